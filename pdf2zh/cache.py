@@ -1,8 +1,29 @@
+import abc
+import atexit
+import collections
+import hashlib
 import logging
 import os
 import json
-from peewee import Model, SqliteDatabase, AutoField, CharField, TextField, SQL
+import sqlite3
+import threading
+import time
+from peewee import (
+    fn,
+    Model,
+    SqliteDatabase,
+    AutoField,
+    BlobField,
+    CharField,
+    FloatField,
+    TextField,
+    SQL,
+    PeeweeException,
+)
 from typing import Optional
+from urllib.parse import urlsplit
+
+from pdf2zh.config import ConfigManager
 
 
 # we don't init the database here
@@ -10,27 +31,133 @@ db = SqliteDatabase(None)
 logger = logging.getLogger(__name__)
 
 
+def text_digest(translate_engine: str, translate_engine_params: str, text: str):
+    """The 16 byte key of a translation, see TranslationCache.digest."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{translate_engine}\0{translate_engine_params}\0".encode())
+    h.update(text.encode())
+    return h.digest()
+
+
+class LRUCache:
+    """
+    Bounded in-memory tier in front of the database, shared by every thread
+    and every TranslationCache. The least recently used entries are evicted
+    beyond max_entries entries or max_bytes bytes of UTF-8 text.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # digest -> (原文, 译文, 字节数)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[tuple[str, str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def set(self, key: bytes, original_text: str, translation: str):
+        size = len(original_text.encode()) + len(translation.encode())
+        with self.lock:
+            if (entry := self.entries.pop(key, None)) is not None:
+                self.bytes -= entry[2]
+            self.entries[key] = (original_text, translation, size)
+            self.bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.bytes > self.max_bytes
+            ):
+                _, entry = self.entries.popitem(last=False)
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+memory_cache = LRUCache()
+
+
 class _TranslationCache(Model):
     id = AutoField()
+    # 只索引定长摘要，原文仅用于校验
+    digest = BlobField()
     translate_engine = CharField(max_length=20)
     translate_engine_params = TextField()
     original_text = TextField()
     translation = TextField()
+    # 最近一次读写的时间，按它淘汰过期和最久未用的译文
+    last_access = FloatField(index=True)
 
     class Meta:
         database = db
-        constraints = [
-            SQL(
-                """
-            UNIQUE (
-                translate_engine,
-                translate_engine_params,
-                original_text
-                )
-            ON CONFLICT REPLACE
-            """
+        constraints = [SQL("UNIQUE (digest) ON CONFLICT REPLACE")]
+
+
+class _LayoutCache(Model):
+    id = AutoField()
+    page_hash = CharField(max_length=64)
+    layout = TextField()
+    last_access = FloatField(index=True)
+
+    class Meta:
+        database = db
+        constraints = [SQL("UNIQUE (page_hash) ON CONFLICT REPLACE")]
+
+
+class LayoutCache:
+    """
+    Layout detected on a page, keyed by a digest of everything that affects
+    the rendered page and the layout model.
+    """
+
+    @staticmethod
+    def get(page_hash: str) -> Optional[dict]:
+        # 缓存是可选的，数据库被锁定、损坏或内容无效时视为未命中，重新分析版面
+        try:
+            result = _LayoutCache.get_or_none(page_hash=page_hash)
+            if result is None:
+                return None
+            layout = json.loads(result.layout)
+            if not isinstance(layout, dict):
+                raise ValueError(f"invalid layout {result.layout[:100]}")
+            # 淘汰以天计，访问时间每天最多更新一次
+            now = time.time()
+            if result.last_access < now - 86400:
+                _LayoutCache.update(last_access=now).where(
+                    _LayoutCache.id == result.id
+                ).execute()
+            return layout
+        except (PeeweeException, sqlite3.Error, ValueError) as e:
+            logger.debug(f"Error getting layout cache: {e}")
+            return None
+
+    @staticmethod
+    def set(page_hash: str, layout: dict):
+        try:
+            _LayoutCache.create(
+                page_hash=page_hash, layout=json.dumps(layout), last_access=time.time()
             )
-        ]
+        except Exception as e:
+            logger.debug(f"Error setting layout cache: {e}")
 
 
 class TranslationCache:
@@ -62,6 +189,10 @@ class TranslationCache:
         self.params = params
         params = self._sort_dict_recursively(params)
         self.translate_engine_params = json.dumps(params)
+        self._prefix = hashlib.blake2b(digest_size=16)
+        self._prefix.update(
+            f"{self.translate_engine}\0{self.translate_engine_params}\0".encode()
+        )
 
     def update_params(self, params: dict = None):
         if params is None:
@@ -73,49 +204,526 @@ class TranslationCache:
         self.params[k] = v
         self.replace_params(self.params)
 
+    def digest(self, original_text: str) -> bytes:
+        """
+        blake2b digest of the engine, its parameters and the text, the only
+        indexed column of the cache.
+        """
+        h = self._prefix.copy()
+        h.update(original_text.encode())
+        return h.digest()
+
     # Since peewee and the underlying sqlite are thread-safe,
     # get and set operations don't need locks.
     def get(self, original_text: str) -> Optional[str]:
-        result = _TranslationCache.get_or_none(
-            translate_engine=self.translate_engine,
-            translate_engine_params=self.translate_engine_params,
-            original_text=original_text,
-        )
-        return result.translation if result else None
+        return self.get_many([original_text])[0]
 
-    def set(self, original_text: str, translation: str):
+    def get_many(self, texts: list[str]) -> list[Optional[str]]:
+        """
+        Look up the translations of texts, in memory first and then with one
+        query for all the texts not found there.
+        """
+        digests = [self.digest(text) for text in texts]
+        translations = [None] * len(texts)
+        missing = {}
+        for i, (text, digest) in enumerate(zip(texts, digests)):
+            entry = memory_cache.get(digest) or write_buffer.get(digest)
+            if entry is None:
+                missing.setdefault(digest, []).append(i)
+            elif entry[0] == text:
+                translations[i] = entry[1]
+                write_buffer.touch(digest)
+        if not missing:
+            return translations
         try:
-            _TranslationCache.create(
-                translate_engine=self.translate_engine,
-                translate_engine_params=self.translate_engine_params,
-                original_text=original_text,
-                translation=translation,
+            found = backend.get_many(list(missing))
+        except Exception as e:  # 缓存不可用时照常翻译
+            logger.warning(f"Error getting cache: {e}")
+            return translations
+        for digest, (text, translation) in found.items():
+            for i in missing[digest]:
+                if texts[i] == text:
+                    translations[i] = translation
+            memory_cache.set(digest, text, translation)
+            write_buffer.touch(digest)
+        return translations
+
+    def set(self, original_text: str, translation: str):
+        digest = self.digest(original_text)
+        memory_cache.set(digest, original_text, translation)
+        write_buffer.add(
+            digest,
+            {
+                "digest": digest,
+                "translate_engine": self.translate_engine,
+                "translate_engine_params": self.translate_engine_params,
+                "original_text": original_text,
+                "translation": translation,
+                "last_access": time.time(),
+            },
+        )
+
+    def set_many(self, texts: list[str], translations: list[str]):
+        for text, translation in zip(texts, translations):
+            self.set(text, translation)
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage behind the in-memory tier of the translation cache, keyed by the
+    digests of TranslationCache.
+    """
+
+    @abc.abstractmethod
+    def get_many(self, digests: list[bytes]) -> dict[bytes, tuple[str, str]]:
+        """Return (original_text, translation) of the digests found."""
+
+    @abc.abstractmethod
+    def set_many(self, rows: list[dict]):
+        """Store rows with the columns of _TranslationCache."""
+
+    def touch(self, digests: list[bytes]):
+        """Record that the digests were just used."""
+
+    @abc.abstractmethod
+    def stats(self) -> dict:
+        """
+        Return the location, number of entries, size and free bytes, the
+        oldest and newest access times and the entries of each engine.
+        """
+
+    @abc.abstractmethod
+    def prune(self, ttl: float = 0, max_size: int = 0) -> int:
+        """
+        Delete the translations unused for ttl seconds, then the least
+        recently used ones until the cache is below max_size bytes. Return the
+        number of deleted translations.
+        """
+
+    def vacuum(self):
+        """Release some free space, cheap enough to run after every prune."""
+
+    @abc.abstractmethod
+    def compact(self):
+        """Return the free space of deleted translations to the system."""
+
+
+class SQLiteBackend(CacheBackend):
+    """The cache.v2.db file of the user, shared by the processes of a host."""
+
+    def get_many(self, digests: list[bytes]) -> dict[bytes, tuple[str, str]]:
+        found = {}
+        # 每次查询的参数个数不超过 SQLite 的上限
+        for start in range(0, len(digests), 500):
+            query = _TranslationCache.select().where(
+                _TranslationCache.digest.in_(digests[start : start + 500])
             )
+            for result in query:
+                found[bytes(result.digest)] = (result.original_text, result.translation)
+        return found
+
+    def set_many(self, rows: list[dict]):
+        with _TranslationCache._meta.database.atomic():
+            _TranslationCache.insert_many(rows).execute()
+
+    def touch(self, digests: list[bytes]):
+        now = time.time()
+        with _TranslationCache._meta.database.atomic():
+            for start in range(0, len(digests), 500):
+                _TranslationCache.update(last_access=now).where(
+                    _TranslationCache.digest.in_(digests[start : start + 500])
+                ).execute()
+
+    def pragma(self, name: str) -> int:
+        return _TranslationCache._meta.database.execute_sql(
+            f"PRAGMA {name}"
+        ).fetchone()[0]
+
+    def stats(self) -> dict:
+        page_size = self.pragma("page_size")
+        oldest, newest = _TranslationCache.select(
+            fn.MIN(_TranslationCache.last_access),
+            fn.MAX(_TranslationCache.last_access),
+        ).scalar(as_tuple=True)
+        engines = (
+            _TranslationCache.select(
+                _TranslationCache.translate_engine, fn.COUNT(_TranslationCache.id)
+            )
+            .group_by(_TranslationCache.translate_engine)
+            .tuples()
+        )
+        return {
+            "path": _TranslationCache._meta.database.database,
+            "entries": _TranslationCache.select().count(),
+            "size": self.pragma("page_count") * page_size,
+            "free": self.pragma("freelist_count") * page_size,
+            "oldest": oldest,
+            "newest": newest,
+            "engines": dict(engines),
+        }
+
+    def delete_oldest(self, model: type[Model], where, limit: int) -> int:
+        # 分批删除，每个事务很短，不会长时间阻塞翻译进程的写入
+        deleted = 0
+        while deleted < limit:
+            ids = (
+                model.select(model.id)
+                .where(where)
+                .order_by(model.last_access)
+                .limit(min(1000, limit - deleted))
+            )
+            count = model.delete().where(model.id.in_(ids)).execute()
+            if not count:
+                break
+            deleted += count
+        return deleted
+
+    def prune(self, ttl: float = 0, max_size: int = 0) -> int:
+        """
+        Delete the translations and layouts unused for ttl seconds, then the
+        least recently used ones of both until the file fits in max_size.
+        """
+        deleted = 0
+        models = [_TranslationCache, _LayoutCache]
+        if ttl:
+            for model in models:
+                deleted += self.delete_oldest(
+                    model, model.last_access < time.time() - ttl, float("inf")
+                )
+        if max_size:
+            page_size = self.pragma("page_size")
+            used = (
+                self.pragma("page_count") - self.pragma("freelist_count")
+            ) * page_size
+            if used > max_size:
+                # 两张表按相同比例删除，按平均每行的大小估计需要删除的行数
+                for model in models:
+                    count = model.select().count()
+                    limit = -(-count * (used - max_size) // used)
+                    deleted += self.delete_oldest(model, True, limit)
+        return deleted
+
+    def vacuum(self):
+        """Free the unused pages at the end of the file, see auto_vacuum."""
+        _TranslationCache._meta.database.execute_sql("PRAGMA incremental_vacuum")
+
+    def compact(self):
+        database = _TranslationCache._meta.database
+        database.execute_sql("VACUUM")
+        database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class RedisBackend(CacheBackend):
+    """
+    A Redis server shared by every worker of a deployment. Each translation
+    is a key of prefix and the hex digest, expiring ttl seconds after its
+    last use. The size is left to the maxmemory policy of the server, and
+    prune uses the idle time of the keys. The engines of the translations
+    are not stored, so stats can not count them.
+    """
+
+    def __init__(
+        self, url: str = "redis://127.0.0.1:6379/0", client=None, ttl: float = 0
+    ):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                logger.warning(
+                    "redis is not installed, install pdf2zh[backend] to use the redis cache backend"
+                )
+                raise
+            client = redis.Redis.from_url(url)
+        # 显示的地址不带密码
+        parts = urlsplit(url)
+        if "@" in parts.netloc:
+            url = parts._replace(netloc=parts.netloc.rpartition("@")[2]).geturl()
+        self.url = url
+        self.client = client
+        self.prefix = "pdf2zh:cache:"
+        self.ttl = int(ttl) or None
+
+    def get_many(self, digests: list[bytes]) -> dict[bytes, tuple[str, str]]:
+        values = self.client.mget([self.prefix + d.hex() for d in digests])
+        return {
+            digest: tuple(json.loads(value))
+            for digest, value in zip(digests, values)
+            if value is not None
+        }
+
+    def set_many(self, rows: list[dict]):
+        pipeline = self.client.pipeline(transaction=False)
+        for row in rows:
+            pipeline.set(
+                self.prefix + row["digest"].hex(),
+                json.dumps([row["original_text"], row["translation"]]),
+                ex=self.ttl,
+            )
+        pipeline.execute()
+
+    def touch(self, digests: list[bytes]):
+        if not self.ttl:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for digest in digests:
+            pipeline.expire(self.prefix + digest.hex(), self.ttl)
+        pipeline.execute()
+
+    def scan(self) -> list[tuple[bytes, int, int]]:
+        """Return (key, idle seconds, bytes) of every translation."""
+        keys = list(self.client.scan_iter(match=self.prefix + "*", count=1000))
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.object("idletime", key)
+            pipeline.memory_usage(key)
+        results = pipeline.execute()
+        # 扫描之后过期的键没有结果
+        return [
+            (key, idle, size)
+            for key, idle, size in zip(keys, results[::2], results[1::2])
+            if idle is not None and size is not None
+        ]
+
+    def stats(self) -> dict:
+        entries = self.scan()
+        memory = self.client.info("memory")
+        now = time.time()
+        return {
+            "path": self.url,
+            "entries": len(entries),
+            "size": sum(size for _, _, size in entries),
+            # 碎片占用的内存，compact 可以归还给系统
+            "free": max(memory["used_memory_rss"] - memory["used_memory"], 0),
+            "oldest": now - max((idle for _, idle, _ in entries), default=0),
+            "newest": now - min((idle for _, idle, _ in entries), default=0),
+            "engines": {},
+        }
+
+    def prune(self, ttl: float = 0, max_size: int = 0) -> int:
+        entries = sorted(self.scan(), key=lambda entry: entry[1], reverse=True)
+        expired = [entry for entry in entries if ttl and entry[1] > ttl]
+        size = sum(size for _, _, size in entries[len(expired) :])
+        for entry in entries[len(expired) :]:
+            if not max_size or size <= max_size:
+                break
+            expired.append(entry)
+            size -= entry[2]
+        for start in range(0, len(expired), 1000):
+            self.client.delete(*[key for key, _, _ in expired[start : start + 1000]])
+        return len(expired)
+
+    def compact(self):
+        self.client.memory_purge()
+
+
+backend: CacheBackend = SQLiteBackend()
+
+
+class WriteBuffer:
+    """
+    New translations waiting to be written to the backend. They are written
+    in one transaction every max_entries entries, at the end of each document
+    and when the process exits.
+    """
+
+    def __init__(self, max_entries: int = 100):
+        self.max_entries = max_entries
+        self.rows = {}  # digest -> 数据库中的一行
+        self.writing = {}  # 正在写入的行，写完之前仍然可以读到
+        self.touched = set()  # 读到的译文，批量更新访问时间
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # 同一时间只有一个线程写入
+
+    def get(self, digest: bytes) -> Optional[tuple[str, str]]:
+        with self.lock:
+            row = self.rows.get(digest) or self.writing.get(digest)
+        return (row["original_text"], row["translation"]) if row else None
+
+    def add(self, digest: bytes, row: dict):
+        with self.lock:
+            self.rows[digest] = row
+            full = len(self.rows) >= self.max_entries
+        if full:
+            self.flush()
+
+    def touch(self, digest: bytes):
+        with self.lock:
+            self.touched.add(digest)
+
+    def flush(self):
+        # 在锁内换出缓冲区，在锁外写入，写入期间其他线程照常读写缓冲区
+        with self.flush_lock:
+            with self.lock:
+                self.writing, self.rows = self.rows, {}
+                touched, self.touched = self.touched, set()
+            try:
+                if self.writing:
+                    backend.set_many(list(self.writing.values()))
+                # 新写入的译文已带有访问时间
+                if touched := [d for d in touched if d not in self.writing]:
+                    backend.touch(touched)
+            except Exception as e:
+                # 译文仍在内存缓存中，只是不会保存到后端
+                logger.warning(
+                    f"Error writing {len(self.writing)} translations to the cache: {e}"
+                )
+            finally:
+                with self.lock:
+                    self.writing = {}
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+            self.touched.clear()
+
+
+write_buffer = WriteBuffer()
+atexit.register(write_buffer.flush)
+
+
+def migrate_v1(v1_path: str, v2_path: str, chunk_size: int = 10000):
+    """
+    Copy the translations and layouts of a cache.v1.db into a new
+    cache.v2.db, adding the digest of every translation.
+    """
+    logger.info(f"Migrating translation cache {v1_path} to {v2_path}")
+    # 先写入临时文件再改名，迁移中断或多个进程同时迁移时不会留下不完整的数据库
+    tmp_path = f"{v2_path}.{os.getpid()}.tmp"
+    tmp_db = SqliteDatabase(tmp_path, pragmas={"auto_vacuum": "incremental"})
+    with tmp_db.bind_ctx([_TranslationCache, _LayoutCache]):
+        tmp_db.create_tables([_TranslationCache, _LayoutCache])
+    tmp_db.close()
+    src = sqlite3.connect(f"file:{v1_path}?mode=ro", uri=True)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        tables = {name for (name,) in src.execute("SELECT name FROM sqlite_master")}
+        if "_translationcache" in tables:
+            rows = src.execute(
+                "SELECT translate_engine, translate_engine_params, original_text, "
+                "translation FROM _translationcache ORDER BY id"
+            )
+            now = time.time()
+            while chunk := rows.fetchmany(chunk_size):
+                dst.executemany(
+                    "INSERT INTO _translationcache (digest, translate_engine, "
+                    "translate_engine_params, original_text, translation, "
+                    "last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(text_digest(*row[:3]), *row, now) for row in chunk],
+                )
+        if "_layoutcache" in tables:  # 旧版本的缓存没有布局表
+            dst.executemany(
+                "INSERT INTO _layoutcache (page_hash, layout) VALUES (?, ?)",
+                src.execute("SELECT page_hash, layout FROM _layoutcache ORDER BY id"),
+            )
+        dst.commit()
+    except BaseException:
+        dst.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        src.close()
+        dst.close()
+    os.replace(tmp_path, v2_path)
+    logger.info(f"Translation cache migrated, {v1_path} can be deleted")
+
+
+def upgrade_schema(database: SqliteDatabase):
+    """Add the columns of newer versions to an existing cache.v2.db."""
+    for table in ["_translationcache", "_layoutcache"]:
+        if not database.table_exists(table):
+            continue
+        columns = {column.name for column in database.get_columns(table)}
+        if "last_access" not in columns:
+            # 常量默认值不需要改写已有的行，已有的行从现在开始计算过期时间
+            database.execute_sql(
+                f"ALTER TABLE {table} ADD COLUMN last_access REAL NOT NULL "
+                f"DEFAULT {time.time()}"
+            )
+
+
+def maintain(ttl: float, max_size: int, interval: float = 3600, delay: float = 0):
+    """
+    Prune the cache every interval seconds, the first time after delay
+    seconds, and free the unused pages.
+    """
+    time.sleep(delay)
+    while True:
+        try:
+            if deleted := backend.prune(ttl, max_size):
+                logger.info(f"Pruned {deleted} translations from the cache")
+            backend.vacuum()
         except Exception as e:
-            logger.debug(f"Error setting cache: {e}")
+            logger.debug(f"Error pruning cache: {e}")
+        time.sleep(interval)
 
 
 def init_db(remove_exists=False):
     cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "pdf2zh")
     os.makedirs(cache_folder, exist_ok=True)
-    # The current version does not support database migration, so add the version number to the file name.
-    cache_db_path = os.path.join(cache_folder, "cache.v1.db")
+    # 数据库结构变化时升级文件名中的版本号，并从旧版本迁移
+    cache_db_path = os.path.join(cache_folder, "cache.v2.db")
     if remove_exists and os.path.exists(cache_db_path):
         os.remove(cache_db_path)
+    v1_path = os.path.join(cache_folder, "cache.v1.db")
+    if not os.path.exists(cache_db_path) and os.path.exists(v1_path):
+        try:
+            migrate_v1(v1_path, cache_db_path)
+        except Exception as e:
+            logger.warning(f"Error migrating translation cache: {e}")
+    memory_cache.max_entries = int(ConfigManager.get("CACHE_MEMORY_ENTRIES", 10000))
+    memory_cache.max_bytes = int(ConfigManager.get("CACHE_MEMORY_BYTES", 64 << 20))
+    global backend
+    ttl = float(ConfigManager.get("CACHE_TTL_DAYS", 0)) * 86400
+    if ConfigManager.get("CACHE_BACKEND", "sqlite") == "redis":
+        backend = RedisBackend(
+            ConfigManager.get("CACHE_REDIS_URL", "redis://127.0.0.1:6379/0"), ttl=ttl
+        )
+    else:
+        backend = SQLiteBackend()
+    memory_cache.clear()
+    write_buffer.max_entries = int(ConfigManager.get("CACHE_FLUSH_ENTRIES", 100))
     db.init(
         cache_db_path,
         pragmas={
             "journal_mode": "wal",
             "busy_timeout": 1000,
+            # 新建的数据库才生效，已有的数据库在 pdf2zh cache compact 后生效
+            "auto_vacuum": "incremental",
         },
     )
-    db.create_tables([_TranslationCache], safe=True)
+    upgrade_schema(db)
+    db.create_tables([_TranslationCache, _LayoutCache], safe=True)
+
+
+_maintenance: Optional[threading.Thread] = None
+
+
+def start_maintenance(delay: float = 600):
+    """
+    Prune the SQLite cache in the background when CACHE_TTL_DAYS or
+    CACHE_MAX_SIZE_MB is set. Only long-running processes (the GUI and the
+    servers) call this; the others leave the cache to pdf2zh cache prune.
+    """
+    global _maintenance
+    ttl = float(ConfigManager.get("CACHE_TTL_DAYS", 0)) * 86400
+    max_size = int(float(ConfigManager.get("CACHE_MAX_SIZE_MB", 0)) * (1 << 20))
+    if _maintenance or not isinstance(backend, SQLiteBackend) or not (ttl or max_size):
+        return
+    # 启动后先等待一段时间，不和启动过程争用数据库
+    _maintenance = threading.Thread(
+        target=maintain, args=(ttl, max_size), kwargs={"delay": delay}, daemon=True
+    )
+    _maintenance.start()
 
 
 def init_test_db():
     import tempfile
 
+    global backend
     cache_db_path = tempfile.mktemp(suffix=".db")
+    backend = SQLiteBackend()
+    memory_cache.clear()
+    write_buffer.clear()
     test_db = SqliteDatabase(
         cache_db_path,
         pragmas={
@@ -123,14 +731,18 @@ def init_test_db():
             "busy_timeout": 1000,
         },
     )
-    test_db.bind([_TranslationCache], bind_refs=False, bind_backrefs=False)
+    test_db.bind(
+        [_TranslationCache, _LayoutCache], bind_refs=False, bind_backrefs=False
+    )
     test_db.connect()
-    test_db.create_tables([_TranslationCache], safe=True)
+    test_db.create_tables([_TranslationCache, _LayoutCache], safe=True)
     return test_db
 
 
 def clean_test_db(test_db):
-    test_db.drop_tables([_TranslationCache])
+    memory_cache.clear()
+    write_buffer.clear()
+    test_db.drop_tables([_TranslationCache, _LayoutCache])
     test_db.close()
     db_path = test_db.database
     if os.path.exists(db_path):
@@ -56,25 +56,33 @@ class ConfigManager:
         with self._lock:  # 加锁确保线程安全
             # 移除循环引用并写入
             cleaned_data = self._remove_circular_references(self._config_data)
-            with self._config_path.open("w", encoding="utf-8") as f:
+            # 先写临时文件再替换，避免多进程同时写入时读到不完整的配置
+            tmp_path = self._config_path.with_name(
+                f"{self._config_path.name}.{os.getpid()}.tmp"
+            )
+            with tmp_path.open("w", encoding="utf-8") as f:
                 json.dump(cleaned_data, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self._config_path)
 
     def _remove_circular_references(self, obj, seen=None):
         """递归移除循环引用"""
         if seen is None:
             seen = set()
+        if not isinstance(obj, (dict, list)):
+            return obj  # 只有容器会形成循环，相同的数字和字符串可能是同一个对象
         obj_id = id(obj)
         if obj_id in seen:
-            return None  # 遇到已处理过的对象，视为循环引用
+            return None  # 遇到当前路径上的对象，视为循环引用
         seen.add(obj_id)
 
         if isinstance(obj, dict):
-            return {
+            result = {
                 k: self._remove_circular_references(v, seen) for k, v in obj.items()
             }
-        elif isinstance(obj, list):
-            return [self._remove_circular_references(i, seen) for i in obj]
-        return obj
+        else:
+            result = [self._remove_circular_references(i, seen) for i in obj]
+        seen.discard(obj_id)
+        return result
 
     @classmethod
     def custome_config(cls, file_path):
@@ -90,6 +98,11 @@ class ConfigManager:
             instance._ensure_config_exists(isInit=False)
             cls._instance = instance
 
+    @classmethod
+    def path(cls) -> Path:
+        """返回当前使用的配置文件路径"""
+        return cls.get_instance()._config_path
+
     @classmethod
     def get(cls, key, default=None):
         """获取配置值"""
@@ -1,6 +1,8 @@
+import asyncio
 import concurrent.futures
 import logging
 import re
+import threading
 import unicodedata
 from enum import Enum
 from string import Template
@@ -13,8 +15,12 @@ from pdfminer.pdffont import PDFCIDFont, PDFUnicodeNotDefined
 from pdfminer.pdfinterp import PDFGraphicState, PDFResourceManager
 from pdfminer.utils import apply_matrix_pt, mult_matrix
 from pymupdf import Font
-from tenacity import retry, wait_fixed
+from tenacity import retry, retry_if_not_exception_type, wait_fixed
 
+from pdf2zh.config import ConfigManager
+from pdf2zh.hedge import DaemonExecutor
+from pdf2zh.ratelimit import AdaptiveConcurrency
+from pdf2zh.transport import get_session, request_timeout
 from pdf2zh.translator import (
     AnythingLLMTranslator,
     ArgosTranslator,
@@ -26,6 +32,7 @@ from pdf2zh.translator import (
     DeepLXTranslator,
     DeepseekTranslator,
     DifyTranslator,
+    FallbackTranslator,
     GeminiTranslator,
     GoogleTranslator,
     GrokTranslator,
@@ -40,6 +47,8 @@ from pdf2zh.translator import (
     XinferenceTranslator,
     ZhipuTranslator,
     X302AITranslator,
+    ServicesUnavailableError,
+    join_chunks,
 )
 
 log = logging.getLogger(__name__)
@@ -115,6 +124,81 @@ class PDFConverterEx(PDFConverter):
         return item.adv
 
 
+class PendingOps:
+    """
+    Operators of a page or form, fn(results) of the futures of its translated
+    paragraphs. result() runs fn in the calling thread: typesetting uses
+    PyMuPDF, which is not thread-safe, so it stays on the thread that parses
+    the pages instead of the translation threads.
+    """
+
+    def __init__(self, futures: list[concurrent.futures.Future], fn):
+        self.futures = futures
+        self.fn = fn
+
+    def then(self, fn) -> "PendingOps":
+        return PendingOps(self.futures, lambda results: fn(self.fn(results)))
+
+    def catch(self, default) -> "PendingOps":
+        """Return default instead of raising when typesetting fails."""
+
+        def fn(results):
+            try:
+                return self.fn(results)
+            except Exception as e:
+                log.debug(f"Typesetting failed: {e}")
+                return default
+
+        return PendingOps(self.futures, fn)
+
+    def done(self) -> bool:
+        return all(f.done() for f in self.futures)
+
+    def result(self, timeout: float = None) -> str:
+        _, not_done = concurrent.futures.wait(self.futures, timeout)
+        if not_done:
+            raise concurrent.futures.TimeoutError()
+        return self.fn([f.result() for f in self.futures])
+
+
+class AsyncExecutor:
+    """
+    Run coroutine functions on an event loop in a background thread, at most
+    max_workers at a time. Has the submit/shutdown interface of
+    concurrent.futures executors, so thousands of requests can be in flight
+    without a thread each.
+    """
+
+    def __init__(self, max_workers: int):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        async def run():
+            async with self.semaphore:
+                return await fn(*args)
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        async def stop():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if cancel_futures:
+                for task in tasks:
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.stop()
+
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(stop(), self.loop)
+        if wait:
+            self.thread.join()
+            self.loop.close()
+
+
 class Paragraph:
     def __init__(self, y, x, x0, x1, y0, y1, size, brk):
         self.y: float = y  # 初始纵坐标
@@ -128,6 +212,24 @@ class Paragraph:
 
 
 # fmt: off
+def create_translator(service: str, lang_in: str, lang_out: str, envs: Dict = None, prompt: Template = None, ignore_cache: bool = False) -> BaseTranslator:
+    # e.g. "deepl>openai>google"，依次回退，envs 只属于第一个服务
+    if ">" in service:
+        services = service.split(">")
+        return FallbackTranslator([create_translator(s, lang_in, lang_out, envs if i == 0 else None, prompt, ignore_cache) for i, s in enumerate(services)])
+    # e.g. "ollama:gemma2:9b" -> ["ollama", "gemma2:9b"]
+    param = service.split(":", 1)
+    service_name = param[0]
+    service_model = param[1] if len(param) > 1 else None
+    if not envs:
+        envs = {}
+    for translator in [GoogleTranslator, BingTranslator, DeepLTranslator, DeepLXTranslator, OllamaTranslator, XinferenceTranslator, AzureOpenAITranslator,
+                       OpenAITranslator, ZhipuTranslator, ModelScopeTranslator, SiliconTranslator, GeminiTranslator, AzureTranslator, TencentTranslator, DifyTranslator, AnythingLLMTranslator, ArgosTranslator, GrokTranslator, GroqTranslator, DeepseekTranslator, OpenAIlikedTranslator, QwenMtTranslator, X302AITranslator]:
+        if service_name == translator.name:
+            return translator(lang_in, lang_out, service_model, envs=envs, prompt=prompt, ignore_cache=ignore_cache)
+    raise ValueError("Unsupported translation service")
+
+
 class TranslateConverter(PDFConverterEx):
     def __init__(
         self,
@@ -144,6 +246,7 @@ class TranslateConverter(PDFConverterEx):
         envs: Dict = None,
         prompt: Template = None,
         ignore_cache: bool = False,
+        adaptive: bool = False,
     ) -> None:
         super().__init__(rsrcmgr)
         self.vfont = vfont
@@ -152,19 +255,41 @@ class TranslateConverter(PDFConverterEx):
         self.layout = layout
         self.noto_name = noto_name
         self.noto = noto
-        self.translator: BaseTranslator = None
-        # e.g. "ollama:gemma2:9b" -> ["ollama", "gemma2:9b"]
-        param = service.split(":", 1)
-        service_name = param[0]
-        service_model = param[1] if len(param) > 1 else None
-        if not envs:
-            envs = {}
-        for translator in [GoogleTranslator, BingTranslator, DeepLTranslator, DeepLXTranslator, OllamaTranslator, XinferenceTranslator, AzureOpenAITranslator,
-                           OpenAITranslator, ZhipuTranslator, ModelScopeTranslator, SiliconTranslator, GeminiTranslator, AzureTranslator, TencentTranslator, DifyTranslator, AnythingLLMTranslator, ArgosTranslator, GrokTranslator, GroqTranslator, DeepseekTranslator, OpenAIlikedTranslator, QwenMtTranslator, X302AITranslator]:
-            if service_name == translator.name:
-                self.translator = translator(lang_in, lang_out, service_model, envs=envs, prompt=prompt, ignore_cache=ignore_cache)
-        if not self.translator:
-            raise ValueError("Unsupported translation service")
+        self.fontmap: Dict = {}         # 由 interpreter 在每个页面和 xobj 解析完成后设置
+        self.fontid: Dict = {}
+        self.translator: BaseTranslator = create_translator(service, lang_in, lang_out, envs, prompt, ignore_cache)
+        # 请求超时，以及超过 p95 延迟时发往 HEDGE_SERVICE 的对冲请求
+        timeout = request_timeout()
+        hedge = None
+        if (hedge_service := ConfigManager.get("HEDGE_SERVICE", "")) and hedge_service != service:
+            hedge = create_translator(hedge_service, lang_in, lang_out, None, prompt, ignore_cache)
+            if adaptive:  # 对冲服务的请求同样受自适应并发限制
+                hedge.concurrency = AdaptiveConcurrency(max(thread, 1))
+        # 有截止时间或对冲时同步请求在线程中执行，每个翻译线程最多同时有一个原请求和一个对冲请求
+        self.hedge_executor = None
+        if timeout or hedge_service:
+            self.hedge_executor = DaemonExecutor(max(thread, 1) * 2)
+        # 回退链中的每个服务分别设置
+        for translator in getattr(self.translator, "translators", [self.translator]):
+            translator.timeout = timeout
+            translator.hedge_executor = self.hedge_executor
+            if hedge_service:
+                translator.hedge = hedge or translator
+            if adaptive:  # 并发数在 1 到 thread 之间自动调整
+                translator.concurrency = AdaptiveConcurrency(max(thread, 1))
+        # HTTP 连接池容纳所有并发请求，对冲请求另需一份
+        get_session(max(thread, 1) * (2 if hedge_service else 1))
+        # 整个文档共用一个线程池，各页面的段落提交后立即开始翻译，始终保持 thread 个请求
+        # 翻译服务有异步客户端时改用事件循环，并发请求不再占用线程
+        if self.translator.asynchronous:
+            self.executor = AsyncExecutor(max_workers=max(thread, 1))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(thread, 1))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False, cancel_futures=True)
 
     def receive_layout(self, ltpage: LTPage):
         # 段落
@@ -185,7 +310,6 @@ class TranslateConverter(PDFConverterEx):
         xt: LTChar = None               # 上一个字符
         xt_cls: int = -1                # 上一个字符所属段落，保证无论第一个字符属于哪个类别都可以触发新段落
         vmax: float = ltpage.width / 4  # 行内公式最大宽度
-        ops: str = ""                   # 渲染结果
 
         def vflag(font: str, char: str):    # 匹配公式（和角标）字体
             if isinstance(font, bytes):     # 不一定能 decode，直接转 str
@@ -225,15 +349,20 @@ class TranslateConverter(PDFConverterEx):
 
         ############################################################
         # A. 原文档解析
+        # 一次性读取所有字符和线条在 layout 中的类别，按遍历顺序依次取出
+        items = [child for child in ltpage if isinstance(child, (LTChar, LTLine))]
+        if items:
+            layout = self.layout[ltpage.pageid]
+            # ltpage.height 可能是 fig 里面的高度，这里统一用 layout.shape
+            h, w = layout.shape
+            cx = np.clip(np.array([child.x0 for child in items]).astype(int), 0, w - 1)
+            cy = np.clip(np.array([child.y0 for child in items]).astype(int), 0, h - 1)
+            layout_cls = iter(layout[cy, cx].tolist())
         for child in ltpage:
             if isinstance(child, LTChar):
                 cur_v = False
-                layout = self.layout[ltpage.pageid]
-                # ltpage.height 可能是 fig 里面的高度，这里统一用 layout.shape
-                h, w = layout.shape
                 # 读取当前字符在 layout 中的类别
-                cx, cy = np.clip(int(child.x0), 0, w - 1), np.clip(int(child.y0), 0, h - 1)
-                cls = layout[cy, cx]
+                cls = next(layout_cls)
                 # 锚定文档中 bullet 的位置
                 if child.get_text() == "•":
                     cls = 0
@@ -316,12 +445,8 @@ class TranslateConverter(PDFConverterEx):
             elif isinstance(child, LTFigure):   # 图表
                 pass
             elif isinstance(child, LTLine):     # 线条
-                layout = self.layout[ltpage.pageid]
-                # ltpage.height 可能是 fig 里面的高度，这里统一用 layout.shape
-                h, w = layout.shape
                 # 读取当前线条在 layout 中的类别
-                cx, cy = np.clip(int(child.x0), 0, w - 1), np.clip(int(child.y0), 0, h - 1)
-                cls = layout[cy, cx]
+                cls = next(layout_cls)
                 if vstk and cls == xt_cls:      # 公式线条
                     vlstk.append(child)
                 else:                           # 全局线条
@@ -344,188 +469,218 @@ class TranslateConverter(PDFConverterEx):
         # B. 段落翻译
         log.debug("\n==========[SSTACK]==========\n")
 
-        @retry(wait=wait_fixed(1))
-        def worker(s: str):  # 多线程翻译
-            if not s.strip() or re.match(r"^\{v\d+\}$", s):  # 空白和公式不翻译
-                return s
+        def log_error(e: BaseException):
+            if log.isEnabledFor(logging.DEBUG):
+                log.exception(e)
+            else:
+                log.exception(e, exc_info=False)
+
+        # 回退链中的服务全部不可用时立即重试也不会成功，不再重试
+        unavailable = retry_if_not_exception_type(ServicesUnavailableError)
+
+        @retry(wait=wait_fixed(1), retry=unavailable)
+        def worker(texts: list[str]):  # 多线程翻译
             try:
-                new = self.translator.translate(s)
-                return new
+                return self.translator.translate_batch(texts)
             except BaseException as e:
-                if log.isEnabledFor(logging.DEBUG):
-                    log.exception(e)
-                else:
-                    log.exception(e, exc_info=False)
+                log_error(e)
+                raise e
+
+        @retry(wait=wait_fixed(1), retry=unavailable)
+        async def aworker(texts: list[str]):  # 异步翻译
+            try:
+                return await self.translator.atranslate_batch(texts)
+            except Exception as e:  # 取消不算翻译错误
+                log_error(e)
                 raise e
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.thread
-        ) as executor:
-            news = list(executor.map(worker, sstk))
+        # 空白和公式不翻译，其余段落按翻译服务的批大小分批
+        todo = [i for i, s in enumerate(sstk) if s.strip() and not re.match(r"^\{v\d+\}$", s)]
+        # 过长的段落按句子分块，各块分到不同批次并行翻译
+        chunks = {i: self.translator.split_text(sstk[i]) for i in todo}
+        pieces = [(i, chunk) for i in todo for chunk in chunks[i]]
+        batches = [pieces[i:i + self.translator.batch_size] for i in range(0, len(pieces), self.translator.batch_size)]
+        # 段落交给文档级线程池翻译，不必等待当前页面翻译完成即可解析下一页
+        fn = aworker if self.translator.asynchronous else worker
+        futures = [self.executor.submit(fn, [chunk for _, chunk in batch]) for batch in batches]
 
         ############################################################
         # C. 新文档排版
-        def raw_string(fcur: str, cstk: str):  # 编码字符串
-            if fcur == self.noto_name:
-                return "".join(["%04x" % self.noto.has_glyph(ord(c)) for c in cstk])
-            elif isinstance(self.fontmap[fcur], PDFCIDFont):  # 判断编码长度
-                return "".join(["%04x" % ord(c) for c in cstk])
-            else:
-                return "".join(["%02x" % ord(c) for c in cstk])
-
-        # 根据目标语言获取默认行距
-        LANG_LINEHEIGHT_MAP = {
-            "zh-cn": 1.4, "zh-tw": 1.4, "zh-hans": 1.4, "zh-hant": 1.4, "zh": 1.4,
-            "ja": 1.1, "ko": 1.2, "en": 1.2, "ar": 1.0, "ru": 0.8, "uk": 0.8, "ta": 0.8
-        }
-        default_line_height = LANG_LINEHEIGHT_MAP.get(self.translator.lang_out.lower(), 1.1) # 小语种默认1.1
-        _x, _y = 0, 0
-        ops_list = []
-
-        def gen_op_txt(font, size, x, y, rtxt):
-            return f"/{font} {size:f} Tf 1 0 0 1 {x:f} {y:f} Tm [<{rtxt}>] TJ "
-
-        def gen_op_line(x, y, xlen, ylen, linewidth):
-            return f"ET q 1 0 0 1 {x:f} {y:f} cm [] 0 d 0 J {linewidth:f} w 0 0 m {xlen:f} {ylen:f} l S Q BT "
-
-        for id, new in enumerate(news):
-            x: float = pstk[id].x                       # 段落初始横坐标
-            y: float = pstk[id].y                       # 段落初始纵坐标
-            x0: float = pstk[id].x0                     # 段落左边界
-            x1: float = pstk[id].x1                     # 段落右边界
-            height: float = pstk[id].y1 - pstk[id].y0   # 段落高度
-            size: float = pstk[id].size                 # 段落字体大小
-            brk: bool = pstk[id].brk                    # 段落换行标记
-            cstk: str = ""                              # 当前文字栈
-            fcur: str = None                            # 当前字体 ID
-            lidx = 0                                    # 记录换行次数
-            tx = x
-            fcur_ = fcur
-            ptr = 0
-            log.debug(f"< {y} {x} {x0} {x1} {size} {brk} > {sstk[id]} | {new}")
-
-            ops_vals: list[dict] = []
-
-            while ptr < len(new):
-                vy_regex = re.match(
-                    r"\{\s*v([\d\s]+)\}", new[ptr:], re.IGNORECASE
-                )  # 匹配 {vn} 公式标记
-                mod = 0  # 文字修饰符
-                if vy_regex:  # 加载公式
-                    ptr += len(vy_regex.group(0))
-                    try:
-                        vid = int(vy_regex.group(1).replace(" ", ""))
-                        adv = vlen[vid]
-                    except Exception:
-                        continue  # 翻译器可能会自动补个越界的公式标记
-                    if var[vid][-1].get_text() and unicodedata.category(var[vid][-1].get_text()[0]) in ["Lm", "Mn", "Sk"]:  # 文字修饰符
-                        mod = var[vid][-1].width
-                else:  # 加载文字
-                    ch = new[ptr]
-                    fcur_ = None
-                    try:
-                        if fcur_ is None and self.fontmap["tiro"].to_unichr(ord(ch)) == ch:
-                            fcur_ = "tiro"  # 默认拉丁字体
-                    except Exception:
-                        pass
-                    if fcur_ is None:
-                        fcur_ = self.noto_name  # 默认非拉丁字体
-                    if fcur_ == self.noto_name: # FIXME: change to CONST
-                        adv = self.noto.char_lengths(ch, size)[0]
-                    else:
-                        adv = self.fontmap[fcur_].char_width(ord(ch)) * size
-                    ptr += 1
-                if (                                # 输出文字缓冲区
-                    fcur_ != fcur                   # 1. 字体更新
-                    or vy_regex                     # 2. 插入公式
-                    or x + adv > x1 + 0.1 * size    # 3. 到达右边界（可能一整行都被符号化，这里需要考虑浮点误差）
-                ):
-                    if cstk:
-                        ops_vals.append({
-                            "type": OpType.TEXT,
-                            "font": fcur,
-                            "size": size,
-                            "x": tx,
-                            "dy": 0,
-                            "rtxt": raw_string(fcur, cstk),
-                            "lidx": lidx
-                        })
-                        cstk = ""
-                if brk and x + adv > x1 + 0.1 * size:  # 到达右边界且原文段落存在换行
-                    x = x0
-                    lidx += 1
-                if vy_regex:  # 插入公式
-                    fix = 0
-                    if fcur is not None:  # 段落内公式修正纵向偏移
-                        fix = varf[vid]
-                    for vch in var[vid]:  # 排版公式字符
-                        vc = chr(vch.cid)
-                        ops_vals.append({
-                            "type": OpType.TEXT,
-                            "font": self.fontid[vch.font],
-                            "size": vch.size,
-                            "x": x + vch.x0 - var[vid][0].x0,
-                            "dy": fix + vch.y0 - var[vid][0].y0,
-                            "rtxt": raw_string(self.fontid[vch.font], vc),
-                            "lidx": lidx
-                        })
-                        if log.isEnabledFor(logging.DEBUG):
-                            lstk.append(LTLine(0.1, (_x, _y), (x + vch.x0 - var[vid][0].x0, fix + y + vch.y0 - var[vid][0].y0)))
-                            _x, _y = x + vch.x0 - var[vid][0].x0, fix + y + vch.y0 - var[vid][0].y0
-                    for l in varl[vid]:  # 排版公式线条
-                        if l.linewidth < 5:  # hack 有的文档会用粗线条当图片背景
+        fontmap, fontid = self.fontmap, self.fontid  # 解析下一页时会被替换，这里先保存当前页面的字体
+
+        def typeset(news: list[str]) -> str:
+            def raw_string(fcur: str, cstk: str):  # 编码字符串
+                if fcur == self.noto_name:
+                    return "".join(["%04x" % self.noto.has_glyph(ord(c)) for c in cstk])
+                elif isinstance(fontmap[fcur], PDFCIDFont):  # 判断编码长度
+                    return "".join(["%04x" % ord(c) for c in cstk])
+                else:
+                    return "".join(["%02x" % ord(c) for c in cstk])
+
+            # 根据目标语言获取默认行距
+            LANG_LINEHEIGHT_MAP = {
+                "zh-cn": 1.4, "zh-tw": 1.4, "zh-hans": 1.4, "zh-hant": 1.4, "zh": 1.4,
+                "ja": 1.1, "ko": 1.2, "en": 1.2, "ar": 1.0, "ru": 0.8, "uk": 0.8, "ta": 0.8
+            }
+            default_line_height = LANG_LINEHEIGHT_MAP.get(self.translator.lang_out.lower(), 1.1) # 小语种默认1.1
+            _x, _y = 0, 0
+            ops_list = []
+
+            def gen_op_txt(font, size, x, y, rtxt):
+                return f"/{font} {size:f} Tf 1 0 0 1 {x:f} {y:f} Tm [<{rtxt}>] TJ "
+
+            def gen_op_line(x, y, xlen, ylen, linewidth):
+                return f"ET q 1 0 0 1 {x:f} {y:f} cm [] 0 d 0 J {linewidth:f} w 0 0 m {xlen:f} {ylen:f} l S Q BT "
+
+            for id, new in enumerate(news):
+                x: float = pstk[id].x                       # 段落初始横坐标
+                y: float = pstk[id].y                       # 段落初始纵坐标
+                x0: float = pstk[id].x0                     # 段落左边界
+                x1: float = pstk[id].x1                     # 段落右边界
+                height: float = pstk[id].y1 - pstk[id].y0   # 段落高度
+                size: float = pstk[id].size                 # 段落字体大小
+                brk: bool = pstk[id].brk                    # 段落换行标记
+                cstk: str = ""                              # 当前文字栈
+                fcur: str = None                            # 当前字体 ID
+                lidx = 0                                    # 记录换行次数
+                tx = x
+                fcur_ = fcur
+                ptr = 0
+                log.debug(f"< {y} {x} {x0} {x1} {size} {brk} > {sstk[id]} | {new}")
+
+                ops_vals: list[dict] = []
+
+                while ptr < len(new):
+                    vy_regex = re.match(
+                        r"\{\s*v([\d\s]+)\}", new[ptr:], re.IGNORECASE
+                    )  # 匹配 {vn} 公式标记
+                    mod = 0  # 文字修饰符
+                    if vy_regex:  # 加载公式
+                        ptr += len(vy_regex.group(0))
+                        try:
+                            vid = int(vy_regex.group(1).replace(" ", ""))
+                            adv = vlen[vid]
+                        except Exception:
+                            continue  # 翻译器可能会自动补个越界的公式标记
+                        if var[vid][-1].get_text() and unicodedata.category(var[vid][-1].get_text()[0]) in ["Lm", "Mn", "Sk"]:  # 文字修饰符
+                            mod = var[vid][-1].width
+                    else:  # 加载文字
+                        ch = new[ptr]
+                        fcur_ = None
+                        try:
+                            if fcur_ is None and fontmap["tiro"].to_unichr(ord(ch)) == ch:
+                                fcur_ = "tiro"  # 默认拉丁字体
+                        except Exception:
+                            pass
+                        if fcur_ is None:
+                            fcur_ = self.noto_name  # 默认非拉丁字体
+                        if fcur_ == self.noto_name: # FIXME: change to CONST
+                            adv = self.noto.char_lengths(ch, size)[0]
+                        else:
+                            adv = fontmap[fcur_].char_width(ord(ch)) * size
+                        ptr += 1
+                    if (                                # 输出文字缓冲区
+                        fcur_ != fcur                   # 1. 字体更新
+                        or vy_regex                     # 2. 插入公式
+                        or x + adv > x1 + 0.1 * size    # 3. 到达右边界（可能一整行都被符号化，这里需要考虑浮点误差）
+                    ):
+                        if cstk:
+                            ops_vals.append({
+                                "type": OpType.TEXT,
+                                "font": fcur,
+                                "size": size,
+                                "x": tx,
+                                "dy": 0,
+                                "rtxt": raw_string(fcur, cstk),
+                                "lidx": lidx
+                            })
+                            cstk = ""
+                    if brk and x + adv > x1 + 0.1 * size:  # 到达右边界且原文段落存在换行
+                        x = x0
+                        lidx += 1
+                    if vy_regex:  # 插入公式
+                        fix = 0
+                        if fcur is not None:  # 段落内公式修正纵向偏移
+                            fix = varf[vid]
+                        for vch in var[vid]:  # 排版公式字符
+                            vc = chr(vch.cid)
                             ops_vals.append({
-                                "type": OpType.LINE,
-                                "x": l.pts[0][0] + x - var[vid][0].x0,
-                                "dy": l.pts[0][1] + fix - var[vid][0].y0,
-                                "linewidth": l.linewidth,
-                                "xlen": l.pts[1][0] - l.pts[0][0],
-                                "ylen": l.pts[1][1] - l.pts[0][1],
+                                "type": OpType.TEXT,
+                                "font": fontid[vch.font],
+                                "size": vch.size,
+                                "x": x + vch.x0 - var[vid][0].x0,
+                                "dy": fix + vch.y0 - var[vid][0].y0,
+                                "rtxt": raw_string(fontid[vch.font], vc),
                                 "lidx": lidx
                             })
-                else:  # 插入文字缓冲区
-                    if not cstk:  # 单行开头
-                        tx = x
-                        if x == x0 and ch == " ":  # 消除段落换行空格
-                            adv = 0
+                            if log.isEnabledFor(logging.DEBUG):
+                                lstk.append(LTLine(0.1, (_x, _y), (x + vch.x0 - var[vid][0].x0, fix + y + vch.y0 - var[vid][0].y0)))
+                                _x, _y = x + vch.x0 - var[vid][0].x0, fix + y + vch.y0 - var[vid][0].y0
+                        for l in varl[vid]:  # 排版公式线条
+                            if l.linewidth < 5:  # hack 有的文档会用粗线条当图片背景
+                                ops_vals.append({
+                                    "type": OpType.LINE,
+                                    "x": l.pts[0][0] + x - var[vid][0].x0,
+                                    "dy": l.pts[0][1] + fix - var[vid][0].y0,
+                                    "linewidth": l.linewidth,
+                                    "xlen": l.pts[1][0] - l.pts[0][0],
+                                    "ylen": l.pts[1][1] - l.pts[0][1],
+                                    "lidx": lidx
+                                })
+                    else:  # 插入文字缓冲区
+                        if not cstk:  # 单行开头
+                            tx = x
+                            if x == x0 and ch == " ":  # 消除段落换行空格
+                                adv = 0
+                            else:
+                                cstk += ch
                         else:
                             cstk += ch
-                    else:
-                        cstk += ch
-                adv -= mod # 文字修饰符
-                fcur = fcur_
-                x += adv
-                if log.isEnabledFor(logging.DEBUG):
-                    lstk.append(LTLine(0.1, (_x, _y), (x, y)))
-                    _x, _y = x, y
-            # 处理结尾
-            if cstk:
-                ops_vals.append({
-                    "type": OpType.TEXT,
-                    "font": fcur,
-                    "size": size,
-                    "x": tx,
-                    "dy": 0,
-                    "rtxt": raw_string(fcur, cstk),
-                    "lidx": lidx
-                })
-
-            line_height = default_line_height
-
-            while (lidx + 1) * size * line_height > height and line_height >= 1:
-                line_height -= 0.05
-
-            for vals in ops_vals:
-                if vals["type"] == OpType.TEXT:
-                    ops_list.append(gen_op_txt(vals["font"], vals["size"], vals["x"], vals["dy"] + y - vals["lidx"] * size * line_height, vals["rtxt"]))
-                elif vals["type"] == OpType.LINE:
-                    ops_list.append(gen_op_line(vals["x"], vals["dy"] + y - vals["lidx"] * size * line_height, vals["xlen"], vals["ylen"], vals["linewidth"]))
-
-        for l in lstk:  # 排版全局线条
-            if l.linewidth < 5:  # hack 有的文档会用粗线条当图片背景
-                ops_list.append(gen_op_line(l.pts[0][0], l.pts[0][1], l.pts[1][0] - l.pts[0][0], l.pts[1][1] - l.pts[0][1], l.linewidth))
-
-        ops = f"BT {''.join(ops_list)}ET "
-        return ops
+                    adv -= mod # 文字修饰符
+                    fcur = fcur_
+                    x += adv
+                    if log.isEnabledFor(logging.DEBUG):
+                        lstk.append(LTLine(0.1, (_x, _y), (x, y)))
+                        _x, _y = x, y
+                # 处理结尾
+                if cstk:
+                    ops_vals.append({
+                        "type": OpType.TEXT,
+                        "font": fcur,
+                        "size": size,
+                        "x": tx,
+                        "dy": 0,
+                        "rtxt": raw_string(fcur, cstk),
+                        "lidx": lidx
+                    })
+
+                line_height = default_line_height
+
+                while (lidx + 1) * size * line_height > height and line_height >= 1:
+                    line_height -= 0.05
+
+                for vals in ops_vals:
+                    if vals["type"] == OpType.TEXT:
+                        ops_list.append(gen_op_txt(vals["font"], vals["size"], vals["x"], vals["dy"] + y - vals["lidx"] * size * line_height, vals["rtxt"]))
+                    elif vals["type"] == OpType.LINE:
+                        ops_list.append(gen_op_line(vals["x"], vals["dy"] + y - vals["lidx"] * size * line_height, vals["xlen"], vals["ylen"], vals["linewidth"]))
+
+            for l in lstk:  # 排版全局线条
+                if l.linewidth < 5:  # hack 有的文档会用粗线条当图片背景
+                    ops_list.append(gen_op_line(l.pts[0][0], l.pts[0][1], l.pts[1][0] - l.pts[0][0], l.pts[1][1] - l.pts[0][1], l.linewidth))
+
+            return f"BT {''.join(ops_list)}ET "
+
+        def merge(results: list[list[str]]) -> str:
+            parts = {i: [] for i in todo}
+            for batch, result in zip(batches, results):
+                for (i, _), new in zip(batch, result):
+                    parts[i].append(new)
+            news = list(sstk)
+            for i in todo:
+                news[i] = join_chunks(chunks[i], parts[i])
+            return typeset(news)
+
+        return PendingOps(futures, merge)
 
 
 class OpType(Enum):
@@ -1,4 +1,6 @@
 import abc
+import hashlib
+import logging
 import os.path
 
 import cv2
@@ -7,7 +9,6 @@ import ast
 from babeldoc.assets.assets import get_doclayout_onnx_model_path
 
 try:
-    import onnx
     import onnxruntime
 except ImportError as e:
     if "DLL load failed" in str(e):
@@ -21,16 +22,65 @@ from huggingface_hub import hf_hub_download
 
 from pdf2zh.config import ConfigManager
 
+logger = logging.getLogger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def model_cache_path(model_path: str, *tags: str, ext: str = ".onnx") -> str:
+    """Path in the cache folder for a file derived from the model and the tags."""
+    stat = os.stat(model_path)
+    key = hashlib.md5(
+        "|".join(
+            [
+                os.path.abspath(model_path),
+                str(stat.st_size),
+                str(stat.st_mtime_ns),
+                onnxruntime.__version__,
+                *tags,
+            ]
+        ).encode()
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "pdf2zh", "onnx")
+    os.makedirs(cache_folder, exist_ok=True)
+    return os.path.join(cache_folder, f"{name}.{key}{ext}")
+
+
+def quantize_model(model_path: str) -> str:
+    """
+    Dynamically quantize the weights of the model to INT8 and return the path
+    of the quantized model, which is cached.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = model_cache_path(model_path, "int8", ext=".int8.onnx")
+    if not os.path.exists(quantized_path):
+        logger.info(f"Quantizing {model_path} to INT8")
+        tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, quantized_path)
+    return quantized_path
+
 
 class DocLayoutModel(abc.ABC):
     @staticmethod
-    def load_onnx():
-        model = OnnxModel.from_pretrained()
+    def load_onnx(quantized: bool = False):
+        model = OnnxModel.from_pretrained(quantized)
         return model
 
     @staticmethod
-    def load_available():
-        return DocLayoutModel.load_onnx()
+    def load_available(quantized: bool = False):
+        return DocLayoutModel.load_onnx(quantized)
 
     @property
     @abc.abstractmethod
@@ -50,6 +100,22 @@ class DocLayoutModel(abc.ABC):
         """
         pass
 
+    def predict_batch(self, images, imgsz=1024, **kwargs) -> list:
+        """
+        Predict the layout of several document pages.
+
+        Args:
+            images: The images of the document pages.
+            imgsz: Resize the images to this size, or a list with one size per image.
+            **kwargs: Additional arguments.
+        """
+        if not isinstance(imgsz, list):
+            imgsz = [imgsz] * len(images)
+        return [
+            self.predict(image, imgsz=size, **kwargs)[0]
+            for image, size in zip(images, imgsz)
+        ]
+
 
 class YoloResult:
     """Helper class to store detection results from ONNX model."""
@@ -70,19 +136,102 @@ class YoloBox:
 
 
 class OnnxModel(DocLayoutModel):
-    def __init__(self, model_path: str):
-        self.model_path = model_path
+    def __init__(
+        self,
+        model_path: str,
+        graph_optimization_level: str = None,
+        intra_op_num_threads: int = None,
+        inter_op_num_threads: int = None,
+        execution_mode: str = None,
+    ):
+        """
+        Args:
+            model_path: Path of the ONNX model.
+            graph_optimization_level: One of "disable", "basic", "extended" or "all".
+            intra_op_num_threads: Threads used inside an operator, 0 for the default.
+            inter_op_num_threads: Threads used between operators, 0 for the default.
+            execution_mode: "sequential" or "parallel".
 
-        model = onnx.load(model_path)
-        metadata = {d.key: d.value for d in model.metadata_props}
+        Options that are not given are read from the configuration file.
+        """
+        self.model_path = model_path
+        if graph_optimization_level is None:
+            graph_optimization_level = ConfigManager.get(
+                "ONNX_GRAPH_OPTIMIZATION_LEVEL", "all"
+            )
+        if intra_op_num_threads is None:
+            intra_op_num_threads = ConfigManager.get("ONNX_INTRA_OP_NUM_THREADS", 0)
+        if inter_op_num_threads is None:
+            inter_op_num_threads = ConfigManager.get("ONNX_INTER_OP_NUM_THREADS", 0)
+        if execution_mode is None:
+            execution_mode = ConfigManager.get("ONNX_EXECUTION_MODE", "sequential")
+        self.graph_optimization_level = graph_optimization_level
+        self.intra_op_num_threads = int(intra_op_num_threads)
+        self.inter_op_num_threads = int(inter_op_num_threads)
+        self.execution_mode = execution_mode
+
+        self.model = self.create_session()
+        metadata = self.model.get_modelmeta().custom_metadata_map
         self._stride = ast.literal_eval(metadata["stride"])
         self._names = ast.literal_eval(metadata["names"])
+        self._batch_failed = False
+
+    def __reduce__(self):
+        # onnxruntime 会话无法序列化，子进程中根据路径重新加载模型
+        return OnnxModel, (
+            self.model_path,
+            self.graph_optimization_level,
+            self.intra_op_num_threads,
+            self.inter_op_num_threads,
+            self.execution_mode,
+        )
 
-        self.model = onnxruntime.InferenceSession(model.SerializeToString())
+    def optimized_model_path(self):
+        """Path where the optimized graph of the model is cached."""
+        if self.graph_optimization_level == "disable" or not os.path.isfile(
+            self.model_path
+        ):
+            return None
+        return model_cache_path(self.model_path, self.graph_optimization_level)
+
+    def create_session(self):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+            self.graph_optimization_level
+        ]
+        options.intra_op_num_threads = self.intra_op_num_threads
+        options.inter_op_num_threads = self.inter_op_num_threads
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        optimized_path = self.optimized_model_path()
+        if optimized_path is None:
+            return onnxruntime.InferenceSession(self.model_path, options)
+        if os.path.exists(optimized_path):
+            # The cached graph is already optimized, skip optimizing it again
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+            try:
+                return onnxruntime.InferenceSession(optimized_path, options)
+            except Exception:
+                logger.warning(
+                    f"Failed to load optimized model {optimized_path}", exc_info=True
+                )
+                options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+                    self.graph_optimization_level
+                ]
+        # Write to a temporary file first, several processes may load the model at once
+        tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+        options.optimized_model_filepath = tmp_path
+        session = onnxruntime.InferenceSession(self.model_path, options)
+        try:
+            os.replace(tmp_path, optimized_path)
+        except OSError:
+            logger.debug(f"Failed to cache optimized model {optimized_path}")
+        return session
 
     @staticmethod
-    def from_pretrained():
+    def from_pretrained(quantized: bool = False):
         pth = get_doclayout_onnx_model_path()
+        if quantized:
+            pth = quantize_model(pth)
         return OnnxModel(pth)
 
     @property
@@ -156,23 +305,48 @@ class OnnxModel(DocLayoutModel):
         return boxes
 
     def predict(self, image, imgsz=1024, **kwargs):
-        # Preprocess input image
-        orig_h, orig_w = image.shape[:2]
-        pix = self.resize_and_pad_image(image, new_shape=imgsz)
-        pix = np.transpose(pix, (2, 0, 1))  # CHW
-        pix = np.expand_dims(pix, axis=0)  # BCHW
-        pix = pix.astype(np.float32) / 255.0  # Normalize to [0, 1]
-        new_h, new_w = pix.shape[2:]
-
-        # Run inference
-        preds = self.model.run(None, {"images": pix})[0]
-
-        # Postprocess predictions
-        preds = preds[preds[..., 4] > 0.25]
-        preds[..., :4] = self.scale_boxes(
-            (new_h, new_w), preds[..., :4], (orig_h, orig_w)
-        )
-        return [YoloResult(boxes=preds, names=self._names)]
+        return self.predict_batch([image], imgsz=imgsz, **kwargs)
+
+    def predict_batch(self, images, imgsz=1024, **kwargs):
+        if not isinstance(imgsz, list):
+            imgsz = [imgsz] * len(images)
+        # Preprocess input images
+        pixs = []
+        for image, size in zip(images, imgsz):
+            pix = self.resize_and_pad_image(image, new_shape=size)
+            pix = np.transpose(pix, (2, 0, 1))  # CHW
+            pix = pix.astype(np.float32) / 255.0  # Normalize to [0, 1]
+            pixs.append(pix)
+
+        # Pages of the same size are letterboxed to the same shape, run them in one batch
+        groups = {}
+        for i, pix in enumerate(pixs):
+            groups.setdefault(pix.shape, []).append(i)
+        results = [None] * len(images)
+        for (_, new_h, new_w), indices in groups.items():
+            preds = self.run_batch(np.stack([pixs[i] for i in indices]))  # BCHW
+            for i, pred in zip(indices, preds):
+                # Postprocess predictions
+                orig_h, orig_w = images[i].shape[:2]
+                pred = pred[pred[..., 4] > 0.25]
+                pred[..., :4] = self.scale_boxes(
+                    (new_h, new_w), pred[..., :4], (orig_h, orig_w)
+                )
+                results[i] = YoloResult(boxes=pred, names=self._names)
+        return results
+
+    def run_batch(self, pix):
+        # Models exported with a fixed batch size of 1 have to run image by image
+        batch = self.model.get_inputs()[0].shape[0]
+        if len(pix) > 1 and (self._batch_failed or isinstance(batch, int)):
+            return np.concatenate([self.run_batch(p[None]) for p in pix])
+        try:
+            return self.model.run(None, {"images": pix})[0]
+        except Exception:
+            if len(pix) == 1:
+                raise
+            self._batch_failed = True
+            return self.run_batch(pix)
 
 
 class ModelInstance:
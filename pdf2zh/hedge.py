@@ -0,0 +1,190 @@
+"""
+Hedged requests and per-request deadlines.
+
+A request that runs past the p95 latency of the recent requests gets a
+duplicate, and the first answer wins. Only about one request in twenty is
+duplicated, while a stalled call no longer holds up its page.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class LatencyTracker:
+    """Latencies of the last size successful requests."""
+
+    def __init__(self, size: int = 100, min_samples: int = 20):
+        self.samples = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self.lock:
+            self.samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """The q quantile of the latencies, None until min_samples are seen."""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+class HedgeSkipped(Exception):
+    """The hedge was not sent, the first call decides alone."""
+
+
+class DaemonExecutor(concurrent.futures.Executor):
+    """
+    A thread pool of at most max_workers daemon threads. A blocking request
+    can not be interrupted, so a call that lost the race keeps its thread
+    until the request ends, but it does not keep the process from exiting.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(max_workers, 1)
+        self.queue = queue.SimpleQueue()
+        self.threads = 0
+        self.idle = threading.Semaphore(0)
+        self.lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.queue.put((future, fn, args, kwargs))
+        # 有空闲线程时交给它执行，否则在上限内新建线程，达到上限时排队
+        if not self.idle.acquire(blocking=False):
+            with self.lock:
+                if self.threads < self.max_workers:
+                    self.threads += 1
+                    threading.Thread(target=self.work, daemon=True).start()
+        return future
+
+    def work(self):
+        while (item := self.queue.get()) is not None:
+            future, fn, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            self.idle.release()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        # 守护线程不等待，执行完当前调用后退出
+        if cancel_futures:
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        with self.lock:
+            for _ in range(self.threads):
+                self.queue.put(None)
+            self.threads = 0
+
+
+# 调用方没有提供线程池时共用
+default_executor = DaemonExecutor(32)
+
+
+def call_hedged(
+    fn: Callable,
+    hedge: Optional[Callable],
+    latency: LatencyTracker,
+    timeout: float = 0,
+    executor: Optional[concurrent.futures.Executor] = None,
+):
+    """
+    Call fn, and also hedge if fn runs past the p95 latency. Return the first
+    successful result, or raise TimeoutError once timeout seconds have passed.
+    An error is raised only when every started call has failed.
+
+    The calls run in executor, default_executor if it is None. A losing call
+    that has not started yet is cancelled. A blocking call can not be
+    interrupted, so one already sent runs until its HTTP request ends, which
+    the session bounds by REQUEST_TIMEOUT, and its answer is dropped.
+    """
+    executor = executor or default_executor
+    start = time.monotonic()
+    delay = latency.percentile(0.95) if hedge else None
+    futures = [executor.submit(fn)]
+    try:
+        while True:
+            now = time.monotonic()
+            waits = []
+            if delay is not None:
+                waits.append(start + delay - now)
+            if timeout:
+                waits.append(start + timeout - now)
+            done, _ = concurrent.futures.wait(
+                futures,
+                timeout=max(min(waits), 0) if waits else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future.exception() is None:
+                    latency.add(time.monotonic() - start)
+                    return future.result()
+            futures = [future for future in futures if future not in done]
+            if done and not futures:
+                raise done.pop().exception()
+            now = time.monotonic()
+            if timeout and now - start >= timeout:
+                raise TimeoutError(f"Request timed out after {timeout} seconds")
+            if delay is not None and now - start >= delay:
+                futures.append(executor.submit(hedge))
+                delay = None
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def acall_hedged(
+    fn: Callable[[], Awaitable],
+    hedge: Optional[Callable[[], Awaitable]],
+    latency: LatencyTracker,
+    timeout: float = 0,
+):
+    """
+    Asynchronous version of call_hedged. The request that loses is cancelled.
+    """
+    start = time.monotonic()
+    delay = latency.percentile(0.95) if hedge else None
+    tasks = [asyncio.ensure_future(fn())]
+    try:
+        while True:
+            now = time.monotonic()
+            waits = []
+            if delay is not None:
+                waits.append(start + delay - now)
+            if timeout:
+                waits.append(start + timeout - now)
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=max(min(waits), 0) if waits else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    latency.add(time.monotonic() - start)
+                    return task.result()
+            tasks = [task for task in tasks if task not in done]
+            if done and not tasks:
+                raise done.pop().exception()
+            now = time.monotonic()
+            if timeout and now - start >= timeout:
+                raise TimeoutError(f"Request timed out after {timeout} seconds")
+            if delay is not None and now - start >= delay:
+                tasks.append(asyncio.ensure_future(hedge()))
+                delay = None
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -1,11 +1,17 @@
 """Functions that can be used for the most common use-cases for pdf2zh.six"""
 
 import asyncio
+import collections
+import concurrent.futures
+import hashlib
 import io
+import multiprocessing
 import os
+import queue
 import re
 import sys
 import tempfile
+import threading
 import logging
 from asyncio import CancelledError
 from pathlib import Path
@@ -22,15 +28,23 @@ from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfparser import PDFParser
 from pymupdf import Document, Font
 
-from pdf2zh.converter import TranslateConverter
-from pdf2zh.doclayout import OnnxModel
-from pdf2zh.pdfinterp import PDFPageInterpreterEx
+from pdf2zh.cache import LayoutCache, init_db, memory_cache, write_buffer
+from pdf2zh.converter import PendingOps, TranslateConverter
+from pdf2zh.doclayout import OnnxModel, YoloResult
+from pdf2zh.pdfinterp import PDFPageInterpreterEx, TIRO_FONT
 
 from pdf2zh.config import ConfigManager
 from babeldoc.assets.assets import get_font_and_metadata
 
 NOTO_NAME = "noto"
 
+# 版面分析阶段最多提前处理的页数，限制预取页面占用的内存
+LAYOUT_PREFETCH = 4
+# 版面分析每次送入模型的页数，同样大小的页面合并成一个批次推理
+LAYOUT_BATCH = 4
+# 最多同时有多少页面在等待翻译，限制已解析页面占用的内存
+TRANSLATE_WINDOW = 16
+
 logger = logging.getLogger(__name__)
 
 noto_list = [
@@ -67,6 +81,237 @@ def check_files(files: List[str]) -> List[str]:
     return missing_files
 
 
+def model_identity(model: OnnxModel) -> str:
+    path = getattr(model, "model_path", "")
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+    return f"{type(model).__name__}:{path}"
+
+
+def page_hash(doc: Document, pageno: int, model_id: str, memo: Dict = None) -> str:
+    """
+    Digest of everything that affects the rendered page: the page geometry,
+    its content streams, the objects reachable from its (possibly inherited)
+    resources, the appearance of its annotations and the layout model. Link
+    destinations and actions are left out, so editing another page does not
+    change the digest.
+
+    memo caches the digests of shared objects (fonts, images) between pages.
+    """
+    memo = {} if memo is None else memo
+    page = doc[pageno]
+    h = hashlib.blake2b(digest_size=32)
+    h.update(f"{model_id}|{page.rect}|{page.cropbox}|{page.rotation}".encode())
+    todo = []
+
+    def add_key(xref: int, key: str):
+        kind, value = doc.xref_get_key(xref, key)
+        h.update(f"|{key}:{kind}:{value}".encode())
+        todo.extend(int(i) for i in re.findall(r"(\d+)\s+\d+\s+R", value))
+
+    add_key(page.xref, "Contents")
+    # 继承的资源
+    xref = page.xref
+    while doc.xref_get_key(xref, "Resources")[0] == "null":
+        parent = doc.xref_get_key(xref, "Parent")
+        if parent[0] != "xref":
+            break
+        xref = int(parent[1].split()[0])
+    add_key(xref, "Resources")
+    # 注释只取位置和外观，不沿链接的目标页面和动作展开
+    kind, annots = doc.xref_get_key(page.xref, "Annots")
+    if kind == "xref":
+        annots = doc.xref_object(int(annots.split()[0]))
+    for annot in re.findall(r"(\d+)\s+\d+\s+R", annots if kind != "null" else ""):
+        for key in ["Rect", "F", "AP"]:
+            add_key(int(annot), key)
+    seen = set()
+    while todo:
+        xref = todo.pop()
+        if xref in seen:
+            continue
+        seen.add(xref)
+        if xref not in memo:
+            # 不沿 Parent 和 P 回溯，否则会哈希到整个页面树
+            obj = re.sub(r"/(?:Parent|P)\s+\d+\s+\d+\s+R", "", doc.xref_object(xref))
+            digest = hashlib.blake2b(obj.encode(), digest_size=32)
+            if doc.xref_is_stream(xref):
+                digest.update(doc.xref_stream_raw(xref) or b"")
+            refs = [int(i) for i in re.findall(r"(\d+)\s+\d+\s+R", obj)]
+            memo[xref] = (digest.digest(), refs)
+        digest, refs = memo[xref]
+        h.update(digest)
+        todo.extend(refs)
+    return h.hexdigest()
+
+
+def detect_layouts(
+    doc_zh: Document,
+    pagenos: list[int],
+    model: OnnxModel,
+    doc_lock: threading.Lock,
+) -> list[dict]:
+    images = []
+    for pageno in pagenos:
+        with doc_lock:  # pymupdf 文档不是线程安全的
+            pix = doc_zh[pageno].get_pixmap()
+        image = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, 3)[
+            :, :, ::-1
+        ]
+        images.append(image)
+    page_layouts = model.predict_batch(
+        images, imgsz=[int(image.shape[0] / 32) * 32 for image in images]
+    )
+    return [
+        {
+            "height": image.shape[0],
+            "width": image.shape[1],
+            "boxes": [
+                [float(v) for v in (*d.xyxy, d.conf, d.cls)] for d in page_layout.boxes
+            ],
+            "names": {int(k): v for k, v in page_layout.names.items()},
+        }
+        for image, page_layout in zip(images, page_layouts)
+    ]
+
+
+def rasterize_layout(page_layout: dict) -> np.ndarray:
+    names = {int(k): v for k, v in page_layout["names"].items()}
+    boxes = YoloResult(np.array(page_layout["boxes"]), names).boxes
+    # kdtree 是不可能 kdtree 的，不如直接渲染成图片，用空间换时间
+    # 类别编号为 0、1 和 i + 2，按框的数量选择最小的整数类型
+    dtype = np.uint8 if len(boxes) + 1 <= 0xFF else np.uint16
+    box = np.ones((page_layout["height"], page_layout["width"]), dtype=dtype)
+    h, w = box.shape
+    vcls = ["abandon", "figure", "table", "isolate_formula", "formula_caption"]
+    for i, d in enumerate(boxes):
+        if names[int(d.cls)] not in vcls:
+            x0, y0, x1, y1 = d.xyxy.squeeze()
+            x0, y0, x1, y1 = (
+                np.clip(int(x0 - 1), 0, w - 1),
+                np.clip(int(h - y1 - 1), 0, h - 1),
+                np.clip(int(x1 + 1), 0, w - 1),
+                np.clip(int(h - y0 + 1), 0, h - 1),
+            )
+            box[y0:y1, x0:x1] = i + 2
+    for i, d in enumerate(boxes):
+        if names[int(d.cls)] in vcls:
+            x0, y0, x1, y1 = d.xyxy.squeeze()
+            x0, y0, x1, y1 = (
+                np.clip(int(x0 - 1), 0, w - 1),
+                np.clip(int(h - y1 - 1), 0, h - 1),
+                np.clip(int(x1 + 1), 0, w - 1),
+                np.clip(int(h - y0 + 1), 0, h - 1),
+            )
+            box[y0:y1, x0:x1] = 0
+    return box
+
+
+def render_layouts(
+    doc_zh: Document,
+    pagenos: list[int],
+    model: OnnxModel,
+    doc_lock: threading.Lock,
+    keys: list[str],
+    ignore_cache: bool = False,
+) -> list[np.ndarray]:
+    page_layouts = [
+        LayoutCache.get(key) if key and not ignore_cache else None for key in keys
+    ]
+    missing = [i for i, page_layout in enumerate(page_layouts) if page_layout is None]
+    if missing:
+        detected = detect_layouts(
+            doc_zh, [pagenos[i] for i in missing], model, doc_lock
+        )
+        for i, page_layout in zip(missing, detected):
+            page_layouts[i] = page_layout
+            if keys[i]:
+                LayoutCache.set(keys[i], page_layout)
+    return [rasterize_layout(page_layout) for page_layout in page_layouts]
+
+
+def iter_layouts(
+    doc_zh: Document,
+    pagenos: list[int],
+    model: OnnxModel,
+    doc_lock: threading.Lock,
+    prefetch: int = LAYOUT_PREFETCH,
+    batch: int = LAYOUT_BATCH,
+    doc_en: Document = None,
+    ignore_cache: bool = False,
+):
+    """
+    Yield (pageno, layout) in order, while a background thread renders and
+    detects the layout of the upcoming pages.
+
+    onnxruntime releases the GIL during inference, so the layout of the next
+    pages is computed while the current page is parsed and translated. Pages
+    are detected in batches of up to `batch` pages.
+
+    Layouts are cached by the hash of the unmodified page in doc_en (doc_zh
+    if not given), so re-translating a document skips rendering and inference.
+    """
+    layouts = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                layouts.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # 后台线程启动前计算所有页面的缓存键，不必在渲染期间持有 doc_lock
+    model_id, memo = model_identity(model), {}
+    doc = doc_zh if doc_en is None else doc_en
+    keys = {pageno: page_hash(doc, pageno, model_id, memo) for pageno in pagenos}
+
+    def producer():
+        try:
+            for i in range(0, len(pagenos), batch):
+                batch_pagenos = pagenos[i : i + batch]
+                page_layouts = render_layouts(
+                    doc_zh,
+                    batch_pagenos,
+                    model,
+                    doc_lock,
+                    [keys[pageno] for pageno in batch_pagenos],
+                    ignore_cache,
+                )
+                for pageno, page_layout in zip(batch_pagenos, page_layouts):
+                    if not put((pageno, page_layout)):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = layouts.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def new_page_xref(doc_zh: Document, pageno: int) -> int:
+    # 新建一个 xref 存放新指令流
+    page_xref = doc_zh.get_new_xref()  # hack 插入页面的新 xref
+    doc_zh.update_object(page_xref, "<<>>")
+    doc_zh.update_stream(page_xref, b"")
+    doc_zh[pageno].set_contents(page_xref)
+    return page_xref
+
+
 def translate_patch(
     inf: BinaryIO,
     pages: Optional[list[int]] = None,
@@ -85,6 +330,10 @@ def translate_patch(
     envs: Dict = None,
     prompt: Template = None,
     ignore_cache: bool = False,
+    page_xrefs: Dict[int, int] = None,
+    fonts: Dict = None,
+    doc_en: Document = None,
+    adaptive: bool = False,
     **kwarg: Any,
 ) -> None:
     rsrcmgr = PDFResourceManager()
@@ -103,11 +352,12 @@ def translate_patch(
         envs,
         prompt,
         ignore_cache,
+        adaptive,
     )
 
     assert device is not None
     obj_patch = {}
-    interpreter = PDFPageInterpreterEx(rsrcmgr, device, obj_patch)
+    interpreter = PDFPageInterpreterEx(rsrcmgr, device, obj_patch, fonts)
     if pages:
         total_pages = len(pages)
     else:
@@ -115,55 +365,191 @@ def translate_patch(
 
     parser = PDFParser(inf)
     doc = PDFDocument(parser)
-    with tqdm.tqdm(total=total_pages) as progress:
-        for pageno, page in enumerate(PDFPage.create_pages(doc)):
+    doc_lock = threading.Lock()
+    # 流水线：后台线程渲染并分析后续页面的版面，主线程解析页面，段落在文档级线程池中翻译后排版
+    layouts = iter_layouts(
+        doc_zh,
+        [i for i in range(doc_zh.page_count) if not pages or i in pages],
+        model,
+        doc_lock,
+        doc_en=doc_en,
+        ignore_cache=ignore_cache,
+    )
+    pending = collections.deque()  # 等待翻译和排版的页面的 xref
+
+    def wait_ops(ops):
+        if not isinstance(ops, PendingOps):
+            return ops
+        while not ops.done():
             if cancellation_event and cancellation_event.is_set():
                 raise CancelledError("task cancelled")
-            if pages and (pageno not in pages):
-                continue
-            progress.update()
-            if callback:
-                callback(progress)
-            page.pageno = pageno
-            pix = doc_zh[page.pageno].get_pixmap()
-            image = np.frombuffer(pix.samples, np.uint8).reshape(
-                pix.height, pix.width, 3
-            )[:, :, ::-1]
-            page_layout = model.predict(image, imgsz=int(pix.height / 32) * 32)[0]
-            # kdtree 是不可能 kdtree 的，不如直接渲染成图片，用空间换时间
-            box = np.ones((pix.height, pix.width))
-            h, w = box.shape
-            vcls = ["abandon", "figure", "table", "isolate_formula", "formula_caption"]
-            for i, d in enumerate(page_layout.boxes):
-                if page_layout.names[int(d.cls)] not in vcls:
-                    x0, y0, x1, y1 = d.xyxy.squeeze()
-                    x0, y0, x1, y1 = (
-                        np.clip(int(x0 - 1), 0, w - 1),
-                        np.clip(int(h - y1 - 1), 0, h - 1),
-                        np.clip(int(x1 + 1), 0, w - 1),
-                        np.clip(int(h - y0 + 1), 0, h - 1),
-                    )
-                    box[y0:y1, x0:x1] = i + 2
-            for i, d in enumerate(page_layout.boxes):
-                if page_layout.names[int(d.cls)] in vcls:
-                    x0, y0, x1, y1 = d.xyxy.squeeze()
-                    x0, y0, x1, y1 = (
-                        np.clip(int(x0 - 1), 0, w - 1),
-                        np.clip(int(h - y1 - 1), 0, h - 1),
-                        np.clip(int(x1 + 1), 0, w - 1),
-                        np.clip(int(h - y0 + 1), 0, h - 1),
-                    )
-                    box[y0:y1, x0:x1] = 0
-            layout[page.pageno] = box
-            # 新建一个 xref 存放新指令流
-            page.page_xref = doc_zh.get_new_xref()  # hack 插入页面的新 xref
-            doc_zh.update_object(page.page_xref, "<<>>")
-            doc_zh.update_stream(page.page_xref, b"")
-            doc_zh[page.pageno].set_contents(page.page_xref)
-            interpreter.process_page(page)
-
-    device.close()
-    return obj_patch
+            concurrent.futures.wait(ops.futures, timeout=0.1)
+        # 排版在主线程进行，和版面分析线程一样持有 doc_lock 使用 PyMuPDF
+        with doc_lock:
+            return ops.result()
+
+    def wait_page(progress):
+        page_xref = pending.popleft()
+        # 排版结果写回 obj_patch，最后只处理仍未排版的表单
+        obj_patch[page_xref] = wait_ops(obj_patch[page_xref])
+        if concurrency := device.translator.concurrency:
+            progress.set_postfix(
+                limit=int(concurrency.limit),
+                latency=f"{concurrency.latency:.2f}s",
+                refresh=False,
+            )
+        progress.update()
+        if callback:
+            callback(progress)
+
+    try:
+        # 多进程模式下进度由主进程汇总，子进程不显示进度条
+        with tqdm.tqdm(total=total_pages, disable=bool(page_xrefs)) as progress:
+            for pageno, page in enumerate(PDFPage.create_pages(doc)):
+                if cancellation_event and cancellation_event.is_set():
+                    raise CancelledError("task cancelled")
+                if pages and (pageno not in pages):
+                    continue
+                page.pageno = pageno
+                _, layout[page.pageno] = next(layouts)
+                if page_xrefs:  # 多进程模式下由主进程预先分配
+                    page.page_xref = page_xrefs[page.pageno]
+                else:
+                    with doc_lock:
+                        page.page_xref = new_page_xref(doc_zh, page.pageno)
+                interpreter.process_page(page)
+                del layout[page.pageno]  # 页面解析完成后不再需要版面
+                pending.append(page.page_xref)
+                if len(pending) > TRANSLATE_WINDOW:
+                    wait_page(progress)
+            while pending:
+                wait_page(progress)
+        obj_patch = {obj_id: wait_ops(ops) for obj_id, ops in obj_patch.items()}
+        return {obj_id: ops for obj_id, ops in obj_patch.items() if ops is not None}
+    finally:
+        layouts.close()
+        device.close()
+        write_buffer.flush()  # 每个文档结束时写入新的译文
+        logger.debug(f"Translation cache in memory: {memory_cache.stats()}")
+
+
+_worker: Dict = {}
+
+
+def _init_worker(
+    stream: bytes, font_path: str, model: OnnxModel, kwarg: Dict, config_path: str
+):
+    # spawn 的子进程从默认路径读取配置，改用主进程的配置文件并按它重新初始化缓存
+    if Path(config_path) != ConfigManager.path():
+        ConfigManager.custome_config(config_path)
+        init_db()
+    _worker.update(
+        stream=stream,
+        doc_zh=Document(stream=stream),
+        noto=Font(kwarg["noto_name"], font_path),
+        model=model,
+        kwarg=kwarg,
+    )
+
+
+def _translate_pages(page_xrefs: Dict[int, int]) -> dict:
+    return translate_patch(
+        io.BytesIO(_worker["stream"]),
+        pages=list(page_xrefs),
+        doc_zh=_worker["doc_zh"],
+        noto=_worker["noto"],
+        model=_worker["model"],
+        page_xrefs=page_xrefs,
+        **_worker["kwarg"],
+    )
+
+
+def translate_patch_processes(
+    inf: BinaryIO,
+    pages: Optional[list[int]] = None,
+    vfont: str = "",
+    vchar: str = "",
+    thread: int = 0,
+    doc_zh: Document = None,
+    lang_in: str = "",
+    lang_out: str = "",
+    service: str = "",
+    noto_name: str = "",
+    font_path: str = "",
+    callback: object = None,
+    cancellation_event: asyncio.Event = None,
+    model: OnnxModel = None,
+    envs: Dict = None,
+    prompt: Template = None,
+    ignore_cache: bool = False,
+    processes: int = 1,
+    fonts: Dict = None,
+    adaptive: bool = False,
+    **kwarg: Any,
+) -> dict:
+    """
+    Same as translate_patch, but shard the pages across worker processes.
+
+    Each worker parses, translates and typesets a contiguous chunk of pages
+    with its own interpreter and converter, and returns its obj_patch. The
+    xrefs of the new page streams are allocated here beforehand, so that the
+    fragments can be merged into doc_zh directly.
+    """
+    pagenos = [i for i in range(doc_zh.page_count) if not pages or i in pages]
+    page_xrefs = {pageno: new_page_xref(doc_zh, pageno) for pageno in pagenos}
+    # 每个进程分到多个小块，平衡各页面耗时的差异
+    size = max(-(-len(pagenos) // (processes * 4)), 1)
+    chunks = [pagenos[i : i + size] for i in range(0, len(pagenos), size)]
+    worker_kwarg = {
+        "vfont": vfont,
+        "vchar": vchar,
+        "thread": thread,
+        "lang_in": lang_in,
+        "lang_out": lang_out,
+        "service": service,
+        "noto_name": noto_name,
+        "envs": envs,
+        "prompt": prompt,
+        "ignore_cache": ignore_cache,
+        "fonts": fonts,
+        "adaptive": adaptive,
+    }
+    # 使用 spawn 避免在持有锁的线程存在时 fork
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(processes, len(chunks)) or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(
+            inf.getvalue(),
+            font_path,
+            model,
+            worker_kwarg,
+            str(ConfigManager.path()),
+        ),
+    )
+    obj_patch = {}
+    try:
+        futures = [
+            executor.submit(_translate_pages, {i: page_xrefs[i] for i in chunk})
+            for chunk in chunks
+        ]
+        with tqdm.tqdm(total=len(pagenos)) as progress:
+            # 按页面顺序合并，与单进程时共享 xobj 的覆盖顺序一致
+            for chunk, future in zip(chunks, futures):
+                while True:
+                    if cancellation_event and cancellation_event.is_set():
+                        raise CancelledError("task cancelled")
+                    try:
+                        obj_patch.update(future.result(timeout=0.1))
+                        break
+                    except concurrent.futures.TimeoutError:
+                        pass
+                progress.update(len(chunk))
+                if callback:
+                    callback(progress)
+        return obj_patch
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def translate_stream(
@@ -182,6 +568,8 @@ def translate_stream(
     prompt: Template = None,
     skip_subset_fonts: bool = False,
     ignore_cache: bool = False,
+    processes: int = 1,
+    adaptive: bool = False,
     **kwarg: Any,
 ):
     font_list = [("tiro", None)]
@@ -191,9 +579,8 @@ def translate_stream(
     noto = Font(noto_name, font_path)
     font_list.append((noto_name, font_path))
 
+    # 两个文档共享同一份输入数据，不再保存后重新打开
     doc_en = Document(stream=stream)
-    stream = io.BytesIO()
-    doc_en.save(stream)
     doc_zh = Document(stream=stream)
     page_count = doc_zh.page_count
     # font_list = [("GoNotoKurrent-Regular.ttf", font_path), ("tiro", None)]
@@ -226,10 +613,19 @@ def translate_stream(
             except Exception:
                 pass
 
-    fp = io.BytesIO()
-
-    doc_zh.save(fp)
-    obj_patch: dict = translate_patch(fp, **locals())
+    if doc_zh.is_repaired:
+        # 修复后的 xref 与原文件不一致，只能让 pdfminer 解析保存后的文件
+        fp = io.BytesIO()
+        doc_zh.save(fp)
+        fonts = None
+    else:
+        # xref 与原文件一致，pdfminer 直接解析原文件，由解释器补上插入的字体
+        fp = io.BytesIO(stream)
+        fonts = {"tiro": TIRO_FONT}
+    if processes > 1:
+        obj_patch: dict = translate_patch_processes(fp, **locals())
+    else:
+        obj_patch: dict = translate_patch(fp, **locals())
 
     for obj_id, ops_new in obj_patch.items():
         # ops_old=doc_en.xref_stream(obj_id)
@@ -317,6 +713,8 @@ def translate(
     prompt: Template = None,
     skip_subset_fonts: bool = False,
     ignore_cache: bool = False,
+    processes: int = 1,
+    adaptive: bool = False,
     **kwarg: Any,
 ):
     if not files:
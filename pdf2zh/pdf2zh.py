@@ -8,12 +8,13 @@ from __future__ import annotations
 import argparse
 import logging
 import sys
+import time
 from string import Template
 from typing import List, Optional
 
 from pdf2zh import __version__, log
 from pdf2zh.high_level import translate, download_remote_fonts
-from pdf2zh.doclayout import OnnxModel, ModelInstance
+from pdf2zh.doclayout import OnnxModel, ModelInstance, quantize_model
 import os
 
 from pdf2zh.config import ConfigManager
@@ -90,7 +91,7 @@ def create_parser() -> argparse.ArgumentParser:
         "-s",
         type=str,
         default="google",
-        help="The service to use for translation.",
+        help='The service to use for translation, or services to fall back on in order, e.g. "deepl>openai>google".',
     )
     parse_params.add_argument(
         "--output",
@@ -106,6 +107,17 @@ def create_parser() -> argparse.ArgumentParser:
         default=4,
         help="The number of threads to execute translation.",
     )
+    parse_params.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adjust the number of concurrent requests up to --thread to what the service sustains.",
+    )
+    parse_params.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="The number of processes to parse and typeset pages in parallel.",
+    )
     parse_params.add_argument(
         "--interactive",
         "-i",
@@ -151,6 +163,11 @@ def create_parser() -> argparse.ArgumentParser:
         type=str,
         help="custom onnx model path.",
     )
+    parse_params.add_argument(
+        "--onnx-quantized",
+        action="store_true",
+        help="Use the layout model with weights dynamically quantized to INT8.",
+    )
 
     parse_params.add_argument(
         "--serverport",
@@ -219,6 +236,76 @@ def parse_args(args: Optional[List[str]]) -> argparse.Namespace:
     return parsed_args
 
 
+def cache_main(args: List[str]) -> int:
+    """pdf2zh cache stats|prune|compact"""
+    from pdf2zh import cache
+
+    # 先读取配置文件，子命令的默认值和缓存后端都来自配置
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument(
+        "--config", type=str, help="config file path of the translation cache."
+    )
+    config_args, _ = config_parser.parse_known_args(args)
+    if config_args.config:
+        ConfigManager.custome_config(config_args.config)
+        cache.init_db()
+
+    parser = argparse.ArgumentParser(
+        prog="pdf2zh cache",
+        description="Manage the translation cache.",
+        parents=[config_parser],
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="Show the size and contents of the cache.")
+    prune = commands.add_parser(
+        "prune", help="Delete expired and least recently used translations and layouts."
+    )
+    prune.add_argument(
+        "--ttl-days",
+        type=float,
+        default=float(ConfigManager.get("CACHE_TTL_DAYS", 0)),
+        help="Delete translations unused for this many days.",
+    )
+    prune.add_argument(
+        "--max-size-mb",
+        type=float,
+        default=float(ConfigManager.get("CACHE_MAX_SIZE_MB", 0)),
+        help="Delete the least recently used translations above this size.",
+    )
+    commands.add_parser("compact", help="Shrink the cache file.")
+    parsed_args = parser.parse_args(args)
+
+    cache.write_buffer.flush()
+    if parsed_args.command == "prune":
+        deleted = cache.backend.prune(
+            parsed_args.ttl_days * 86400,
+            int(parsed_args.max_size_mb * (1 << 20)),
+        )
+        cache.backend.vacuum()
+        print(f"Deleted {deleted} entries")
+    elif parsed_args.command == "compact":
+        size = cache.backend.stats()["size"]
+        cache.backend.compact()
+        print(
+            f"Compacted {megabytes(size)} to {megabytes(cache.backend.stats()['size'])}"
+        )
+    stats = cache.backend.stats()
+    print(f"Path: {stats['path']}")
+    print(f"Entries: {stats['entries']}")
+    print(f"Size: {megabytes(stats['size'])} ({megabytes(stats['free'])} free)")
+    for name in ["oldest", "newest"]:
+        if stats[name]:
+            accessed = time.strftime("%Y-%m-%d %H:%M", time.localtime(stats[name]))
+            print(f"{name.capitalize()} access: {accessed}")
+    for engine, count in sorted(stats["engines"].items()):
+        print(f"  {engine}: {count}")
+    return 0
+
+
+def megabytes(size: int) -> str:
+    return f"{size / (1 << 20):.1f} MB"
+
+
 def find_all_files_in_directory(directory_path):
     """
     Recursively search all PDF files in the given directory and return their paths as a list.
@@ -258,18 +345,35 @@ def main(args: Optional[List[str]] = None) -> int:
     logging.getLogger("http11").setLevel("CRITICAL")
     logging.getLogger("http11").propagate = False
 
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["cache"]:
+        return cache_main(args[1:])
+
     parsed_args = parse_args(args)
 
     if parsed_args.config:
+        from pdf2zh import cache
+
         ConfigManager.custome_config(parsed_args.config)
+        cache.init_db()
 
     if parsed_args.debug:
         log.setLevel(logging.DEBUG)
 
     if parsed_args.onnx:
-        ModelInstance.value = OnnxModel(parsed_args.onnx)
+        if parsed_args.onnx_quantized:
+            ModelInstance.value = OnnxModel(quantize_model(parsed_args.onnx))
+        else:
+            ModelInstance.value = OnnxModel(parsed_args.onnx)
     else:
-        ModelInstance.value = OnnxModel.load_available()
+        ModelInstance.value = OnnxModel.load_available(parsed_args.onnx_quantized)
+
+    if parsed_args.interactive or parsed_args.flask or parsed_args.celery:
+        from pdf2zh import cache
+
+        # 只有常驻进程在后台清理缓存
+        cache.start_maintenance()
 
     if parsed_args.interactive:
         from pdf2zh.gui import setup_gui
@@ -304,8 +408,11 @@ def main(args: Optional[List[str]] = None) -> int:
 
     if parsed_args.mcp:
         logging.getLogger("mcp").setLevel(logging.ERROR)
+        from pdf2zh import cache
         from pdf2zh.mcp_server import create_mcp_app, create_starlette_app
 
+        cache.start_maintenance()
+
         mcp = create_mcp_app()
         if parsed_args.sse:
             import uvicorn
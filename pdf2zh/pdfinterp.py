@@ -26,6 +26,7 @@ from pdfminer.pdftypes import (
 )
 from pdfminer.psexceptions import PSEOF
 from pdfminer.psparser import (
+    LIT,
     PSKeyword,
     keyword_name,
     literal_name,
@@ -38,8 +39,18 @@ from pdfminer.utils import (
     apply_matrix_pt,
 )
 
+from pdf2zh.converter import PendingOps
+
 log = logging.getLogger(__name__)
 
+# pymupdf insert_font("tiro") 插入的字体，直接解析原文件时由解释器补上
+TIRO_FONT = {
+    "Type": LIT("Font"),
+    "Subtype": LIT("Type1"),
+    "BaseFont": LIT("Times-Roman"),
+    "Encoding": LIT("WinAnsiEncoding"),
+}
+
 
 def safe_float(o: Any) -> Optional[float]:
     try:
@@ -48,6 +59,11 @@ def safe_float(o: Any) -> Optional[float]:
         return None
 
 
+def concat_ops(ops_new: PendingOps, fmt) -> PendingOps:
+    # 排版在段落翻译完成后才进行，这里等排版完成后再拼接指令流
+    return ops_new.then(fmt)
+
+
 class PDFPageInterpreterEx(PDFPageInterpreter):
     """Processor for the content of a PDF page
 
@@ -55,14 +71,33 @@ class PDFPageInterpreterEx(PDFPageInterpreter):
     """
 
     def __init__(
-        self, rsrcmgr: PDFResourceManager, device: PDFDevice, obj_patch
+        self,
+        rsrcmgr: PDFResourceManager,
+        device: PDFDevice,
+        obj_patch,
+        fonts: Optional[Dict[str, dict]] = None,
     ) -> None:
         self.rsrcmgr = rsrcmgr
         self.device = device
         self.obj_patch = obj_patch
+        self.fonts = fonts
 
     def dup(self) -> "PDFPageInterpreterEx":
-        return self.__class__(self.rsrcmgr, self.device, self.obj_patch)
+        return self.__class__(self.rsrcmgr, self.device, self.obj_patch, self.fonts)
+
+    def inject_fonts(
+        self, resources: Dict[object, object], force: bool = False
+    ) -> Dict[object, object]:
+        """
+        Add the fonts inserted by pymupdf to the resources, the same way
+        translate_stream does: pages always get them, xobjects only if they
+        have their own Font dictionary. Existing fonts take precedence.
+        """
+        if not self.fonts or not (force or "Font" in resources):
+            return resources
+        resources = dict(resources)
+        resources["Font"] = {**self.fonts, **dict_value(resources.get("Font", {}))}
+        return resources
 
     def init_resources(self, resources: Dict[object, object]) -> None:
         # 重载设置 fontid 和 descent
@@ -214,7 +249,7 @@ class PDFPageInterpreterEx(PDFPageInterpreter):
             # instead of having their own Resources entry.
             xobjres = xobj.get("Resources")
             if xobjres:
-                resources = dict_value(xobjres)
+                resources = self.inject_fonts(dict_value(xobjres))
             else:
                 resources = self.resources.copy()
             self.device.begin_figure(xobjid, bbox, matrix)
@@ -238,9 +273,11 @@ class PDFPageInterpreterEx(PDFPageInterpreter):
                     pos_inv = -np.mat(ctm[4:]) * ctm_inv
                 a, b, c, d = ctm_inv.reshape(4).tolist()
                 e, f = pos_inv.tolist()[0]
-                self.obj_patch[self.xobjmap[xobjid].objid] = (
-                    f"q {ops_base}Q {a} {b} {c} {d} {e} {f} cm {ops_new}"
-                )
+                # 排版失败时不修改这个 form，保留原来的指令流
+                self.obj_patch[self.xobjmap[xobjid].objid] = concat_ops(
+                    ops_new,
+                    lambda ops: f"q {ops_base}Q {a} {b} {c} {d} {e} {f} cm {ops}",
+                ).catch(None)
             except Exception:
                 pass
         elif subtype is LITERAL_IMAGE and "Width" in xobj and "Height" in xobj:
@@ -266,13 +303,15 @@ class PDFPageInterpreterEx(PDFPageInterpreter):
         else:
             ctm = (1, 0, 0, 1, -x0, -y0)
         self.device.begin_page(page, ctm)
-        ops_base = self.render_contents(page.resources, page.contents, ctm=ctm)
+        resources = self.inject_fonts(dict_value(page.resources or {}), force=True)
+        ops_base = self.render_contents(resources, page.contents, ctm=ctm)
         self.device.fontid = self.fontid
         self.device.fontmap = self.fontmap
         ops_new = self.device.end_page(page)
         # 上面渲染的时候会根据 cropbox 减掉页面偏移得到真实坐标，这里输出的时候需要用 cm 把页面偏移加回来
-        self.obj_patch[page.page_xref] = (
-            f"q {ops_base}Q 1 0 0 1 {x0} {y0} cm {ops_new}"  # ops_base 里可能有图，需要让 ops_new 里的文字覆盖在上面，使用 q/Q 重置位置矩阵
+        self.obj_patch[page.page_xref] = concat_ops(
+            ops_new,
+            lambda ops: f"q {ops_base}Q 1 0 0 1 {x0} {y0} cm {ops}",  # ops_base 里可能有图，需要让 ops_new 里的文字覆盖在上面，使用 q/Q 重置位置矩阵
         )
         for obj in page.contents:
             self.obj_patch[obj.objid] = ""
@@ -0,0 +1,317 @@
+"""
+Rate and concurrency limits of translation services.
+
+Limits are configured per translator name with the RATE_LIMITS config key,
+e.g. {"openai": {"rps": 5, "tpm": 200000, "shared": true}}. rps is requests
+per second and tpm estimated tokens per minute. Every thread of a process
+draws from the same buckets; with shared the buckets are kept in a SQLite file,
+so every process on the host draws from them too.
+
+AdaptiveConcurrency adjusts the number of in-flight requests of a translator
+to what the service sustains.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from peewee import CharField, FloatField, Model, SqliteDatabase
+
+from pdf2zh.config import ConfigManager
+
+logger = logging.getLogger(__name__)
+
+shared_db = SqliteDatabase(None)
+
+
+class _Bucket(Model):
+    key = CharField(primary_key=True)
+    tokens = FloatField()
+    updated = FloatField()
+
+    class Meta:
+        database = shared_db
+
+
+class TokenBucket:
+    """
+    A bucket refilled with rate tokens per second up to capacity. A taker may
+    drive it below zero and then waits until its share is refilled, so takers
+    are served in order and the rate never overshoots.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take amount tokens, return the seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket kept in the shared SQLite database under key, so that the
+    processes using the same key share the rate.
+    """
+
+    def __init__(self, key: str, rate: float, capacity: Optional[float] = None):
+        super().__init__(rate, capacity)
+        self.key = key
+
+    def reserve(self, amount: float = 1) -> float:
+        # 写事务加锁，多个进程依次更新同一个桶
+        with shared_db.atomic("IMMEDIATE"):
+            now = time.time()
+            bucket = _Bucket.get_or_none(_Bucket.key == self.key)
+            tokens = self.capacity
+            if bucket is not None:
+                tokens = min(
+                    self.capacity, bucket.tokens + (now - bucket.updated) * self.rate
+                )
+            tokens -= amount
+            _Bucket.replace(key=self.key, tokens=tokens, updated=now).execute()
+        return max(-tokens / self.rate, 0)
+
+
+class RateLimiter:
+    """
+    Requests per second and tokens per minute limits of a translation service.
+    """
+
+    def __init__(self, name: str, rps: float = 0, tpm: float = 0, shared=False):
+        self.requests: Optional[TokenBucket] = None
+        self.tokens: Optional[TokenBucket] = None
+        self.shared = shared
+        if shared:
+            init_shared_db()
+        if rps:
+            self.requests = (
+                SharedTokenBucket(f"{name}:rps", rps) if shared else TokenBucket(rps)
+            )
+        if tpm:
+            # 每秒补充 tpm / 60 个 token，最多积累一秒
+            self.tokens = (
+                SharedTokenBucket(f"{name}:tpm", tpm / 60)
+                if shared
+                else TokenBucket(tpm / 60)
+            )
+
+    def reserve(self, tokens: int = 0) -> float:
+        delay = 0
+        if self.requests:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens and tokens:
+            delay = max(delay, self.tokens.reserve(tokens))
+        return delay
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until a request of tokens estimated tokens may be sent."""
+        if delay := self.reserve(tokens):
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """Asynchronous version of acquire."""
+        # 共享的令牌桶要写数据库，在线程中预留，不阻塞事件循环
+        if self.shared:
+            delay = await asyncio.to_thread(self.reserve, tokens)
+        else:
+            delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    """The HTTP status of the error, None when it does not come from a response."""
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_overload(e: BaseException) -> bool:
+    """Whether the error means the service is overloaded: 429, 5xx or timeout."""
+    if (status := status_code(e)) is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, TimeoutError) or "timeout" in type(e).__name__.lower()
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of in-flight requests adjusted like TCP congestion control. The
+    limit starts at one and grows by one per successful request until the
+    first overload (slow start), then by one per round trip (additive
+    increase), and halves on 429, 5xx or timeouts (multiplicative decrease).
+    It does not grow while latency exceeds tolerance times the fastest
+    request seen.
+    """
+
+    def __init__(self, max_limit: int, tolerance: float = 3):
+        self.max_limit = max(max_limit, 1)
+        self.tolerance = tolerance
+        self.limit = 1.0
+        self.inflight = 0
+        self.latency = 0.0  # 平均延迟
+        self.min_latency = float("inf")
+        self.slow_start = True
+        self.last_decrease = float("-inf")
+        self.cond = threading.Condition()
+        self.waiters = collections.deque()  # 等待中的协程
+
+    def acquire(self) -> float:
+        with self.cond:
+            self.cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+        return time.monotonic()
+
+    def try_acquire(self) -> Optional[float]:
+        """Take a slot without waiting, None when the limit is reached."""
+        with self.cond:
+            if self.inflight >= int(self.limit):
+                return None
+            self.inflight += 1
+        return time.monotonic()
+
+    async def aacquire(self) -> float:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                if self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return time.monotonic()
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, start: float, error: Optional[BaseException] = None) -> None:
+        now = time.monotonic()
+        latency = now - start
+        with self.cond:
+            self.inflight -= 1
+            if error is None:
+                self.latency = (
+                    latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+                )
+                self.min_latency = min(self.min_latency, latency)
+                if latency <= self.tolerance * self.min_latency:
+                    self.limit += 1 if self.slow_start else 1 / self.limit
+                    self.limit = min(self.limit, self.max_limit)
+            elif is_overload(error) and start > self.last_decrease:
+                # 减半之前发出的请求随后失败时不再重复减半
+                self.limit = max(self.limit / 2, 1)
+                self.slow_start = False
+                self.last_decrease = now
+            self.cond.notify_all()
+            while self.waiters:
+                loop, waiter = self.waiters.popleft()
+                loop.call_soon_threadsafe(
+                    lambda waiter=waiter: waiter.done() or waiter.set_result(None)
+                )
+
+    @contextlib.contextmanager
+    def request(self):
+        start = self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            self.release(start, e)
+            raise
+        self.release(start)
+
+    @contextlib.asynccontextmanager
+    async def arequest(self):
+        start = await self.aacquire()
+        try:
+            yield
+        except BaseException as e:
+            self.release(start, e)
+            raise
+        self.release(start)
+
+    @contextlib.contextmanager
+    def try_request(self):
+        """Like request, but yield False instead of waiting for a slot."""
+        start = self.try_acquire()
+        if start is None:
+            yield False
+            return
+        try:
+            yield True
+        except BaseException as e:
+            self.release(start, e)
+            raise
+        self.release(start)
+
+
+def init_shared_db(path: Optional[str] = None):
+    if path is None:
+        if shared_db.database is not None:
+            return
+        cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "pdf2zh")
+        os.makedirs(cache_folder, exist_ok=True)
+        path = os.path.join(cache_folder, "ratelimit.db")
+    shared_db.init(
+        path,
+        pragmas={
+            "journal_mode": "wal",
+            "busy_timeout": 10000,
+        },
+    )
+    shared_db.create_tables([_Bucket], safe=True)
+
+
+_limiters: dict[str, Optional[RateLimiter]] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> Optional[RateLimiter]:
+    """
+    Return the rate limiter of the translator name, shared by the whole
+    process, or None if the service has no configured limits.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            limits = ConfigManager.get("RATE_LIMITS", {})
+            if isinstance(limits, str):  # 来自环境变量
+                limits = json.loads(limits)
+            config = limits.get(name)
+            _limiters[name] = RateLimiter(name, **config) if config else None
+            if config:
+                logger.info(f"Rate limits of {name}: {config}")
+        return _limiters[name]
+
+
+class ConcurrencyGroup:
+    """
+    The adaptive concurrency of several services seen as one, for display:
+    the limits add up, and the latency is the mean of the services that have
+    answered.
+    """
+
+    def __init__(self, members: list[AdaptiveConcurrency]):
+        self.members = members
+
+    @property
+    def limit(self) -> float:
+        return sum(member.limit for member in self.members)
+
+    @property
+    def latency(self) -> float:
+        latencies = [member.latency for member in self.members if member.latency]
+        return sum(latencies) / len(latencies) if latencies else 0.0
@@ -1,8 +1,14 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import html
 import json
 import logging
 import os
 import re
+import threading
+import time
 import unicodedata
 from copy import copy
 from string import Template
@@ -10,12 +16,13 @@ from typing import cast
 import deepl
 import ollama
 import openai
-import requests
 import xinference_client
 from azure.ai.translation.text import TextTranslationClient
 from azure.core.credentials import AzureKeyCredential
 from tencentcloud.common import credential
 from tencentcloud.tmt.v20180321.models import (
+    TextTranslateBatchRequest,
+    TextTranslateBatchResponse,
     TextTranslateRequest,
     TextTranslateResponse,
 )
@@ -23,6 +30,15 @@ from tencentcloud.tmt.v20180321.tmt_client import TmtClient
 
 from pdf2zh.cache import TranslationCache
 from pdf2zh.config import ConfigManager
+from pdf2zh.hedge import HedgeSkipped, LatencyTracker, acall_hedged, call_hedged
+from pdf2zh.ratelimit import (
+    AdaptiveConcurrency,
+    ConcurrencyGroup,
+    get_rate_limiter,
+    is_overload,
+    status_code,
+)
+from pdf2zh.transport import get_session, request_timeout
 
 
 from tenacity import retry, retry_if_exception_type
@@ -37,11 +53,164 @@ def remove_control_characters(s):
     return "".join(ch for ch in s if unicodedata.category(ch)[0] != "C")
 
 
+def estimate_tokens(text: str) -> int:
+    # 粗略估计：CJK 等字符约一个 token，其余约四个字符一个 token
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide) // 4 + 1
+
+
+class AsyncClient:
+    """
+    Create an async client lazily for the running event loop, since the
+    connections of an async client can not be shared between loops.
+    """
+
+    def __init__(self, factory, **kwargs):
+        self.factory = factory
+        self.kwargs = kwargs
+        self.loop = None
+        self.client = None
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.client = self.factory(**self.kwargs)
+            self.loop = loop
+        return self.client
+
+
+def split_text(text: str, max_length: int) -> list[str]:
+    """
+    Split text into chunks of at most max_length characters at sentence
+    boundaries, without breaking {vN} placeholders. Each chunk keeps its
+    trailing whitespace, so the chunks join back into text.
+    """
+    if len(text) <= max_length:
+        return [text]
+    pieces, start = [], 0
+    for match in re.finditer(r"(?<=[.!?;:])\s+|(?<=[。！？；：])\s*", text):
+        if match.end() > start:
+            pieces.append(text[start : match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    # 过长的句子在空格处切开，没有空格时硬切，但不切断公式占位符
+    sentences = []
+    for piece in pieces:
+        while len(piece) > max_length:
+            cut = piece.rfind(" ", 0, max_length) + 1 or max_length
+            for match in re.finditer(r"\{v\d+\}", piece):
+                if match.start() < cut < match.end():
+                    cut = match.start() or match.end()
+            sentences.append(piece[:cut])
+            piece = piece[cut:]
+        if piece:
+            sentences.append(piece)
+    # 相邻的句子合并到不超过 max_length
+    chunks = []
+    for sentence in sentences:
+        if chunks and len(chunks[-1]) + len(sentence) <= max_length:
+            chunks[-1] += sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+def join_chunks(chunks: list[str], translations: list[str]) -> str:
+    """Join the translations of the chunks of split_text."""
+    if len(chunks) == 1:
+        return translations[0]
+    return "".join(
+        translation.rstrip() + chunk[len(chunk.rstrip()) :]
+        for chunk, translation in zip(chunks, translations)
+    )
+
+
+def split_endpoints(base_url: str | None, api_key: str | None) -> list[tuple]:
+    """
+    Pair the ";" separated base URLs and API keys, e.g. one base URL with
+    several keys, several base URLs with one key, or as many of both.
+    """
+    base_urls = [url.strip() for url in base_url.split(";")] if base_url else [None]
+    api_keys = [key.strip() for key in api_key.split(";")] if api_key else [None]
+    if len(base_urls) == 1:
+        base_urls *= len(api_keys)
+    if len(api_keys) == 1:
+        api_keys *= len(base_urls)
+    if len(base_urls) != len(api_keys):
+        raise ValueError("The numbers of base URLs and API keys do not match.")
+    return list(zip(base_urls, api_keys))
+
+
+class ClientPool:
+    """
+    Clients of several endpoints of one service. A request goes to the healthy
+    endpoint with the fewest outstanding requests. An endpoint that fails with
+    an overload or connection error leaves the rotation for a cooldown, which
+    doubles with every consecutive failure, and one that rejects its
+    credentials with 401 or 403 leaves it for good.
+    """
+
+    def __init__(self, endpoints: list, cooldown: float = 1, max_cooldown=60):
+        self.endpoints = endpoints
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.outstanding = [0] * len(endpoints)
+        self.sent = [0] * len(endpoints)
+        self.failures = [0] * len(endpoints)
+        self.down_until = [0.0] * len(endpoints)
+        self.lock = threading.Lock()
+
+    def pick(self) -> int:
+        now = time.monotonic()
+        indices = range(len(self.endpoints))
+        healthy = [i for i in indices if self.down_until[i] <= now]
+        if not healthy:  # 全部不可用时选最早恢复的
+            healthy = [min(indices, key=lambda i: self.down_until[i])]
+        return min(healthy, key=lambda i: (self.outstanding[i], self.sent[i]))
+
+    @contextlib.contextmanager
+    def acquire(self):
+        with self.lock:
+            i = self.pick()
+            self.outstanding[i] += 1
+            self.sent[i] += 1
+        try:
+            yield self.endpoints[i]
+        except BaseException as e:
+            with self.lock:
+                self.outstanding[i] -= 1
+                if status_code(e) in (401, 403):
+                    self.down_until[i] = float("inf")
+                    logger.warning(f"Endpoint {i} rejected the credentials: {e}")
+                elif is_overload(e) or "connect" in type(e).__name__.lower():
+                    self.failures[i] += 1
+                    cooldown = self.cooldown * 2 ** (self.failures[i] - 1)
+                    self.down_until[i] = time.monotonic() + min(
+                        cooldown, self.max_cooldown
+                    )
+                    logger.warning(f"Endpoint {i} is unhealthy for {cooldown}s: {e}")
+            raise
+        with self.lock:
+            self.outstanding[i] -= 1
+            self.failures[i] = 0
+
+
 class BaseTranslator:
     name = "base"
     envs = {}
     lang_map: dict[str, str] = {}
     CustomPrompt = False
+    # 单次请求最多翻译的段落数和总字符数，服务支持批量翻译时覆盖 do_translate_batch
+    batch_size = 1
+    batch_chars = 0
+    # 是否有原生异步客户端，否则 ado_translate 在线程中调用 do_translate
+    asynchronous = False
+    # 单次请求的最大文本长度，更长的段落按句子分块翻译，0 表示不限制
+    max_text_length = 0
+    # 没有多个端点时 acquire_endpoint 返回的客户端，由子类设置
+    client = None
+    aclient = None
 
     def __init__(self, lang_in: str, lang_out: str, model: str, ignore_cache: bool):
         lang_in = self.lang_map.get(lang_in.lower(), lang_in)
@@ -59,6 +228,22 @@ class BaseTranslator:
                 "model": model,
             },
         )
+        self.rate_limiter = get_rate_limiter(self.name)
+        # 进程内共用的 HTTP 连接池
+        self.session = get_session()
+        if max_text_length := int(ConfigManager.get("MAX_TEXT_LENGTH", 0)):
+            self.max_text_length = min(
+                self.max_text_length or max_text_length, max_text_length
+            )
+        # 自适应并发、请求超时和对冲请求的目标，由调用方按需设置
+        self.concurrency: AdaptiveConcurrency | None = None
+        self.timeout: float = 0
+        self.hedge: BaseTranslator | None = None
+        # 同步请求和对冲请求在这个有界线程池中执行，未设置时使用 hedge 模块的线程池
+        self.hedge_executor: concurrent.futures.Executor | None = None
+        self.latency = LatencyTracker()
+        # 多个端点时的客户端池，否则直接使用 client 和 aclient
+        self.pool: ClientPool | None = None
 
     def set_envs(self, envs):
         # Detach from self.__class__.envs
@@ -93,14 +278,227 @@ class BaseTranslator:
         :param text: text to translate
         :return: translated text
         """
+        return self.translate_batch([text], ignore_cache)[0]
+
+    def translate_batch(
+        self, texts: list[str], ignore_cache: bool = False
+    ) -> list[str]:
+        """
+        Translate several texts, sending the ones missing in the cache to the
+        service in batches of at most batch_size texts and batch_chars characters.
+        :param texts: texts to translate
+        :return: translated texts, in the same order
+        """
+        chunks = [self.split_text(text) for text in texts]
+        if len(chunks) != sum(len(c) for c in chunks):  # 分块翻译后拼接
+            results = iter(self.translate_batch(sum(chunks, []), ignore_cache))
+            return [join_chunks(c, [next(results) for _ in c]) for c in chunks]
+        translations = [None] * len(texts)
+        if not (self.ignore_cache or ignore_cache):
+            translations = self.cache.get_many(texts)
+        missing = [
+            i for i, translation in enumerate(translations) if translation is None
+        ]
+        for batch in self.split_batches([texts[i] for i in missing]):
+            batch = [missing[i] for i in batch]
+            with self.request([texts[i] for i in batch]):
+                results, cacheable = self.send_batch([texts[i] for i in batch])
+            if cacheable:
+                self.cache.set_many([texts[i] for i in batch], results)
+            for i, translation in zip(batch, results):
+                translations[i] = translation
+        return translations
+
+    async def atranslate(self, text: str, ignore_cache: bool = False) -> str:
+        """
+        Asynchronous version of translate.
+        :param text: text to translate
+        :return: translated text
+        """
+        return (await self.atranslate_batch([text], ignore_cache))[0]
+
+    async def atranslate_batch(
+        self, texts: list[str], ignore_cache: bool = False
+    ) -> list[str]:
+        """
+        Asynchronous version of translate_batch.
+        :param texts: texts to translate
+        :return: translated texts, in the same order
+        """
+        chunks = [self.split_text(text) for text in texts]
+        if len(chunks) != sum(len(c) for c in chunks):
+            results = iter(await self.atranslate_batch(sum(chunks, []), ignore_cache))
+            return [join_chunks(c, [next(results) for _ in c]) for c in chunks]
+        translations = [None] * len(texts)
+        # 缓存读写可能访问数据库或 Redis，放到线程中执行，不阻塞事件循环
         if not (self.ignore_cache or ignore_cache):
-            cache = self.cache.get(text)
-            if cache is not None:
-                return cache
+            translations = await asyncio.to_thread(self.cache.get_many, texts)
+        missing = [
+            i for i, translation in enumerate(translations) if translation is None
+        ]
+        for batch in self.split_batches([texts[i] for i in missing]):
+            batch = [missing[i] for i in batch]
+            async with self.arequest([texts[i] for i in batch]):
+                results, cacheable = await self.asend_batch([texts[i] for i in batch])
+            if cacheable:
+                await asyncio.to_thread(
+                    self.cache.set_many, [texts[i] for i in batch], results
+                )
+            for i, translation in zip(batch, results):
+                translations[i] = translation
+        return translations
+
+    @contextlib.contextmanager
+    def request(self, texts: list[str]):
+        """
+        Hold a slot of the concurrency limit while a request of texts is sent.
+        """
+        if self.concurrency is None:
+            yield
+            return
+        with self.concurrency.request():
+            yield
+
+    @contextlib.asynccontextmanager
+    async def arequest(self, texts: list[str]):
+        """
+        Asynchronous version of request.
+        """
+        if self.concurrency is None:
+            yield
+            return
+        async with self.concurrency.arequest():
+            yield
+
+    @contextlib.contextmanager
+    def try_request(self, texts: list[str]):
+        """
+        Like request, but yield False instead of waiting when the concurrency
+        limit is reached.
+        """
+        if self.concurrency is None:
+            yield True
+            return
+        with self.concurrency.try_request() as acquired:
+            yield acquired
+
+    @contextlib.contextmanager
+    def acquire_endpoint(self, texts: list[str]):
+        """
+        Wait for the rate limits, then yield the (client, aclient) pair of the
+        endpoint to send a single HTTP request of texts to. Every request goes
+        through here, retries and re-requests included, so each one is charged.
+        """
+        if self.rate_limiter:
+            self.rate_limiter.acquire(sum(estimate_tokens(text) for text in texts))
+        with self.pick_endpoint() as endpoint:
+            yield endpoint
+
+    @contextlib.asynccontextmanager
+    async def aacquire_endpoint(self, texts: list[str]):
+        """
+        Asynchronous version of acquire_endpoint.
+        """
+        if self.rate_limiter:
+            await self.rate_limiter.aacquire(
+                sum(estimate_tokens(text) for text in texts)
+            )
+        with self.pick_endpoint() as endpoint:
+            yield endpoint
+
+    @contextlib.contextmanager
+    def pick_endpoint(self):
+        if self.pool is None:
+            yield self.client, self.aclient
+            return
+        with self.pool.acquire() as endpoint:
+            yield endpoint
+
+    def send_batch(self, texts: list[str]) -> tuple[list[str], bool]:
+        """
+        Send a request of texts with the deadline of timeout seconds, hedged
+        to the hedge translator when it runs past the p95 latency. Return the
+        translations, and whether this service produced them, so that they
+        may be cached under its key.
+        """
+        if not (self.timeout or self.hedge):
+            return self.do_translate_batch(texts), True
+        return call_hedged(
+            lambda: (self.do_translate_batch(texts), True),
+            self.hedge and (lambda: self.send_hedge(texts)),
+            self.latency,
+            self.timeout,
+            self.hedge_executor,
+        )
+
+    async def asend_batch(self, texts: list[str]) -> tuple[list[str], bool]:
+        """
+        Asynchronous version of send_batch.
+        """
+        if not (self.timeout or self.hedge):
+            return await self.ado_translate_batch(texts), True
 
-        translation = self.do_translate(text)
-        self.cache.set(text, translation)
-        return translation
+        async def primary():
+            return await self.ado_translate_batch(texts), True
+
+        return await acall_hedged(
+            primary,
+            self.hedge and (lambda: self.asend_hedge(texts)),
+            self.latency,
+            self.timeout,
+        )
+
+    def send_hedge(self, texts: list[str]) -> tuple[list[str], bool]:
+        """
+        Send the duplicate of a request of texts. It takes its own slot of the
+        concurrency limit, and is skipped when none is free: waiting for one
+        would send it after the race is decided. Another service translates
+        it with translate_batch, which caches the answer under that service
+        and applies its limits.
+        """
+        if self.hedge is self:
+            with self.try_request(texts) as acquired:
+                if not acquired:
+                    raise HedgeSkipped("No free slot for the hedge")
+                return self.do_translate_batch(texts), True
+        return self.hedge.translate_batch(texts), False
+
+    async def asend_hedge(self, texts: list[str]) -> tuple[list[str], bool]:
+        """
+        Asynchronous version of send_hedge.
+        """
+        if self.hedge is self:
+            with self.try_request(texts) as acquired:
+                if not acquired:
+                    raise HedgeSkipped("No free slot for the hedge")
+                return await self.ado_translate_batch(texts), True
+        return await self.hedge.atranslate_batch(texts), False
+
+    def split_text(self, text: str) -> list[str]:
+        """
+        Split a text longer than max_text_length into chunks at sentence
+        boundaries, see split_text.
+        """
+        if not self.max_text_length:
+            return [text]
+        return split_text(text, self.max_text_length)
+
+    def split_batches(self, texts: list[str]) -> list[list[int]]:
+        """
+        Split the indices of texts into batches that fit in a single request.
+        """
+        batches, chars = [], 0
+        for i, text in enumerate(texts):
+            if (
+                not batches
+                or len(batches[-1]) >= self.batch_size
+                or (self.batch_chars and chars + len(text) > self.batch_chars)
+            ):
+                batches.append([])
+                chars = 0
+            batches[-1].append(i)
+            chars += len(text)
+        return batches
 
     def do_translate(self, text: str) -> str:
         """
@@ -110,6 +508,34 @@ class BaseTranslator:
         """
         raise NotImplementedError
 
+    def do_translate_batch(self, texts: list[str]) -> list[str]:
+        """
+        Actual translate texts in a single request, override this method if
+        the service accepts a list of texts
+        :param texts: texts to translate
+        :return: translated texts
+        """
+        return [self.do_translate(text) for text in texts]
+
+    async def ado_translate(self, text: str) -> str:
+        """
+        Actual translate text asynchronously, override this method and set
+        asynchronous if the service has an async client
+        :param text: text to translate
+        :return: translated text
+        """
+        return await asyncio.to_thread(self.do_translate, text)
+
+    async def ado_translate_batch(self, texts: list[str]) -> list[str]:
+        """
+        Actual translate texts asynchronously in a single request
+        :param texts: texts to translate
+        :return: translated texts
+        """
+        if not self.asynchronous:
+            return await asyncio.to_thread(self.do_translate_batch, texts)
+        return [await self.ado_translate(text) for text in texts]
+
     def prompt(
         self, text: str, prompt_template: Template | None = None
     ) -> list[dict[str, str]]:
@@ -167,22 +593,22 @@ class BaseTranslator:
 class GoogleTranslator(BaseTranslator):
     name = "google"
     lang_map = {"zh": "zh-CN"}
+    max_text_length = 5000
 
     def __init__(self, lang_in, lang_out, model, ignore_cache=False, **kwargs):
         super().__init__(lang_in, lang_out, model, ignore_cache)
-        self.session = requests.Session()
         self.endpoint = "https://translate.google.com/m"
         self.headers = {
             "User-Agent": "Mozilla/4.0 (compatible;MSIE 6.0;Windows NT 5.1;SV1;.NET CLR 1.1.4322;.NET CLR 2.0.50727;.NET CLR 3.0.04506.30)"  # noqa: E501
         }
 
     def do_translate(self, text):
-        text = text[:5000]  # google translate max length
-        response = self.session.get(
-            self.endpoint,
-            params={"tl": self.lang_out, "sl": self.lang_in, "q": text},
-            headers=self.headers,
-        )
+        with self.acquire_endpoint([text]):
+            response = self.session.get(
+                self.endpoint,
+                params={"tl": self.lang_out, "sl": self.lang_in, "q": text},
+                headers=self.headers,
+            )
         re_result = re.findall(
             r'(?s)class="(?:t0|result-container)">(.*?)<', response.text
         )
@@ -198,17 +624,24 @@ class BingTranslator(BaseTranslator):
     # https://github.com/immersive-translate/old-immersive-translate/blob/6df13da22664bea2f51efe5db64c63aca59c4e79/src/background/translationService.js
     name = "bing"
     lang_map = {"zh": "zh-Hans"}
+    max_text_length = 1000
+
+    # IG、IID 和 token 的有效期（秒），过期或被拒绝时重新获取
+    sid_ttl = 600
 
     def __init__(self, lang_in, lang_out, model, ignore_cache=False, **kwargs):
         super().__init__(lang_in, lang_out, model, ignore_cache)
-        self.session = requests.Session()
         self.endpoint = "https://www.bing.com/translator"
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",  # noqa: E501
         }
+        self.sid = None
+        self.sid_expires = 0.0
+        self.sid_lock = threading.Lock()
 
-    def find_sid(self):
-        response = self.session.get(self.endpoint)
+    def fetch_sid(self):
+        with self.acquire_endpoint([]):
+            response = self.session.get(self.endpoint)
         response.raise_for_status()
         url = response.url[:-10]
         ig = re.findall(r"\"ig\":\"(.*?)\"", response.text)[0]
@@ -218,21 +651,54 @@ class BingTranslator(BaseTranslator):
         )[0]
         return url, ig, iid, key, token
 
+    def find_sid(self, stale=None):
+        """
+        Return the cached (url, ig, iid, key, token), fetching the translator
+        page when it has expired or when stale, the one rejected by the
+        service, is still cached. All threads share one fetch.
+        """
+        with self.sid_lock:
+            if (
+                self.sid is None
+                or self.sid == stale
+                or time.monotonic() >= self.sid_expires
+            ):
+                self.sid = self.fetch_sid()
+                self.sid_expires = time.monotonic() + self.sid_ttl
+            return self.sid
+
+    def rejected(self, response) -> bool:
+        # token 失效时返回 401/403，或者返回 {"statusCode": 205} 之类的错误对象
+        if response.status_code in (401, 403):
+            return True
+        try:
+            return isinstance(response.json(), dict)
+        except ValueError:
+            return False
+
+    def post(self, sid, text):
+        url, ig, iid, key, token = sid
+        with self.acquire_endpoint([text]):
+            return self.session.post(
+                f"{url}ttranslatev3?IG={ig}&IID={iid}",
+                data={
+                    "fromLang": self.lang_in,
+                    "to": self.lang_out,
+                    "text": text,
+                    "token": token,
+                    "key": key,
+                },
+                headers=self.headers,
+            )
+
     def do_translate(self, text):
-        text = text[:1000]  # bing translate max length
-        url, ig, iid, key, token = self.find_sid()
-        response = self.session.post(
-            f"{url}ttranslatev3?IG={ig}&IID={iid}",
-            data={
-                "fromLang": self.lang_in,
-                "to": self.lang_out,
-                "text": text,
-                "token": token,
-                "key": key,
-            },
-            headers=self.headers,
-        )
+        sid = self.find_sid()
+        response = self.post(sid, text)
+        if self.rejected(response):
+            response = self.post(self.find_sid(stale=sid), text)
         response.raise_for_status()
+        if self.rejected(response):
+            raise ValueError(f"Bing rejected the request: {response.text}")
         return response.json()[0]["translations"][0]["text"]
 
 
@@ -243,6 +709,9 @@ class DeepLTranslator(BaseTranslator):
         "DEEPL_AUTH_KEY": None,
     }
     lang_map = {"zh": "zh-Hans"}
+    # https://developers.deepl.com/docs/api-reference/translate
+    batch_size = 50
+    batch_chars = 100000
 
     def __init__(
         self, lang_in, lang_out, model, envs=None, ignore_cache=False, **kwargs
@@ -253,11 +722,19 @@ class DeepLTranslator(BaseTranslator):
         self.client = deepl.Translator(auth_key)
 
     def do_translate(self, text):
-        response = self.client.translate_text(
-            text, target_lang=self.lang_out, source_lang=self.lang_in
-        )
+        with self.acquire_endpoint([text]):
+            response = self.client.translate_text(
+                text, target_lang=self.lang_out, source_lang=self.lang_in
+            )
         return response.text
 
+    def do_translate_batch(self, texts):
+        with self.acquire_endpoint(texts):
+            response = self.client.translate_text(
+                texts, target_lang=self.lang_out, source_lang=self.lang_in
+            )
+        return [result.text for result in response]
+
 
 class DeepLXTranslator(BaseTranslator):
     # https://deeplx.owo.network/endpoints/free.html
@@ -274,21 +751,21 @@ class DeepLXTranslator(BaseTranslator):
         self.set_envs(envs)
         super().__init__(lang_in, lang_out, model, ignore_cache)
         self.endpoint = self.envs["DEEPLX_ENDPOINT"]
-        self.session = requests.Session()
         auth_key = self.envs["DEEPLX_ACCESS_TOKEN"]
         if auth_key:
             self.endpoint = f"{self.endpoint}?token={auth_key}"
 
     def do_translate(self, text):
-        response = self.session.post(
-            self.endpoint,
-            json={
-                "source_lang": self.lang_in,
-                "target_lang": self.lang_out,
-                "text": text,
-            },
-            verify=False,  # noqa: S506
-        )
+        with self.acquire_endpoint([text]):
+            response = self.session.post(
+                self.endpoint,
+                json={
+                    "source_lang": self.lang_in,
+                    "target_lang": self.lang_out,
+                    "text": text,
+                },
+                verify=False,  # noqa: S506
+            )
         response.raise_for_status()
         return response.json()["data"]
 
@@ -301,6 +778,7 @@ class OllamaTranslator(BaseTranslator):
         "OLLAMA_MODEL": "gemma2",
     }
     CustomPrompt = True
+    asynchronous = True
 
     def __init__(
         self,
@@ -319,7 +797,17 @@ class OllamaTranslator(BaseTranslator):
             "temperature": 0,  # 随机采样可能会打断公式标记
             "num_predict": 2000,
         }
-        self.client = ollama.Client(host=self.envs["OLLAMA_HOST"])
+        timeout = request_timeout() or None
+        clients = [
+            (
+                ollama.Client(host=host, timeout=timeout),
+                AsyncClient(ollama.AsyncClient, host=host, timeout=timeout),
+            )
+            for host, _ in split_endpoints(self.envs["OLLAMA_HOST"], None)
+        ]
+        self.client, self.aclient = clients[0]
+        if len(clients) > 1:
+            self.pool = ClientPool(clients)
         self.prompt_template = prompt
         self.add_cache_impact_parameters("temperature", self.options["temperature"])
 
@@ -327,11 +815,25 @@ class OllamaTranslator(BaseTranslator):
         if (max_token := len(text) * 5) > self.options["num_predict"]:
             self.options["num_predict"] = max_token
 
-        response = self.client.chat(
-            model=self.model,
-            messages=self.prompt(text, self.prompt_template),
-            options=self.options,
-        )
+        with self.acquire_endpoint([text]) as (client, _):
+            response = client.chat(
+                model=self.model,
+                messages=self.prompt(text, self.prompt_template),
+                options=self.options,
+            )
+        content = self._remove_cot_content(response.message.content or "")
+        return content.strip()
+
+    async def ado_translate(self, text: str) -> str:
+        if (max_token := len(text) * 5) > self.options["num_predict"]:
+            self.options["num_predict"] = max_token
+
+        async with self.aacquire_endpoint([text]) as (_, aclient):
+            response = await aclient.get().chat(
+                model=self.model,
+                messages=self.prompt(text, self.prompt_template),
+                options=self.options,
+            )
         content = self._remove_cot_content(response.message.content or "")
         return content.strip()
 
@@ -380,10 +882,11 @@ class XinferenceTranslator(BaseTranslator):
                         + xf_prompt[1]["content"],
                     }
                 ]
-                response = xf_model.chat(
-                    generate_config=self.options,
-                    messages=xf_prompt,
-                )
+                with self.acquire_endpoint([text]):
+                    response = xf_model.chat(
+                        generate_config=self.options,
+                        messages=xf_prompt,
+                    )
 
                 response = response["choices"][0]["message"]["content"].replace(
                     "<end_of_turn>", ""
@@ -396,6 +899,17 @@ class XinferenceTranslator(BaseTranslator):
         raise Exception("All models failed")
 
 
+retry_rate_limit = retry(
+    retry=retry_if_exception_type(openai.RateLimitError),
+    stop=stop_after_attempt(100),
+    wait=wait_exponential(multiplier=1, min=1, max=15),
+    before_sleep=lambda retry_state: logger.warning(
+        f"RateLimitError, retrying in {retry_state.next_action.sleep} seconds... "
+        f"(Attempt {retry_state.attempt_number}/100)"
+    ),
+)
+
+
 class OpenAITranslator(BaseTranslator):
     # https://github.com/openai/openai-python
     name = "openai"
@@ -405,6 +919,10 @@ class OpenAITranslator(BaseTranslator):
         "OPENAI_MODEL": "gpt-4o-mini",
     }
     CustomPrompt = True
+    asynchronous = True
+    # 打包模式下单次请求最多的段落数，是否支持打包
+    pack_size = 50
+    packable = True
 
     def __init__(
         self,
@@ -422,38 +940,183 @@ class OpenAITranslator(BaseTranslator):
             model = self.envs["OPENAI_MODEL"]
         super().__init__(lang_in, lang_out, model, ignore_cache)
         self.options = {"temperature": 0}  # 随机采样可能会打断公式标记
-        self.client = openai.OpenAI(
-            base_url=base_url or self.envs["OPENAI_BASE_URL"],
-            api_key=api_key or self.envs["OPENAI_API_KEY"],
-        )
+        # 超过截止时间的请求由客户端断开，被对冲请求超过的同步请求不会一直占用线程
+        timeout = request_timeout() or openai.NOT_GIVEN
+        clients = [
+            (
+                openai.OpenAI(base_url=url, api_key=key, timeout=timeout),
+                AsyncClient(
+                    openai.AsyncOpenAI, base_url=url, api_key=key, timeout=timeout
+                ),
+            )
+            for url, key in split_endpoints(
+                base_url or self.envs["OPENAI_BASE_URL"],
+                api_key or self.envs["OPENAI_API_KEY"],
+            )
+        ]
+        self.client, self.aclient = clients[0]
+        if len(clients) > 1:  # 多个地址或密钥
+            self.pool = ClientPool(clients)
         self.prompttext = prompt
         self.add_cache_impact_parameters("temperature", self.options["temperature"])
         self.add_cache_impact_parameters("prompt", self.prompt("", self.prompttext))
         think_filter_regex = r"^<think>.+?\n*(</think>|\n)*(</think>)\n*"
         self.add_cache_impact_parameters("think_filter_regex", think_filter_regex)
         self.think_filter_regex = re.compile(think_filter_regex, flags=re.DOTALL)
+        # 多个段落打包进一个请求时，源文本的 token 预算，0 表示不打包
+        self.pack_tokens = int(ConfigManager.get("LLM_PACK_TOKENS", 0))
+        if self.pack_tokens and self.packable:
+            self.add_cache_impact_parameters("pack", True)
 
-    @retry(
-        retry=retry_if_exception_type(openai.RateLimitError),
-        stop=stop_after_attempt(100),
-        wait=wait_exponential(multiplier=1, min=1, max=15),
-        before_sleep=lambda retry_state: logger.warning(
-            f"RateLimitError, retrying in {retry_state.next_action.sleep} seconds... "
-            f"(Attempt {retry_state.attempt_number}/100)"
-        ),
-    )
     def do_translate(self, text) -> str:
-        response = self.client.chat.completions.create(
-            model=self.model,
-            **self.options,
-            messages=self.prompt(text, self.prompttext),
+        return self.do_translate_chat(self.prompt(text, self.prompttext))
+
+    async def ado_translate(self, text) -> str:
+        return await self.ado_translate_chat(self.prompt(text, self.prompttext))
+
+    @property
+    def packing(self) -> bool:
+        # 自定义提示词无法约束输出格式，此时不打包
+        return bool(self.pack_tokens and self.packable and self.prompttext is None)
+
+    @property
+    def batch_size(self) -> int:
+        return self.pack_size if self.packing else 1
+
+    def split_batches(self, texts: list[str]) -> list[list[int]]:
+        batches, tokens = [], 0
+        for i, text in enumerate(texts):
+            size = estimate_tokens(text)
+            if (
+                not batches
+                or len(batches[-1]) >= self.batch_size
+                or tokens + size > self.pack_tokens
+            ):
+                batches.append([])
+                tokens = 0
+            batches[-1].append(i)
+            tokens += size
+        return batches
+
+    def do_translate_batch(self, texts: list[str]) -> list[str]:
+        if not self.packing or len(texts) == 1:
+            return [self.do_translate(text) for text in texts]
+        results = {}
+        todo = list(range(len(texts)))
+        for _ in range(2):  # 打包翻译，解析失败的段落重新打包请求一次
+            if len(todo) <= 1:
+                break
+            results.update(self.do_translate_packed({i: texts[i] for i in todo}))
+            todo = [i for i in todo if i not in results]
+        for i in todo:  # 仍然失败的段落单独翻译
+            results[i] = self.do_translate(texts[i])
+        return [results[i] for i in range(len(texts))]
+
+    async def ado_translate_batch(self, texts: list[str]) -> list[str]:
+        if not self.packing or len(texts) == 1:
+            return [await self.ado_translate(text) for text in texts]
+        results = {}
+        todo = list(range(len(texts)))
+        for _ in range(2):
+            if len(todo) <= 1:
+                break
+            results.update(await self.ado_translate_packed({i: texts[i] for i in todo}))
+            todo = [i for i in todo if i not in results]
+        for i in todo:
+            results[i] = await self.ado_translate(texts[i])
+        return [results[i] for i in range(len(texts))]
+
+    def pack_prompt(self, segments: dict[str, str]) -> list[dict[str, str]]:
+        return [
+            {
+                "role": "user",
+                "content": (
+                    "You are a professional, authentic machine translation engine. "
+                    "Only Output the translated text, do not include any other text."
+                    "\n\n"
+                    f"Translate each value of the following JSON object from markdown "
+                    f"source text to {self.lang_out}. "
+                    "Keep the keys and the formula notation {v*} unchanged. "
+                    "Output a JSON object with the same keys and the translations as "
+                    "values directly without any additional text."
+                    "\n\n"
+                    f"Source Text: {json.dumps(segments, ensure_ascii=False)}"
+                    "\n\n"
+                    "Translated Text:"
+                ),
+            },
+        ]
+
+    def do_translate_packed(self, texts: dict[int, str]) -> dict[int, str]:
+        """
+        Translate several texts in a single request, numbering them in a JSON
+        object. Return the translations that came back with every formula
+        placeholder, keyed like texts.
+        """
+        keys = {str(n + 1): i for n, i in enumerate(texts)}
+        content = self.do_translate_chat(
+            self.pack_prompt({k: texts[i] for k, i in keys.items()})
+        )
+        return self.unpack(texts, keys, content)
+
+    async def ado_translate_packed(self, texts: dict[int, str]) -> dict[int, str]:
+        keys = {str(n + 1): i for n, i in enumerate(texts)}
+        content = await self.ado_translate_chat(
+            self.pack_prompt({k: texts[i] for k, i in keys.items()})
         )
+        return self.unpack(texts, keys, content)
+
+    def unpack(
+        self, texts: dict[int, str], keys: dict[str, int], content: str
+    ) -> dict[int, str]:
+        try:
+            start, end = content.index("{"), content.rindex("}")
+            response = json.loads(content[start : end + 1])
+        except ValueError:
+            logger.warning("Failed to parse packed translation, retrying")
+            return {}
+        if not isinstance(response, dict):
+            return {}
+        results = {}
+        for k, i in keys.items():
+            new = response.get(k)
+            # 原文中的占位符必须原样保留，丢失或被改写（如 {v1} 变成 {{v1}}）视为失败
+            placeholders = sorted(re.findall(r"\{+v\d+\}+", texts[i]))
+            if (
+                isinstance(new, str)
+                and sorted(re.findall(r"\{+v\d+\}+", new)) == placeholders
+            ):
+                results[i] = new.strip()
+        return results
+
+    @retry_rate_limit
+    def do_translate_chat(self, messages: list[dict[str, str]]) -> str:
+        texts = [message["content"] for message in messages]
+        with self.acquire_endpoint(texts) as (client, _):
+            response = client.chat.completions.create(
+                model=self.model,
+                **self.options,
+                messages=messages,
+            )
+        return self.chat_content(response)
+
+    @retry_rate_limit
+    async def ado_translate_chat(self, messages: list[dict[str, str]]) -> str:
+        texts = [message["content"] for message in messages]
+        async with self.aacquire_endpoint(texts) as (_, aclient):
+            response = await aclient.get().chat.completions.create(
+                model=self.model,
+                **self.options,
+                messages=messages,
+            )
+        return self.chat_content(response)
+
+    def chat_content(self, response) -> str:
         if not response.choices:
             if hasattr(response, "error"):
                 raise ValueError("Error response from Service", response.error)
         content = response.choices[0].message.content.strip()
-        content = self.think_filter_regex.sub("", content).strip()
-        return content
+        return self.think_filter_regex.sub("", content).strip()
 
     def get_formular_placeholder(self, id: int):
         return "{{v" + str(id) + "}}"
@@ -500,17 +1163,19 @@ class AzureOpenAITranslator(BaseTranslator):
             azure_deployment=model,
             api_version=api_version,
             api_key=api_key,
+            timeout=request_timeout() or openai.NOT_GIVEN,
         )
         self.prompttext = prompt
         self.add_cache_impact_parameters("temperature", self.options["temperature"])
         self.add_cache_impact_parameters("prompt", self.prompt("", self.prompttext))
 
     def do_translate(self, text) -> str:
-        response = self.client.chat.completions.create(
-            model=self.model,
-            **self.options,
-            messages=self.prompt(text, self.prompttext),
-        )
+        with self.acquire_endpoint([text]):
+            response = self.client.chat.completions.create(
+                model=self.model,
+                **self.options,
+                messages=self.prompt(text, self.prompttext),
+            )
         return response.choices[0].message.content.strip()
 
 
@@ -581,16 +1246,30 @@ class ZhipuTranslator(OpenAITranslator):
 
     def do_translate(self, text) -> str:
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                **self.options,
-                messages=self.prompt(text, self.prompttext),
-            )
+            with self.acquire_endpoint([text]) as (client, _):
+                response = client.chat.completions.create(
+                    model=self.model,
+                    **self.options,
+                    messages=self.prompt(text, self.prompttext),
+                )
         except openai.BadRequestError as e:
-            if (
-                json.loads(response.choices[0].message.content.strip())["error"]["code"]
-                == "1301"
-            ):
+            # 1301 表示内容不安全，重试也无法翻译
+            if e.code == "1301":
+                return "IRREPARABLE TRANSLATION ERROR"
+            raise e
+        return response.choices[0].message.content.strip()
+
+    async def ado_translate(self, text) -> str:
+        try:
+            async with self.aacquire_endpoint([text]) as (_, aclient):
+                response = await aclient.get().chat.completions.create(
+                    model=self.model,
+                    **self.options,
+                    messages=self.prompt(text, self.prompttext),
+                )
+        except openai.BadRequestError as e:
+            # 1301 表示内容不安全，重试也无法翻译
+            if e.code == "1301":
                 return "IRREPARABLE TRANSLATION ERROR"
             raise e
         return response.choices[0].message.content.strip()
@@ -691,6 +1370,9 @@ class AzureTranslator(BaseTranslator):
         "AZURE_API_KEY": None,
     }
     lang_map = {"zh": "zh-Hans"}
+    # https://learn.microsoft.com/azure/ai-services/translator/service-limits
+    batch_size = 1000
+    batch_chars = 50000
 
     def __init__(
         self, lang_in, lang_out, model, envs=None, ignore_cache=False, **kwargs
@@ -708,14 +1390,24 @@ class AzureTranslator(BaseTranslator):
         logger.setLevel(logging.WARNING)
 
     def do_translate(self, text) -> str:
-        response = self.client.translate(
-            body=[text],
-            from_language=self.lang_in,
-            to_language=[self.lang_out],
-        )
+        with self.acquire_endpoint([text]):
+            response = self.client.translate(
+                body=[text],
+                from_language=self.lang_in,
+                to_language=[self.lang_out],
+            )
         translated_text = response[0].translations[0].text
         return translated_text
 
+    def do_translate_batch(self, texts):
+        with self.acquire_endpoint(texts):
+            response = self.client.translate(
+                body=texts,
+                from_language=self.lang_in,
+                to_language=[self.lang_out],
+            )
+        return [item.translations[0].text for item in response]
+
 
 class TencentTranslator(BaseTranslator):
     # https://github.com/TencentCloud/tencentcloud-sdk-python
@@ -724,6 +1416,9 @@ class TencentTranslator(BaseTranslator):
         "TENCENTCLOUD_SECRET_ID": None,
         "TENCENTCLOUD_SECRET_KEY": None,
     }
+    # https://cloud.tencent.com/document/api/551/40566
+    batch_size = 100
+    batch_chars = 6000
 
     def __init__(
         self, lang_in, lang_out, model, envs=None, ignore_cache=False, **kwargs
@@ -738,16 +1433,27 @@ class TencentTranslator(BaseTranslator):
                 self.envs["TENCENTCLOUD_SECRET_KEY"],
             )
         self.client = TmtClient(cred, "ap-beijing")
-        self.req = TextTranslateRequest()
-        self.req.Source = self.lang_in
-        self.req.Target = self.lang_out
-        self.req.ProjectId = 0
 
     def do_translate(self, text):
-        self.req.SourceText = text
-        resp: TextTranslateResponse = self.client.TextTranslate(self.req)
+        req = TextTranslateRequest()
+        req.Source = self.lang_in
+        req.Target = self.lang_out
+        req.ProjectId = 0
+        req.SourceText = text
+        with self.acquire_endpoint([text]):
+            resp: TextTranslateResponse = self.client.TextTranslate(req)
         return resp.TargetText
 
+    def do_translate_batch(self, texts):
+        req = TextTranslateBatchRequest()
+        req.Source = self.lang_in
+        req.Target = self.lang_out
+        req.ProjectId = 0
+        req.SourceTextList = texts
+        with self.acquire_endpoint(texts):
+            resp: TextTranslateBatchResponse = self.client.TextTranslateBatch(req)
+        return resp.TargetTextList
+
 
 class AnythingLLMTranslator(BaseTranslator):
     name = "anythingllm"
@@ -779,9 +1485,10 @@ class AnythingLLMTranslator(BaseTranslator):
             "sessionId": "translation_expert",
         }
 
-        response = requests.post(
-            self.api_url, headers=self.headers, data=json.dumps(payload)
-        )
+        with self.acquire_endpoint([text]):
+            response = self.session.post(
+                self.api_url, headers=self.headers, data=json.dumps(payload)
+            )
         response.raise_for_status()
         data = response.json()
 
@@ -821,9 +1528,10 @@ class DifyTranslator(BaseTranslator):
         }
 
         # 向 Dify 服务器发送请求
-        response = requests.post(
-            self.api_url, headers=headers, data=json.dumps(payload)
-        )
+        with self.acquire_endpoint([text]):
+            response = self.session.post(
+                self.api_url, headers=headers, data=json.dumps(payload)
+            )
         response.raise_for_status()
         response_data = response.json()
 
@@ -865,13 +1573,11 @@ class ArgosTranslator(BaseTranslator):
         download_path = available_package.download()
         argostranslate.package.install_from_path(download_path)
 
-    def translate(self, text: str, ignore_cache: bool = False):
+    def do_translate(self, text: str):
         # Translate
-        import argotranslate.translate  # noqa: F401
+        import argostranslate.translate
 
-        installed_languages = (
-            argostranslate.translate.get_installed_languages()  # noqa: F821
-        )
+        installed_languages = argostranslate.translate.get_installed_languages()
         from_lang = list(filter(lambda x: x.code == self.lang_in, installed_languages))[
             0
         ]
@@ -1016,6 +1722,7 @@ class QwenMtTranslator(OpenAITranslator):
         "ALI_DOMAINS": "This sentence is extracted from a scientific paper. When translating, please pay close attention to the use of specialized troubleshooting terminologies and adhere to scientific sentence structures to maintain the technical rigor and precision of the original text.",
     }
     CustomPrompt = True
+    packable = False
 
     def __init__(
         self, lang_in, lang_out, model, envs=None, prompt=None, ignore_cache=False
@@ -1059,20 +1766,215 @@ class QwenMtTranslator(OpenAITranslator):
 
         return langdict[input_lang]
 
+    def translation_options(self) -> dict:
+        return {
+            "source_lang": self.lang_mapping(self.lang_in),
+            "target_lang": self.lang_mapping(self.lang_out),
+            "domains": self.envs["ALI_DOMAINS"],
+        }
+
     def do_translate(self, text) -> str:
         """
         Qwen-MT Model reqeust to send translation_options to the server.
         domains are options, but suggested. it must be in English.
         """
-        translation_options = {
-            "source_lang": self.lang_mapping(self.lang_in),
-            "target_lang": self.lang_mapping(self.lang_out),
-            "domains": self.envs["ALI_DOMAINS"],
-        }
-        response = self.client.chat.completions.create(
-            model=self.model,
-            **self.options,
-            messages=[{"role": "user", "content": text}],
-            extra_body={"translation_options": translation_options},
-        )
+        translation_options = self.translation_options()
+        with self.acquire_endpoint([text]) as (client, _):
+            response = client.chat.completions.create(
+                model=self.model,
+                **self.options,
+                messages=[{"role": "user", "content": text}],
+                extra_body={"translation_options": translation_options},
+            )
         return response.choices[0].message.content.strip()
+
+    async def ado_translate(self, text) -> str:
+        async with self.aacquire_endpoint([text]) as (_, aclient):
+            response = await aclient.get().chat.completions.create(
+                model=self.model,
+                **self.options,
+                messages=[{"role": "user", "content": text}],
+                extra_body={"translation_options": self.translation_options()},
+            )
+        return response.choices[0].message.content.strip()
+
+
+class CircuitBreaker:
+    """
+    Health of a service from its recent requests. The circuit opens when the
+    error rate of the last window requests reaches error_rate, counting the
+    requests slower than latency seconds as errors. While it is open the
+    service is skipped; after cooldown seconds one trial request is let
+    through, which closes the circuit on success and opens it again otherwise.
+    """
+
+    def __init__(
+        self,
+        error_rate: float = 0.5,
+        latency: float = 0,
+        window: int = 20,
+        min_requests: int = 5,
+        cooldown: float = 30,
+    ):
+        self.error_rate = error_rate
+        self.latency = latency
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened_at: float | None = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def closed(self) -> bool:
+        return self.opened_at is None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, ok: bool, latency: float = 0) -> None:
+        with self.lock:
+            if ok and self.latency and latency > self.latency:
+                ok = False
+            if self.trial:
+                self.trial = False
+                self.opened_at = None if ok else time.monotonic()
+                self.outcomes.clear()
+                return
+            if self.opened_at is not None:  # 断开之前发出的请求
+                return
+            self.outcomes.append(ok)
+            errors = self.outcomes.count(False)
+            if (
+                len(self.outcomes) >= self.min_requests
+                and errors / len(self.outcomes) >= self.error_rate
+            ):
+                self.opened_at = time.monotonic()
+
+
+class ServicesUnavailableError(RuntimeError):
+    """
+    Every service of a fallback chain has its circuit breaker open. Retrying
+    right away can not succeed, so the converter does not retry it.
+    """
+
+
+class FallbackTranslator(BaseTranslator):
+    """
+    Try several services in order, e.g. "deepl>openai>google". A service
+    whose circuit breaker is open is skipped, and a request that fails goes
+    to the next service. Each translation is cached by the service that
+    produced it, and the caches of all services are looked up before sending.
+    ServicesUnavailableError is raised when no service may be tried.
+    """
+
+    name = "fallback"
+
+    def __init__(self, translators: list[BaseTranslator]):
+        primary = translators[0]
+        super().__init__(primary.lang_in, primary.lang_out, None, primary.ignore_cache)
+        self.translators = translators
+        self.asynchronous = primary.asynchronous
+        self.max_text_length = primary.max_text_length
+        error_rate = float(ConfigManager.get("FALLBACK_ERROR_RATE", 0.5))
+        latency = float(ConfigManager.get("FALLBACK_LATENCY", 0))
+        self.breakers = [CircuitBreaker(error_rate, latency) for _ in translators]
+
+    @property
+    def batch_size(self) -> int:
+        return self.translators[0].batch_size
+
+    @property
+    def concurrency(self) -> ConcurrencyGroup | None:
+        # 回退链本身不发送请求，进度条显示各个服务的并发限制之和
+        members = [t.concurrency for t in self.translators if t.concurrency]
+        return ConcurrencyGroup(members) if members else None
+
+    @concurrency.setter
+    def concurrency(self, value):
+        if value is not None:
+            raise AttributeError("Set the concurrency of each service of the chain")
+
+    def cached(self, texts: list[str], ignore_cache: bool) -> list[str | None]:
+        translations = [None] * len(texts)
+        if self.ignore_cache or ignore_cache:
+            return translations
+        for translator in self.translators:
+            if translator.ignore_cache:
+                continue
+            missing = [i for i, t in enumerate(translations) if t is None]
+            results = translator.cache.get_many([texts[i] for i in missing])
+            for i, translation in zip(missing, results):
+                translations[i] = translation
+        return translations
+
+    def translate_batch(
+        self, texts: list[str], ignore_cache: bool = False
+    ) -> list[str]:
+        translations = self.cached(texts, ignore_cache)
+        missing = [
+            i for i, translation in enumerate(translations) if translation is None
+        ]
+        if missing:
+            error = None
+            for translator, breaker in zip(self.translators, self.breakers):
+                if not breaker.allow():
+                    continue
+                start = time.monotonic()
+                try:
+                    results = translator.translate_batch(
+                        [texts[i] for i in missing], ignore_cache=True
+                    )
+                except Exception as e:
+                    breaker.record(False)
+                    logger.warning(f"{translator.name} failed, falling back: {e}")
+                    error = e
+                    continue
+                breaker.record(True, time.monotonic() - start)
+                break
+            else:
+                raise error or ServicesUnavailableError(
+                    "All translation services are unavailable"
+                )
+            for i, translation in zip(missing, results):
+                translations[i] = translation
+        return translations
+
+    async def atranslate_batch(
+        self, texts: list[str], ignore_cache: bool = False
+    ) -> list[str]:
+        # 缓存查询不阻塞事件循环，译文由各服务的 atranslate_batch 在线程中写入
+        translations = await asyncio.to_thread(self.cached, texts, ignore_cache)
+        missing = [
+            i for i, translation in enumerate(translations) if translation is None
+        ]
+        if missing:
+            error = None
+            for translator, breaker in zip(self.translators, self.breakers):
+                if not breaker.allow():
+                    continue
+                start = time.monotonic()
+                try:
+                    results = await translator.atranslate_batch(
+                        [texts[i] for i in missing], ignore_cache=True
+                    )
+                except Exception as e:
+                    breaker.record(False)
+                    logger.warning(f"{translator.name} failed, falling back: {e}")
+                    error = e
+                    continue
+                breaker.record(True, time.monotonic() - start)
+                break
+            else:
+                raise error or ServicesUnavailableError(
+                    "All translation services are unavailable"
+                )
+            for i, translation in zip(missing, results):
+                translations[i] = translation
+        return translations
@@ -0,0 +1,71 @@
+"""
+The HTTP transport shared by the translators.
+
+A single requests session per process keeps connections, and with them TLS,
+alive between requests and between documents. Its connection pool per host
+grows to the number of concurrent translation requests, and every request
+gets the HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT config keys as timeouts
+unless it passes its own. The read timeout is capped by REQUEST_TIMEOUT, so
+a request abandoned at its deadline does not keep a connection for longer.
+"""
+
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pdf2zh.config import ConfigManager
+
+
+class Session(requests.Session):
+    """A requests session with default timeouts and a resizable pool."""
+
+    def __init__(self, pool_size: int = 10, timeout: Optional[tuple] = None):
+        super().__init__()
+        self.timeout = timeout
+        self.pool_size = 0
+        self.resize(pool_size)
+
+    def resize(self, pool_size: int) -> None:
+        """Grow the connection pool of every host to pool_size."""
+        if pool_size <= self.pool_size:
+            return
+        # 新的连接池替换旧的，旧连接池中的连接在请求结束后随之释放
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.pool_size = pool_size
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def request_timeout() -> float:
+    """The REQUEST_TIMEOUT config key, the deadline of a request, 0 for none."""
+    return float(ConfigManager.get("REQUEST_TIMEOUT", 0))
+
+
+_session: Optional[Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size: int = 0) -> Session:
+    """
+    Return the session shared by the whole process, with at least pool_size
+    connections per host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            timeout = (
+                float(ConfigManager.get("HTTP_CONNECT_TIMEOUT", 10)),
+                float(ConfigManager.get("HTTP_READ_TIMEOUT", 120)),
+            )
+            if deadline := request_timeout():
+                timeout = (timeout[0], min(timeout[1], deadline))
+            _session = Session(max(pool_size, 10), timeout)
+        else:
+            _session.resize(pool_size)
+        return _session
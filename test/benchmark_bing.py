@@ -0,0 +1,65 @@
+"""
+Compare the Bing translator with and without the cached session token.
+
+Translates paragraphs through a local stand-in for bing.com/translator that
+adds a fixed latency to every request, and reports the requests and time.
+
+    python test/benchmark_bing.py [--texts 200] [--threads 4] [--latency 0.02]
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+from test_translator import BingHandler
+
+from pdf2zh.translator import BingTranslator
+
+
+class SlowBingHandler(BingHandler):
+    latency = 0.0
+
+    def reply(self, body: str, content_type: str):
+        time.sleep(self.latency)
+        super().reply(body, content_type)
+
+
+def run(endpoint: str, server, texts: list[str], threads: int, ttl: float):
+    server.pages = server.posts = 0
+    server.tokens = set()
+    translator = BingTranslator("en", "zh", None, ignore_cache=True)
+    translator.endpoint = endpoint
+    translator.sid_ttl = ttl
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(translator.translate, texts))
+    return server.pages + server.posts, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds.")
+    args = parser.parse_args()
+
+    SlowBingHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowBingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}/translator"
+    texts = [f"Paragraph {i}." for i in range(args.texts)]
+
+    # sid_ttl 为 0 时每段都重新获取翻译页面，即缓存之前的行为
+    for name, ttl in [("uncached", 0), ("cached", BingTranslator.sid_ttl)]:
+        requests, elapsed = run(endpoint, server, texts, args.threads, ttl)
+        print(
+            f"{name}: {requests} requests, {elapsed:.2f} s, "
+            f"{elapsed / len(texts) * 1000:.1f} ms/paragraph"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
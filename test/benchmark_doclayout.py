@@ -0,0 +1,117 @@
+"""
+Compare the INT8 quantized layout model with the FP32 model.
+
+Reports the per-page latency of both models and how well their boxes agree
+(same class and IoU above the threshold) on the PDF files in test/file.
+
+    python test/benchmark_doclayout.py [--onnx model.onnx] [files ...]
+"""
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import numpy as np
+import pymupdf
+
+from pdf2zh.doclayout import OnnxModel, quantize_model
+from babeldoc.assets.assets import get_doclayout_onnx_model_path
+
+
+def render_pages(files: list[Path]) -> list[np.ndarray]:
+    images = []
+    for file in files:
+        for page in pymupdf.open(file):
+            pix = page.get_pixmap()
+            image = np.frombuffer(pix.samples, np.uint8).reshape(
+                pix.height, pix.width, 3
+            )[:, :, ::-1]
+            images.append(image)
+    return images
+
+
+def detect(model: OnnxModel, images: list[np.ndarray]):
+    results, latencies = [], []
+    for image in images:
+        start = time.perf_counter()
+        result = model.predict(image, imgsz=int(image.shape[0] / 32) * 32)[0]
+        latencies.append(time.perf_counter() - start)
+        results.append(result)
+    return results, latencies
+
+
+def iou(a, b) -> float:
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(x1 - x0, 0) * max(y1 - y0, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0
+
+
+def match(boxes_a, boxes_b, threshold: float):
+    """Greedily match boxes of the same class, return the IoU of each match."""
+    ious, used = [], set()
+    for a in boxes_a:
+        best, best_iou = None, threshold
+        for j, b in enumerate(boxes_b):
+            if j in used or int(a.cls) != int(b.cls):
+                continue
+            value = iou(a.xyxy, b.xyxy)
+            if value >= best_iou:
+                best, best_iou = j, value
+        if best is not None:
+            used.add(best)
+            ious.append(best_iou)
+    return ious
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("files", nargs="*", type=Path)
+    parser.add_argument("--onnx", type=str, help="FP32 onnx model path.")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU threshold.")
+    args = parser.parse_args()
+
+    files = args.files or sorted(
+        p for p in (Path(__file__).parent / "file").glob("*.pdf") if "-" not in p.stem
+    )
+    model_path = args.onnx or get_doclayout_onnx_model_path()
+    images = render_pages(files)
+    print(f"{len(images)} pages from {len(files)} files")
+
+    fp32 = OnnxModel(model_path)
+    int8 = OnnxModel(quantize_model(model_path))
+    # warm up
+    detect(fp32, images[:1])
+    detect(int8, images[:1])
+    results_fp32, latencies_fp32 = detect(fp32, images)
+    results_int8, latencies_int8 = detect(int8, images)
+
+    for name, latencies in [("fp32", latencies_fp32), ("int8", latencies_int8)]:
+        print(
+            f"{name}: mean {statistics.mean(latencies) * 1000:.1f} ms/page, "
+            f"median {statistics.median(latencies) * 1000:.1f} ms/page"
+        )
+    print(
+        f"speedup: {statistics.mean(latencies_fp32) / statistics.mean(latencies_int8):.2f}x"
+    )
+
+    matched = total_fp32 = total_int8 = 0
+    ious = []
+    for a, b in zip(results_fp32, results_int8):
+        page_ious = match(a.boxes, b.boxes, args.iou)
+        matched += len(page_ious)
+        total_fp32 += len(a.boxes)
+        total_int8 += len(b.boxes)
+        ious += page_ious
+    print(
+        f"boxes: fp32 {total_fp32}, int8 {total_int8}, matched {matched} "
+        f"(recall {matched / max(total_fp32, 1):.1%}, "
+        f"precision {matched / max(total_int8, 1):.1%}, "
+        f"mean IoU {statistics.mean(ious) if ious else 0:.3f})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
+import os
+import sqlite3
+import time
 import unittest
+from unittest import mock
+from peewee import SqliteDatabase
 from pdf2zh import cache
 import threading
 import multiprocessing
@@ -210,6 +215,494 @@ class TestCache(unittest.TestCase):
     #         expected = f"翻译_{text}"
     #         self.assertEqual(result, expected)
 
+    def test_digest_verified(self):
+        """Test that a digest collision does not return another text"""
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("hello", "你好")
+        cache.write_buffer.flush()
+        cache._TranslationCache.update(original_text="other").execute()
+        cache.memory_cache.clear()
+        self.assertIsNone(cache_instance.get("hello"))
+
+    def test_memory_cache(self):
+        """Test that repeated lookups are served from memory"""
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("hello", "你好")
+        cache.write_buffer.flush()
+        cache.memory_cache.clear()
+        self.assertEqual(cache_instance.get("hello"), "你好")
+        # 数据库中的记录被删除后仍然从内存返回
+        cache._TranslationCache.delete().execute()
+        self.assertEqual(cache_instance.get("hello"), "你好")
+        self.assertIsNone(cache_instance.get("world"))
+        stats = cache.memory_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_get_many(self):
+        """Test that texts missing in memory are fetched with one query"""
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("a", "A")
+        cache_instance.set("b", "B")
+        cache.write_buffer.flush()
+        cache.memory_cache.clear()
+        with mock.patch.object(
+            cache._TranslationCache, "select", wraps=cache._TranslationCache.select
+        ) as select:
+            self.assertEqual(
+                cache_instance.get_many(["a", "b", "c", "a"]), ["A", "B", None, "A"]
+            )
+            self.assertEqual(select.call_count, 1)
+            # 查到的译文进入内存
+            self.assertEqual(cache_instance.get_many(["a", "b"]), ["A", "B"])
+            self.assertEqual(select.call_count, 1)
+
+    def test_write_buffer(self):
+        """Test that translations are written in batches"""
+        cache_instance = cache.TranslationCache("test_engine")
+        with mock.patch.object(cache.write_buffer, "max_entries", 3):
+            cache_instance.set("a", "A")
+            cache_instance.set("b", "B")
+            self.assertEqual(cache._TranslationCache.select().count(), 0)
+            # 缓冲区中的译文在写入前也能查到
+            cache.memory_cache.clear()
+            self.assertEqual(cache_instance.get("a"), "A")
+            cache_instance.set("c", "C")
+            self.assertEqual(cache._TranslationCache.select().count(), 3)
+            cache_instance.set("d", "D")
+            cache.write_buffer.flush()
+            self.assertEqual(cache._TranslationCache.select().count(), 4)
+
+    def test_write_buffer_unlocked(self):
+        """Test that the buffer is usable while it is written"""
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("a", "A")
+        cache.memory_cache.clear()
+        seen = []
+
+        def set_many(rows):
+            self.assertFalse(cache.write_buffer.lock.locked())
+            seen.append(cache_instance.get("a"))
+
+        with mock.patch.object(cache.backend, "set_many", side_effect=set_many):
+            cache.write_buffer.flush()
+        self.assertEqual(seen, ["A"])
+
+    def test_write_buffer_error(self):
+        """Test that a failed write is logged"""
+        cache.TranslationCache("test_engine").set("a", "A")
+        with (
+            mock.patch.object(cache.backend, "set_many", side_effect=OSError),
+            self.assertLogs("pdf2zh.cache", "WARNING"),
+        ):
+            cache.write_buffer.flush()
+        self.assertEqual(cache.write_buffer.rows, {})
+        self.assertEqual(cache.write_buffer.writing, {})
+
+
+class TestEviction(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+        self.cache = cache.TranslationCache("test_engine")
+        for i in range(10):
+            self.cache.set(f"text{i}", "译文" * 100)
+        cache.write_buffer.flush()
+        cache.memory_cache.clear()
+
+    def tearDown(self):
+        cache.clean_test_db(self.test_db)
+
+    def age(self, seconds: float, texts: list[str]):
+        cache._TranslationCache.update(last_access=time.time() - seconds).where(
+            cache._TranslationCache.original_text.in_(texts)
+        ).execute()
+
+    def test_touch(self):
+        """Test that reads update the access time in batches"""
+        self.age(1000, ["text0"])
+        before = cache._TranslationCache.get(original_text="text0").last_access
+        self.assertEqual(self.cache.get("text0"), "译文" * 100)
+        self.assertEqual(
+            cache._TranslationCache.get(original_text="text0").last_access, before
+        )
+        cache.write_buffer.flush()
+        self.assertGreater(
+            cache._TranslationCache.get(original_text="text0").last_access,
+            time.time() - 10,
+        )
+
+    def test_prune_ttl(self):
+        self.age(2 * 86400, ["text0", "text1"])
+        self.assertEqual(cache.backend.prune(ttl=86400), 2)
+        self.assertIsNone(self.cache.get("text0"))
+        self.assertEqual(cache.backend.stats()["entries"], 8)
+
+    def test_prune_max_size(self):
+        # 最久未用的译文先被删除
+        self.age(100, ["text3"])
+        self.age(50, ["text5"])
+        stats = cache.backend.stats()
+        self.assertEqual(cache.backend.prune(max_size=stats["size"] - 1), 1)
+        self.assertIsNone(self.cache.get("text3"))
+        self.assertIsNotNone(self.cache.get("text5"))
+
+    def test_maintenance(self):
+        """Test that maintenance starts only when asked, after its delay"""
+        config = {"CACHE_TTL_DAYS": 1}
+        with (
+            mock.patch.object(
+                cache.ConfigManager, "get", lambda key, default=None: config.get(key, 0)
+            ),
+            mock.patch.object(cache.threading, "Thread") as thread,
+            mock.patch.object(cache, "_maintenance", None),
+        ):
+            cache.init_db()
+            thread.assert_not_called()
+            cache.start_maintenance(delay=60)
+            cache.start_maintenance(delay=60)
+            thread.assert_called_once()
+            kwargs = thread.call_args.kwargs
+        self.assertEqual(kwargs["args"], (86400, 0))
+        self.assertEqual(kwargs["kwargs"], {"delay": 60})
+
+        events = []
+
+        def sleep(seconds):
+            events.append(("sleep", seconds))
+            if len(events) > 2:
+                raise StopIteration
+
+        with (
+            mock.patch.object(cache.time, "sleep", sleep),
+            mock.patch.object(
+                cache.backend, "prune", lambda ttl, size: events.append("prune")
+            ),
+            self.assertRaises(StopIteration),
+        ):
+            cache.maintain(86400, 0, interval=3600, delay=60)
+        self.assertEqual(events, [("sleep", 60), "prune", ("sleep", 3600)])
+
+    def test_prune_layouts(self):
+        """Test that layouts expire and count toward the size limit"""
+        for i in range(200):
+            cache.LayoutCache.set(f"page{i}", {"boxes": [[0, 0, 1, 1, 0.5, 0]] * 50})
+        cache._LayoutCache.update(last_access=time.time() - 2 * 86400).where(
+            cache._LayoutCache.page_hash == "page0"
+        ).execute()
+        self.assertEqual(cache.backend.prune(ttl=86400), 1)
+        self.assertIsNone(cache.LayoutCache.get("page0"))
+
+        def used():
+            return (
+                cache.backend.pragma("page_count")
+                - cache.backend.pragma("freelist_count")
+            ) * cache.backend.pragma("page_size")
+
+        max_size = used() // 2
+        for _ in range(3):
+            cache.backend.prune(max_size=max_size)
+        self.assertLessEqual(used(), max_size)
+        self.assertGreater(cache.backend.stats()["entries"], 0)
+
+    def test_layout_touch(self):
+        cache.LayoutCache.set("page", {"boxes": []})
+        cache._LayoutCache.update(last_access=1000).execute()
+        cache.LayoutCache.get("page")
+        self.assertGreater(
+            cache._LayoutCache.get(page_hash="page").last_access, time.time() - 10
+        )
+
+    def test_compact(self):
+        cache.backend.prune(max_size=1)
+        cache.backend.compact()
+        stats = cache.backend.stats()
+        self.assertEqual((stats["entries"], stats["free"]), (0, 0))
+
+    def test_upgrade_schema(self):
+        """Test that a cache.v2.db without last_access gets the column"""
+        path = self.test_db.database + ".old"
+        old = sqlite3.connect(path)
+        old.execute(
+            "CREATE TABLE _translationcache (id INTEGER PRIMARY KEY, digest BLOB, "
+            "translate_engine VARCHAR(20), translate_engine_params TEXT, "
+            "original_text TEXT, translation TEXT)"
+        )
+        old.execute(
+            "CREATE TABLE _layoutcache (id INTEGER PRIMARY KEY, "
+            "page_hash VARCHAR(64), layout TEXT)"
+        )
+        old.commit()
+        old.close()
+        database = SqliteDatabase(path)
+        cache.upgrade_schema(database)
+        for table in ["_translationcache", "_layoutcache"]:
+            columns = [column.name for column in database.get_columns(table)]
+            self.assertIn("last_access", columns)
+        database.close()
+        os.remove(path)
+
+
+class FakeRedis:
+    """The part of the redis client used by RedisBackend."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.idle = {}
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        self.expiry[key] = ex
+
+    def expire(self, key, seconds):
+        self.expiry[key] = seconds
+
+    def scan_iter(self, match, count=None):
+        return [key for key in self.data if key.startswith(match.rstrip("*"))]
+
+    def object(self, infotype, key):
+        return self.idle.get(key, 0) if key in self.data else None
+
+    def memory_usage(self, key):
+        return len(key) + len(self.data[key]) if key in self.data else None
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def info(self, section):
+        return {"used_memory": 1000, "used_memory_rss": 1500}
+
+    def memory_purge(self):
+        pass
+
+    def pipeline(self, transaction=True):
+        client = self
+
+        class Pipeline:
+            def __init__(self):
+                self.commands = []
+
+            def set(self, key, value, ex=None):
+                self.commands.append((client.set, key, value, ex))
+
+            def expire(self, key, seconds):
+                self.commands.append((client.expire, key, seconds))
+
+            def object(self, infotype, key):
+                self.commands.append((client.object, infotype, key))
+
+            def memory_usage(self, key):
+                self.commands.append((client.memory_usage, key))
+
+            def execute(self):
+                return [command(*args) for command, *args in self.commands]
+
+        return Pipeline()
+
+
+class TestRedisBackend(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+        self.redis = FakeRedis()
+        backend = cache.RedisBackend(client=self.redis)
+        patcher = mock.patch.object(cache, "backend", backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cache.clean_test_db(self.test_db)
+
+    def test_shared(self):
+        """Test that workers share translations through redis"""
+        cache.TranslationCache("test_engine").set("hello", "你好")
+        cache.write_buffer.flush()
+        self.assertEqual(len(self.redis.data), 1)
+        self.assertEqual(cache._TranslationCache.select().count(), 0)
+        # 另一台机器上的进程
+        cache.memory_cache.clear()
+        other = cache.TranslationCache("test_engine")
+        self.assertEqual(other.get_many(["hello", "world"]), ["你好", None])
+        self.assertIsNone(cache.TranslationCache("other_engine").get("hello"))
+
+    def test_ttl(self):
+        """Test that translations expire a while after their last use"""
+        cache.backend.ttl = 60
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("hello", "你好")
+        cache.write_buffer.flush()
+        (key,) = self.redis.data
+        self.assertEqual(self.redis.expiry[key], 60)
+        self.redis.expiry[key] = 1
+        cache_instance.get("hello")
+        cache.write_buffer.flush()
+        self.assertEqual(self.redis.expiry[key], 60)
+
+    def test_stats(self):
+        cache_instance = cache.TranslationCache("test_engine")
+        cache_instance.set("a", "A")
+        cache_instance.set("b", "B")
+        cache.write_buffer.flush()
+        for key in self.redis.data:
+            self.redis.idle[key] = 60
+        stats = cache.backend.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(
+            stats["size"], sum(len(k) + len(v) for k, v in self.redis.data.items())
+        )
+        self.assertEqual(stats["free"], 500)
+        self.assertAlmostEqual(stats["oldest"], time.time() - 60, delta=1)
+        self.assertEqual(
+            cache.RedisBackend("redis://:secret@host:6379/0", self.redis).url,
+            "redis://host:6379/0",
+        )
+
+    def test_prune(self):
+        """Test that keys are pruned by their idle time"""
+        cache_instance = cache.TranslationCache("test_engine")
+        for i, text in enumerate("abcd"):
+            cache_instance.set(text, text.upper())
+            cache.write_buffer.flush()
+            self.redis.idle[list(self.redis.data)[-1]] = 100 * (4 - i)
+        self.assertEqual(cache.backend.prune(ttl=350), 1)
+        size = cache.backend.stats()["size"]
+        # 超出大小时先删除空闲最久的
+        self.assertEqual(cache.backend.prune(max_size=size - 1), 1)
+        cache.memory_cache.clear()
+        self.assertEqual(
+            cache_instance.get_many(["a", "b", "c", "d"]), [None, None, "C", "D"]
+        )
+
+    def test_unavailable(self):
+        """Test that an unreachable server counts as a miss"""
+        with mock.patch.object(self.redis, "mget", side_effect=ConnectionError):
+            self.assertIsNone(cache.TranslationCache("test_engine").get("hello"))
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_max_entries(self):
+        lru = cache.LRUCache(max_entries=2)
+        lru.set(b"a", "a", "A")
+        lru.set(b"b", "b", "B")
+        lru.get(b"a")
+        lru.set(b"c", "c", "C")
+        # b 最久未使用，被淘汰
+        self.assertIsNone(lru.get(b"b"))
+        self.assertEqual(lru.get(b"a"), ("a", "A"))
+        self.assertEqual(lru.get(b"c"), ("c", "C"))
+
+    def test_max_bytes(self):
+        lru = cache.LRUCache(max_bytes=10)
+        lru.set(b"a", "aa", "你好")  # 2 + 6 字节
+        lru.set(b"a", "aa", "AA")
+        self.assertEqual(lru.bytes, 4)
+        lru.set(b"b", "bbbb", "BBB")
+        self.assertIsNone(lru.get(b"a"))
+        self.assertEqual(lru.stats()["bytes"], 7)
+
+    def test_threads(self):
+        lru = cache.LRUCache(max_entries=50)
+
+        def worker(n):
+            for i in range(200):
+                key = f"{n}-{i}".encode()
+                lru.set(key, str(i), str(i))
+                lru.get(key)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = lru.stats()
+        self.assertEqual(stats["entries"], 50)
+        self.assertEqual(stats["hits"] + stats["misses"], 800)
+        self.assertEqual(
+            stats["bytes"], sum(entry[2] for entry in lru.entries.values())
+        )
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.folder = tempfile.mkdtemp()
+        self.v1_path = os.path.join(self.folder, "cache.v1.db")
+        self.v2_path = os.path.join(self.folder, "cache.v2.db")
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.folder)
+
+    def test_migrate_v1(self):
+        v1 = sqlite3.connect(self.v1_path)
+        v1.executescript(
+            """
+            CREATE TABLE _translationcache (
+                id INTEGER PRIMARY KEY, translate_engine VARCHAR(20),
+                translate_engine_params TEXT, original_text TEXT, translation TEXT,
+                UNIQUE (translate_engine, translate_engine_params, original_text)
+                ON CONFLICT REPLACE
+            );
+            INSERT INTO _translationcache VALUES (1, 'google', '{}', 'hello', '你好');
+            INSERT INTO _translationcache
+                VALUES (2, 'openai', '{"model": "gpt"}', 'hello', '您好');
+            """
+        )
+        v1.commit()
+        v1.close()
+        cache.migrate_v1(self.v1_path, self.v2_path)
+        self.assertEqual(
+            sorted(os.listdir(self.folder)), ["cache.v1.db", "cache.v2.db"]
+        )
+
+        test_db = SqliteDatabase(self.v2_path)
+        with test_db.bind_ctx([cache._TranslationCache, cache._LayoutCache]):
+            self.assertEqual(cache.TranslationCache("google").get("hello"), "你好")
+            openai = cache.TranslationCache("openai", {"model": "gpt"})
+            self.assertEqual(openai.get("hello"), "您好")
+            self.assertIsNone(cache.LayoutCache.get("page"))
+        test_db.close()
+
+
+class TestLayoutCache(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+
+    def tearDown(self):
+        cache.clean_test_db(self.test_db)
+
+    def test_set_get(self):
+        layout = {
+            "height": 842,
+            "width": 595,
+            "boxes": [[1.5, 2.0, 100.0, 200.0, 0.9, 1.0]],
+            "names": {"1": "plain text"},
+        }
+        self.assertIsNone(cache.LayoutCache.get("page"))
+        cache.LayoutCache.set("page", layout)
+        self.assertEqual(cache.LayoutCache.get("page"), layout)
+
+    def test_overwrite(self):
+        cache.LayoutCache.set("page", {"boxes": []})
+        cache.LayoutCache.set("page", {"boxes": [[0, 0, 1, 1, 0.5, 0]]})
+        self.assertEqual(
+            cache.LayoutCache.get("page"), {"boxes": [[0, 0, 1, 1, 0.5, 0]]}
+        )
+
+    def test_errors(self):
+        """Test that a broken layout cache is treated as a miss"""
+        cache._LayoutCache.create(page_hash="page", layout="{", last_access=0)
+        self.assertIsNone(cache.LayoutCache.get("page"))
+        cache._LayoutCache.create(page_hash="page", layout="[]", last_access=0)
+        self.assertIsNone(cache.LayoutCache.get("page"))
+        self.test_db.execute_sql("DROP TABLE _layoutcache")
+        self.assertIsNone(cache.LayoutCache.get("page"))
+        self.test_db.create_tables([cache._LayoutCache])
+
 
 if __name__ == "__main__":
     unittest.main()
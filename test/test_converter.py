@@ -1,8 +1,17 @@
+import asyncio
+import threading
 import unittest
-from unittest.mock import Mock, patch, MagicMock
+import numpy as np
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
 from pdfminer.layout import LTPage, LTChar, LTLine
 from pdfminer.pdfinterp import PDFResourceManager
-from pdf2zh.converter import PDFConverterEx, TranslateConverter
+from pdf2zh.converter import (
+    AsyncExecutor,
+    PDFConverterEx,
+    PendingOps,
+    TranslateConverter,
+)
 
 
 class TestPDFConverterEx(unittest.TestCase):
@@ -87,13 +96,11 @@ class TestTranslateConverter(unittest.TestCase):
         ltline = LTLine(0.1, (0, 0), (10, 20))
         ltpage.add(ltchar)
         ltpage.add(ltline)
-        mock_layout = MagicMock()
-        mock_layout.shape = (100, 100)
-        mock_layout.__getitem__.return_value = -1
-        self.converter.layout = [None, mock_layout]
+        self.converter.layout = [None, np.ones((100, 100), dtype=np.uint8)]
         self.converter.thread = 1
         result = self.converter.receive_layout(ltpage)
         self.assertIsNotNone(result)
+        self.assertIsInstance(result.result(timeout=10), str)
 
     def test_invalid_translation_service(self):
         with self.assertRaises(ValueError):
@@ -106,5 +113,67 @@ class TestTranslateConverter(unittest.TestCase):
             )
 
 
+class TestPendingOps(unittest.TestCase):
+    def test_result(self):
+        futures = [Future(), Future()]
+        ops = PendingOps(futures, lambda news: "".join(news)).then(str.upper)
+        futures[1].set_result("b")
+        self.assertFalse(ops.done())
+        with self.assertRaises(TimeoutError):
+            ops.result(timeout=0.01)
+        futures[0].set_result("a")
+        self.assertEqual(ops.result(), "AB")
+
+    def test_typeset_in_calling_thread(self):
+        future = Future()
+        threads = []
+        ops = PendingOps([future], lambda _: threads.append(threading.get_ident()))
+        threading.Thread(target=future.set_result, args=("a",)).start()
+        ops.result(timeout=10)
+        self.assertEqual(threads, [threading.get_ident()])
+
+    def test_empty(self):
+        self.assertEqual(PendingOps([], len).result(), 0)
+
+    def test_exception(self):
+        future = Future()
+        ops = PendingOps([future], lambda news: news)
+        future.set_exception(ValueError("error"))
+        with self.assertRaises(ValueError):
+            ops.result()
+
+    def test_catch(self):
+        def fail(_):
+            raise ValueError("error")
+
+        self.assertIsNone(PendingOps([], fail).catch(None).result())
+
+
+class TestAsyncExecutor(unittest.TestCase):
+    def test_submit(self):
+        executor = AsyncExecutor(max_workers=2)
+        running = peak = 0
+
+        async def work(value):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return value * 2
+
+        futures = [executor.submit(work, i) for i in range(6)]
+        self.assertEqual([f.result(timeout=10) for f in futures], [0, 2, 4, 6, 8, 10])
+        self.assertEqual(peak, 2)
+        executor.shutdown()
+        self.assertTrue(executor.loop.is_closed())
+
+    def test_shutdown_cancel_futures(self):
+        executor = AsyncExecutor(max_workers=1)
+        future = executor.submit(asyncio.sleep, 60)
+        executor.shutdown(cancel_futures=True)
+        self.assertTrue(future.cancelled())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,24 +1,24 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 import numpy as np
+import onnxruntime
 from pdf2zh.doclayout import (
     OnnxModel,
     YoloResult,
+    quantize_model,
     YoloBox,
 )
 
 
 class TestOnnxModel(unittest.TestCase):
-    @patch("onnx.load")
     @patch("onnxruntime.InferenceSession")
-    def setUp(self, mock_inference_session, mock_onnx_load):
+    def setUp(self, mock_inference_session):
         # Mock ONNX model metadata
-        mock_model = MagicMock()
-        mock_model.metadata_props = [
-            MagicMock(key="stride", value="32"),
-            MagicMock(key="names", value="['class1', 'class2']"),
-        ]
-        mock_onnx_load.return_value = mock_model
+        mock_inference_session.return_value.get_modelmeta.return_value = MagicMock(
+            custom_metadata_map={"stride": "32", "names": "['class1', 'class2']"}
+        )
 
         # Initialize OnnxModel with a fake path
         self.model_path = "fake_model_path.onnx"
@@ -28,6 +28,41 @@ class TestOnnxModel(unittest.TestCase):
         # Test that stride is correctly set from model metadata
         self.assertEqual(self.model.stride, 32)
 
+    @patch("pdf2zh.doclayout.OnnxModel.__init__", return_value=None)
+    def test_reduce(self, mock_init):
+        # The session is not picklable, the model is reloaded from its path
+        cls, args = self.model.__reduce__()
+        self.assertIs(cls, OnnxModel)
+        self.assertEqual(args[0], self.model_path)
+        cls(*args)
+        mock_init.assert_called_once_with(*args)
+
+    def test_optimized_model_path(self):
+        # A model that is not a local file is not cached
+        self.assertIsNone(self.model.optimized_model_path())
+
+    @patch("onnxruntime.InferenceSession")
+    def test_session_options(self, mock_inference_session):
+        mock_inference_session.return_value.get_modelmeta.return_value = MagicMock(
+            custom_metadata_map={"stride": "32", "names": "['class1', 'class2']"}
+        )
+        OnnxModel(
+            self.model_path,
+            graph_optimization_level="basic",
+            intra_op_num_threads=2,
+            inter_op_num_threads=1,
+            execution_mode="parallel",
+        )
+        path, options = mock_inference_session.call_args.args
+        self.assertEqual(path, self.model_path)
+        self.assertEqual(
+            options.graph_optimization_level,
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        )
+        self.assertEqual(options.intra_op_num_threads, 2)
+        self.assertEqual(options.inter_op_num_threads, 1)
+        self.assertEqual(options.execution_mode, onnxruntime.ExecutionMode.ORT_PARALLEL)
+
     def test_resize_and_pad_image(self):
         # Create a dummy image (100x200)
         image = np.ones((100, 200, 3), dtype=np.uint8)
@@ -70,6 +105,64 @@ class TestOnnxModel(unittest.TestCase):
         self.assertGreater(len(results[0].boxes), 0)
         self.assertIsInstance(results[0].boxes[0], YoloBox)
 
+    def test_predict_batch(self):
+        self.model.model.get_inputs.return_value = [MagicMock(shape=["batch", 3])]
+        self.model.model.run.side_effect = lambda _, feed: [
+            np.random.random((len(feed["images"]), 300, 6))
+        ]
+        images = [
+            np.ones((500, 300, 3), dtype=np.uint8),
+            np.ones((400, 600, 3), dtype=np.uint8),
+            np.ones((500, 300, 3), dtype=np.uint8),
+        ]
+
+        results = self.model.predict_batch(images, imgsz=[480, 384, 480])
+
+        # Pages with the same letterboxed shape share one run
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(r, YoloResult) for r in results))
+        batches = [
+            c.args[1]["images"].shape for c in self.model.model.run.call_args_list
+        ]
+        self.assertEqual(batches, [(2, 3, 480, 288), (1, 3, 256, 384)])
+
+    def test_predict_batch_fixed_batch_size(self):
+        self.model.model.get_inputs.return_value = [MagicMock(shape=[1, 3])]
+        self.model.model.run.return_value = [np.random.random((1, 300, 6))]
+        images = [np.ones((500, 300, 3), dtype=np.uint8)] * 3
+
+        results = self.model.predict_batch(images, imgsz=480)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.model.model.run.call_count, 3)
+
+
+class TestQuantizeModel(unittest.TestCase):
+    def test_quantized_model_is_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            model_path = os.path.join(tmp, "model.onnx")
+            with open(model_path, "wb") as f:
+                f.write(b"model")
+
+            def quantize_dynamic(model_input, model_output, **kwargs):
+                with open(model_output, "wb") as f:
+                    f.write(b"quantized")
+
+            with (
+                patch("os.path.expanduser", return_value=tmp),
+                patch(
+                    "onnxruntime.quantization.quantize_dynamic",
+                    side_effect=quantize_dynamic,
+                ) as mock_quantize,
+            ):
+                path = quantize_model(model_path)
+                self.assertEqual(quantize_model(model_path), path)
+
+            self.assertTrue(path.endswith(".int8.onnx"))
+            self.assertEqual(mock_quantize.call_count, 1)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"quantized")
+
 
 class TestYoloResult(unittest.TestCase):
     def test_yolo_result(self):
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from pdf2zh.hedge import DaemonExecutor, LatencyTracker, acall_hedged, call_hedged
+
+
+def warm(latency: LatencyTracker, value: float = 0.01) -> LatencyTracker:
+    for _ in range(latency.min_samples):
+        latency.add(value)
+    return latency
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_percentile(self):
+        latency = LatencyTracker(size=100, min_samples=10)
+        for i in range(9):
+            latency.add(i)
+        self.assertIsNone(latency.percentile(0.95))
+        for i in range(9, 100):
+            latency.add(i)
+        self.assertEqual(latency.percentile(0.95), 95)
+        self.assertEqual(latency.percentile(1), 99)
+
+
+class TestCallHedged(unittest.TestCase):
+    def test_no_hedge(self):
+        latency = LatencyTracker()
+        self.assertEqual(call_hedged(lambda: "a", None, latency), "a")
+        self.assertEqual(len(latency.samples), 1)
+
+    def test_hedge_wins(self):
+        stalled = threading.Event()
+        latency = warm(LatencyTracker())
+        result = call_hedged(
+            lambda: stalled.wait(10) or "slow", lambda: "fast", latency
+        )
+        self.assertEqual(result, "fast")
+        stalled.set()
+
+    def test_not_hedged_before_warm_up(self):
+        calls = []
+        result = call_hedged(
+            lambda: time.sleep(0.05) or "slow",
+            lambda: calls.append(1) or "fast",
+            LatencyTracker(),
+        )
+        self.assertEqual(result, "slow")
+        self.assertEqual(calls, [])
+
+    def test_timeout(self):
+        stalled = threading.Event()
+        with self.assertRaises(TimeoutError):
+            call_hedged(lambda: stalled.wait(10), None, LatencyTracker(), 0.05)
+        stalled.set()
+
+    def test_error(self):
+        def fail():
+            raise ValueError("error")
+
+        with self.assertRaises(ValueError):
+            call_hedged(fail, lambda: "hedge", LatencyTracker())
+
+    def test_primary_fails_after_hedge(self):
+        def fail():
+            time.sleep(0.05)
+            raise ValueError("error")
+
+        latency = warm(LatencyTracker())
+        self.assertEqual(
+            call_hedged(fail, lambda: time.sleep(0.1) or "hedge", latency), "hedge"
+        )
+
+
+class TestDaemonExecutor(unittest.TestCase):
+    def test_bounded(self):
+        executor = DaemonExecutor(2)
+        release = threading.Event()
+        running = []
+
+        def work(i):
+            running.append(i)
+            release.wait(10)
+            return i
+
+        futures = [executor.submit(work, i) for i in range(4)]
+        time.sleep(0.05)
+        self.assertEqual(sorted(running), [0, 1])
+        release.set()
+        self.assertEqual([future.result(1) for future in futures], [0, 1, 2, 3])
+        self.assertEqual(executor.threads, 2)
+        executor.shutdown()
+
+    def test_loser_cancelled(self):
+        # 线程池已满时对冲请求排队，超时后取消，不再发出
+        executor = DaemonExecutor(1)
+        stalled = threading.Event()
+        calls = []
+        with self.assertRaises(TimeoutError):
+            call_hedged(
+                lambda: stalled.wait(10),
+                lambda: calls.append(1),
+                warm(LatencyTracker()),
+                0.1,
+                executor,
+            )
+        stalled.set()
+        time.sleep(0.05)
+        self.assertEqual(calls, [])
+        executor.shutdown()
+
+
+class TestAcallHedged(unittest.TestCase):
+    def test_hedge_wins_and_cancels(self):
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def fast():
+            return "fast"
+
+        latency = warm(LatencyTracker())
+        result = asyncio.run(acall_hedged(slow, fast, latency))
+        self.assertEqual(result, "fast")
+        self.assertEqual(cancelled, [True])
+
+    def test_timeout(self):
+        async def slow():
+            await asyncio.sleep(10)
+
+        with self.assertRaises(TimeoutError):
+            asyncio.run(acall_hedged(slow, None, LatencyTracker(), 0.05))
+
+
+if __name__ == "__main__":
+    unittest.main()
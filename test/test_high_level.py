@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pymupdf
+from pymupdf import Document
+
+from pdf2zh import high_level
+from pdf2zh.config import ConfigManager
+from pdf2zh.high_level import page_hash
+
+
+class TestPageHash(unittest.TestCase):
+    def setUp(self):
+        self.doc = Document()
+        for i in range(3):
+            page = self.doc.new_page()
+            page.insert_text((72, 72), f"page {i}")
+        # 第一页链接到第三页
+        self.doc[0].insert_link(
+            {
+                "kind": 1,
+                "from": pymupdf.Rect(0, 0, 100, 100),
+                "page": 2,
+                "to": pymupdf.Point(0, 0),
+            }
+        )
+        self.doc = Document("pdf", self.doc.tobytes())
+
+    def test_stable(self):
+        self.assertEqual(
+            page_hash(self.doc, 0, "model"), page_hash(self.doc, 0, "model")
+        )
+        self.assertNotEqual(
+            page_hash(self.doc, 0, "model"), page_hash(self.doc, 0, "other")
+        )
+        self.assertNotEqual(
+            page_hash(self.doc, 0, "model"), page_hash(self.doc, 1, "model")
+        )
+
+    def test_link_target_ignored(self):
+        before = page_hash(self.doc, 0, "model")
+        self.doc[2].insert_text((72, 144), "edited")
+        self.assertNotEqual(before, page_hash(self.doc, 2, "model"))
+        self.assertEqual(before, page_hash(self.doc, 0, "model"))
+
+    def test_contents_change(self):
+        before = page_hash(self.doc, 0, "model")
+        self.doc[0].insert_text((72, 144), "edited")
+        self.assertNotEqual(before, page_hash(self.doc, 0, "model"))
+
+    def test_memo(self):
+        memo = {}
+        keys = [page_hash(self.doc, i, "model", memo) for i in range(3)]
+        self.assertEqual(keys, [page_hash(self.doc, i, "model") for i in range(3)])
+        self.assertTrue(memo)
+
+
+class TestInitWorker(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"CACHE_BACKEND": "sqlite", "REQUEST_TIMEOUT": 7}, f)
+
+    def tearDown(self):
+        # 恢复默认配置文件
+        ConfigManager._instance = None
+        os.remove(self.path)
+
+    def test_config(self):
+        """Test that workers read the config file of the main process"""
+        with (
+            mock.patch.object(high_level, "init_db") as init_db,
+            mock.patch.object(high_level, "Document"),
+            mock.patch.object(high_level, "Font"),
+        ):
+            high_level._init_worker(b"", "", None, {"noto_name": ""}, self.path)
+            self.assertEqual(str(ConfigManager.path()), self.path)
+            self.assertEqual(ConfigManager.get("REQUEST_TIMEOUT"), 7)
+            init_db.assert_called_once()
+            # 配置文件相同时不重新初始化缓存
+            high_level._init_worker(b"", "", None, {"noto_name": ""}, self.path)
+            init_db.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import Mock
+from pdfminer.pdfinterp import PDFResourceManager
+from pdf2zh.pdfinterp import PDFPageInterpreterEx, TIRO_FONT
+
+
+class TestInjectFonts(unittest.TestCase):
+    def setUp(self):
+        self.interpreter = PDFPageInterpreterEx(
+            PDFResourceManager(), Mock(), {}, {"tiro": TIRO_FONT}
+        )
+
+    def test_page_resources(self):
+        resources = self.interpreter.inject_fonts({}, force=True)
+        self.assertEqual(resources["Font"], {"tiro": TIRO_FONT})
+
+    def test_xobject_without_font(self):
+        resources = {"ProcSet": []}
+        self.assertIs(self.interpreter.inject_fonts(resources), resources)
+
+    def test_existing_font_wins(self):
+        resources = {"Font": {"tiro": "original", "F1": "f1"}}
+        injected = self.interpreter.inject_fonts(resources)
+        self.assertEqual(injected["Font"], {"tiro": "original", "F1": "f1"})
+        self.assertEqual(resources["Font"], {"tiro": "original", "F1": "f1"})
+
+    def test_no_fonts(self):
+        interpreter = PDFPageInterpreterEx(PDFResourceManager(), Mock(), {})
+        resources = {}
+        self.assertIs(interpreter.inject_fonts(resources, force=True), resources)
+
+    def test_tiro_font(self):
+        font = PDFResourceManager().get_font(None, TIRO_FONT)
+        self.assertEqual(font.to_unichr(ord("a")), "a")
+
+
+if __name__ == "__main__":
+    unittest.main()
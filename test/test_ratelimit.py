@@ -0,0 +1,179 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pdf2zh import ratelimit
+from pdf2zh.ratelimit import (
+    AdaptiveConcurrency,
+    RateLimiter,
+    SharedTokenBucket,
+    TokenBucket,
+    is_overload,
+)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # 桶已空，后来者依次排队
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=100, capacity=1)
+        bucket.reserve()
+        time.sleep(0.02)
+        self.assertEqual(bucket.reserve(), 0)
+
+    @mock.patch("pdf2zh.ratelimit.time.monotonic", return_value=100.0)
+    def test_threads(self, _):
+        bucket = TokenBucket(rate=1000, capacity=1)
+        delays = []
+
+        def take():
+            for _ in range(50):
+                delays.append(bucket.reserve())
+
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 200 次请求按 1000/s 排开，最后一个约等待 0.2 秒
+        self.assertAlmostEqual(max(delays), 0.199)
+
+
+class TestSharedTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix=".db")
+        ratelimit.init_shared_db(self.path)
+
+    def tearDown(self):
+        ratelimit.shared_db.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    @mock.patch("pdf2zh.ratelimit.time.time", return_value=100.0)
+    def test_shared(self, _):
+        a = SharedTokenBucket("test", rate=10, capacity=1)
+        b = SharedTokenBucket("test", rate=10, capacity=1)
+        self.assertEqual(a.reserve(), 0)
+        self.assertAlmostEqual(b.reserve(), 0.1, places=2)
+        self.assertEqual(SharedTokenBucket("other", rate=10).reserve(), 0)
+
+    def test_aacquire_off_loop(self):
+        limiter = RateLimiter("test", rps=10, shared=True)
+        threads = []
+        reserve = limiter.requests.reserve
+
+        def record(amount=1):
+            threads.append(threading.current_thread())
+            return reserve(amount)
+
+        limiter.requests.reserve = record
+        asyncio.run(limiter.aacquire())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_reserve(self):
+        limiter = RateLimiter("test", rps=10, tpm=600)
+        self.assertEqual(limiter.reserve(5), 0)
+        # 每秒 10 个 token，再取 10 个需要等待约 0.5 秒
+        self.assertAlmostEqual(limiter.reserve(10), 0.5, places=2)
+
+    def test_get_rate_limiter(self):
+        limits = {"test-service": {"rps": 5}}
+        with (
+            mock.patch.object(ratelimit, "_limiters", {}),
+            mock.patch.object(ratelimit.ConfigManager, "get", return_value=limits),
+        ):
+            limiter = ratelimit.get_rate_limiter("test-service")
+            self.assertEqual(limiter.requests.rate, 5)
+            self.assertIsNone(limiter.tokens)
+            self.assertIs(ratelimit.get_rate_limiter("test-service"), limiter)
+            self.assertIsNone(ratelimit.get_rate_limiter("other"))
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_is_overload(self):
+        self.assertTrue(is_overload(HTTPError(429)))
+        self.assertTrue(is_overload(HTTPError(503)))
+        self.assertFalse(is_overload(HTTPError(400)))
+        self.assertTrue(is_overload(TimeoutError()))
+        self.assertFalse(is_overload(ValueError()))
+
+    def test_aimd(self):
+        concurrency = AdaptiveConcurrency(max_limit=8)
+        with mock.patch("pdf2zh.ratelimit.time.monotonic", return_value=1.0):
+            # 慢启动：每次成功加一
+            for _ in range(5):
+                concurrency.release(concurrency.acquire())
+            self.assertEqual(concurrency.limit, 6)
+            start = [concurrency.acquire() for _ in range(3)]
+            # 同一轮的多个失败只减半一次
+            for s in start:
+                concurrency.release(s, HTTPError(429))
+            self.assertEqual(concurrency.limit, 3)
+            # 拥塞避免：每个请求加 1 / limit
+            concurrency.release(concurrency.acquire())
+        self.assertAlmostEqual(concurrency.limit, 3 + 1 / 3)
+        self.assertEqual(concurrency.inflight, 0)
+
+    def test_max_limit(self):
+        concurrency = AdaptiveConcurrency(max_limit=2)
+        for _ in range(5):
+            concurrency.release(concurrency.acquire())
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_try_request(self):
+        concurrency = AdaptiveConcurrency(max_limit=1)
+        with concurrency.request():
+            with concurrency.try_request() as acquired:
+                self.assertFalse(acquired)
+            self.assertEqual(concurrency.inflight, 1)
+        with concurrency.try_request() as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(concurrency.inflight, 1)
+        self.assertEqual(concurrency.inflight, 0)
+
+    def test_slow_requests(self):
+        concurrency = AdaptiveConcurrency(max_limit=8)
+        with mock.patch("pdf2zh.ratelimit.time.monotonic", side_effect=[0, 1, 1, 5]):
+            concurrency.release(concurrency.acquire())
+            concurrency.release(concurrency.acquire())  # 延迟超过 3 倍，不增加
+        self.assertEqual(concurrency.limit, 2)
+        self.assertAlmostEqual(concurrency.latency, 0.8 * 1 + 0.2 * 4)
+
+    def test_aacquire(self):
+        concurrency = AdaptiveConcurrency(max_limit=1)
+        order = []
+
+        async def request(i):
+            async with concurrency.arequest():
+                order.append(("start", i))
+                await asyncio.sleep(0.01)
+                order.append(("end", i))
+
+        async def main():
+            await asyncio.gather(request(0), request(1))
+
+        asyncio.run(main())
+        self.assertEqual(order, [("start", 0), ("end", 0), ("start", 1), ("end", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,32 @@
+import asyncio
+import json
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from textwrap import dedent
 from unittest import mock
 
+import openai
 from ollama import ResponseError as OllamaResponseError
 
 from pdf2zh import cache
 from pdf2zh.config import ConfigManager
-from pdf2zh.translator import BaseTranslator, OllamaTranslator, OpenAIlikedTranslator
+from pdf2zh.ratelimit import AdaptiveConcurrency
+from pdf2zh.translator import (
+    BaseTranslator,
+    BingTranslator,
+    CircuitBreaker,
+    ClientPool,
+    FallbackTranslator,
+    OllamaTranslator,
+    OpenAIlikedTranslator,
+    QwenMtTranslator,
+    ServicesUnavailableError,
+    ZhipuTranslator,
+    split_endpoints,
+    split_text,
+)
 
 # Since it is necessary to test whether the functionality meets the expected requirements,
 # private functions and private methods are allowed to be called.
@@ -82,6 +102,132 @@ class TestTranslator(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             translator.translate("Hello World")
 
+    def test_translate_batch_fallback(self):
+        translator = AutoIncreaseTranslator("en", "zh", "test", False)
+        self.assertEqual(translator.translate_batch(["a", "b", "a"]), ["1", "2", "3"])
+        # Cached texts are not sent again
+        self.assertEqual(translator.translate_batch(["b", "c"]), ["2", "4"])
+        self.assertEqual(translator.translate("c"), "4")
+
+    def test_translate_batch(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        translator.translate("b")
+        texts = ["a", "b", "ccc", "dd", "e"]
+        self.assertEqual(
+            translator.translate_batch(texts), ["A", "B", "CCC", "DD", "E"]
+        )
+        # "b" comes from the cache, the rest is split by batch_size and batch_chars
+        self.assertEqual(translator.batches, [["b"], ["a", "ccc"], ["dd", "e"]])
+        self.assertEqual(translator.translate("dd", ignore_cache=False), "DD")
+
+    def test_atranslate_batch(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        self.assertEqual(
+            asyncio.run(translator.atranslate_batch(["a", "b", "c"])), ["A", "B", "C"]
+        )
+        self.assertEqual(asyncio.run(translator.atranslate("a")), "A")
+        self.assertEqual(translator.batches, [["a", "b", "c"]])
+
+    def test_hedge(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        translator.do_translate_batch = lambda texts: time.sleep(10)
+        translator.hedge = HedgeTranslator("en", "zh", "test", False)
+        for _ in range(translator.latency.min_samples):
+            translator.latency.add(0.01)
+        self.assertEqual(translator.translate_batch(["a", "b"]), ["A", "B"])
+        self.assertEqual(translator.hedge.batches, [["a", "b"]])
+        # 对冲服务的译文缓存在对冲服务下
+        self.assertEqual(translator.cache.get_many(["a", "b"]), [None, None])
+        self.assertEqual(translator.hedge.cache.get_many(["a", "b"]), ["A", "B"])
+
+    def hedge_same_service(self, limit: int) -> list[list[str]]:
+        translator = BatchTranslator("en", "zh", "test", False)
+        translator.hedge = translator
+        translator.concurrency = AdaptiveConcurrency(4)
+        translator.concurrency.limit = limit
+        stalled = threading.Event()
+        calls = []
+
+        def do_translate_batch(texts):
+            calls.append(texts)
+            if len(calls) == 1:
+                stalled.wait(0.5)
+            return [text.upper() for text in texts]
+
+        translator.do_translate_batch = do_translate_batch
+        for _ in range(translator.latency.min_samples):
+            translator.latency.add(0.01)
+        self.assertEqual(translator.translate_batch(["a", "b"]), ["A", "B"])
+        stalled.set()
+        time.sleep(0.1)  # 等待可能仍在发送的对冲请求
+        # 译文是本服务的，照常缓存
+        self.assertEqual(translator.cache.get_many(["a", "b"]), ["A", "B"])
+        self.assertEqual(translator.concurrency.inflight, 0)
+        return calls
+
+    def test_hedge_same_service(self):
+        # 对冲请求另占一个并发名额
+        self.assertEqual(len(self.hedge_same_service(2)), 2)
+
+    def test_hedge_same_service_saturated(self):
+        # 没有空闲名额时不对冲，不等待主请求释放名额后再重复发送
+        self.assertEqual(len(self.hedge_same_service(1)), 1)
+
+    def test_timeout(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        translator.do_translate_batch = lambda texts: time.sleep(10)
+        translator.timeout = 0.05
+        with self.assertRaises(TimeoutError):
+            translator.translate("a")
+
+    def test_split_batches(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        self.assertEqual(
+            translator.split_batches(["a", "bb", "ccc", "d", "e", "f"]),
+            [[0, 1], [2, 3], [4, 5]],
+        )
+
+    def test_split_text(self):
+        text = "First sentence. Second one! {v0} and {v12} third; fourth。第五句。"
+        chunks = split_text(text, 20)
+        self.assertEqual("".join(chunks), text)
+        self.assertTrue(all(len(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(chunks[0], "First sentence. ")
+        # 没有句子边界时在空格处切开，且不切断公式占位符
+        chunks = split_text("aaaa {v10} bbbb {v11}cccc", 8)
+        self.assertEqual("".join(chunks), "aaaa {v10} bbbb {v11}cccc")
+        for chunk in chunks:
+            self.assertEqual(chunk.count("{"), chunk.count("}"))
+        self.assertEqual(split_text("short", 20), ["short"])
+
+    def test_translate_long_text(self):
+        translator = BatchTranslator("en", "zh", "test", False)
+        translator.max_text_length = 4
+        self.assertEqual(
+            translator.translate_batch(["ab. cd. ef", "g"]), ["AB. CD. EF", "G"]
+        )
+        # 各块分别发送和缓存
+        self.assertEqual(translator.batches, [["ab. "], ["cd. "], ["ef", "g"]])
+        self.assertEqual(translator.translate("cd. "), "CD. ")
+
+
+class BatchTranslator(BaseTranslator):
+    name = "batch"
+    batch_size = 3
+    batch_chars = 4
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.batches = []
+
+    def do_translate_batch(self, texts):
+        self.batches.append(texts)
+        return [text.upper() for text in texts]
+
+
+class HedgeTranslator(BatchTranslator):
+    name = "hedge"
+
 
 class TestOpenAIlikedTranslator(unittest.TestCase):
     def setUp(self) -> None:
@@ -152,6 +298,434 @@ class TestOpenAIlikedTranslator(unittest.TestCase):
         self.assertIsNone(translator.envs["OPENAILIKED_API_KEY"])
 
 
+def chat_response(content):
+    response = mock.Mock()
+    response.choices = [mock.Mock()]
+    response.choices[0].message.content = content
+    return response
+
+
+class TestPackedTranslation(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+        ConfigManager.clear()
+        ConfigManager.set("LLM_PACK_TOKENS", 1000)
+        self.translator = OpenAIlikedTranslator(
+            lang_in="en",
+            lang_out="zh",
+            model=None,
+            envs={
+                "OPENAILIKED_BASE_URL": "https://api.openailiked.com",
+                "OPENAILIKED_API_KEY": "test_api_key",
+                "OPENAILIKED_MODEL": "test_model",
+            },
+            ignore_cache=True,
+        )
+        self.translator.client = mock.Mock()
+        self.create = self.translator.client.chat.completions.create
+
+    def tearDown(self):
+        ConfigManager.clear()
+        cache.clean_test_db(self.test_db)
+
+    def test_packing_disabled(self):
+        translator = QwenMtTranslator(
+            "en", "zh", "qwen-mt-turbo", envs={"ALI_API_KEY": "test_api_key"}
+        )
+        self.assertFalse(translator.packing)
+        self.assertEqual(translator.batch_size, 1)
+        self.translator.prompttext = "custom"
+        self.assertFalse(self.translator.packing)
+
+    def test_split_batches(self):
+        self.translator.pack_tokens = 10
+        self.assertEqual(
+            self.translator.split_batches(["a" * 16, "b" * 16, "c" * 36, "d"]),
+            [[0, 1], [2], [3]],
+        )
+
+    def test_translate_packed(self):
+        self.create.return_value = chat_response(
+            '<think>\n...\n</think>\n```json\n{"1": "甲 {v0}", "2": "乙 {v1}"}\n```'
+        )
+        self.assertEqual(
+            self.translator.translate_batch(["a {v0}", "b {v1}"]),
+            ["甲 {v0}", "乙 {v1}"],
+        )
+        self.assertEqual(self.create.call_count, 1)
+        self.assertIn('{"1": "a {v0}", "2": "b {v1}"}', str(self.create.call_args))
+
+    def test_retry_failed_segments(self):
+        # 第一次丢失公式占位符和第三段，第二次只重新请求失败的两段
+        self.create.side_effect = [
+            chat_response('{"1": "甲", "2": "乙"}'),
+            chat_response('{"1": "甲 {v0}", "2": "丙"}'),
+        ]
+        self.assertEqual(
+            self.translator.translate_batch(["a {v0}", "b", "c"]),
+            ["甲 {v0}", "乙", "丙"],
+        )
+        self.assertIn('{"1": "a {v0}", "2": "c"}', str(self.create.call_args))
+
+    def test_rewritten_placeholder(self):
+        self.create.side_effect = [
+            chat_response('{"1": "甲 {{v0}}", "2": "乙"}'),
+            chat_response("甲 {v0}"),
+        ]
+        self.assertEqual(
+            self.translator.translate_batch(["a {v0}", "b"]), ["甲 {v0}", "乙"]
+        )
+        self.assertEqual(self.create.call_count, 2)
+
+    def test_atranslate_packed(self):
+        aclient = mock.Mock()
+        aclient.chat.completions.create = mock.AsyncMock(
+            side_effect=[
+                chat_response('{"1": "甲", "2": "乙"}'),
+                chat_response("丙 {v0}"),
+            ]
+        )
+        self.translator.aclient = mock.Mock(get=mock.Mock(return_value=aclient))
+        self.assertEqual(
+            asyncio.run(self.translator.atranslate_batch(["a", "b", "c {v0}"])),
+            ["甲", "乙", "丙 {v0}"],
+        )
+        self.create.assert_not_called()
+
+    def test_fallback_to_single(self):
+        self.create.side_effect = [
+            chat_response("not json"),
+            chat_response("still not json"),
+            chat_response("甲"),
+            chat_response("乙"),
+        ]
+        self.assertEqual(self.translator.translate_batch(["a", "b"]), ["甲", "乙"])
+        self.assertEqual(self.create.call_count, 4)
+
+    def test_rate_limit_every_request(self):
+        # 重新打包的请求、逐段回退和限流重试都要计入速率限制
+        self.translator.rate_limiter = mock.Mock()
+        self.create.side_effect = [
+            chat_response("not json"),
+            chat_response("still not json"),
+            openai.RateLimitError("slow down", response=mock.Mock(), body=None),
+            chat_response("甲"),
+            chat_response("乙"),
+        ]
+        with mock.patch("tenacity.nap.time.sleep"):
+            self.assertEqual(self.translator.translate_batch(["a", "b"]), ["甲", "乙"])
+        self.assertEqual(self.translator.rate_limiter.acquire.call_count, 5)
+
+
+class TestZhipuTranslator(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+        ConfigManager.clear()
+        self.translator = ZhipuTranslator(
+            "en", "zh", None, envs={"ZHIPU_API_KEY": "test_api_key"}
+        )
+        self.create = mock.AsyncMock()
+        aclient = mock.Mock()
+        aclient.chat.completions.create = self.create
+        self.translator.aclient = mock.Mock(get=mock.Mock(return_value=aclient))
+
+    def tearDown(self):
+        ConfigManager.clear()
+        cache.clean_test_db(self.test_db)
+
+    def test_ado_translate(self):
+        self.create.return_value = chat_response(" 你好 ")
+        self.assertEqual(asyncio.run(self.translator.ado_translate("hello")), "你好")
+
+    def test_irreparable(self):
+        self.create.side_effect = openai.BadRequestError(
+            "bad request", response=mock.Mock(), body={"code": "1301"}
+        )
+        self.assertEqual(
+            asyncio.run(self.translator.ado_translate("hello")),
+            "IRREPARABLE TRANSLATION ERROR",
+        )
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class TestClientPool(unittest.TestCase):
+    def test_split_endpoints(self):
+        self.assertEqual(split_endpoints("a", "k1; k2"), [("a", "k1"), ("a", "k2")])
+        self.assertEqual(split_endpoints("a;b", "k"), [("a", "k"), ("b", "k")])
+        self.assertEqual(split_endpoints("a;b", "k1;k2"), [("a", "k1"), ("b", "k2")])
+        self.assertEqual(split_endpoints("a", None), [("a", None)])
+        with self.assertRaises(ValueError):
+            split_endpoints("a;b;c", "k1;k2")
+
+    def test_least_outstanding(self):
+        pool = ClientPool(["a", "b", "c"])
+        with pool.acquire() as first, pool.acquire() as second:
+            self.assertEqual((first, second), ("a", "b"))
+            with pool.acquire() as third:
+                self.assertEqual(third, "c")
+            with pool.acquire() as fourth:  # c 已经空闲
+                self.assertEqual(fourth, "c")
+        # 空闲时轮流使用
+        used = []
+        for _ in range(3):
+            with pool.acquire() as endpoint:
+                used.append(endpoint)
+        self.assertEqual(used, ["a", "b", "a"])
+
+    def test_unhealthy(self):
+        pool = ClientPool(["a", "b"], cooldown=60)
+        with self.assertRaises(HTTPError):
+            with pool.acquire():
+                raise HTTPError(429)
+        for _ in range(3):
+            with pool.acquire() as endpoint:
+                self.assertEqual(endpoint, "b")
+        # 普通错误不影响端点状态
+        with self.assertRaises(HTTPError):
+            with pool.acquire():
+                raise HTTPError(400)
+        self.assertEqual(pool.failures, [1, 0])
+        self.assertEqual(pool.outstanding, [0, 0])
+
+    def test_rejected_credentials(self):
+        pool = ClientPool(["a", "b"], cooldown=1)
+        with self.assertRaises(HTTPError), pool.acquire():
+            raise HTTPError(401)
+        pool.down_until[1] = 0
+        for _ in range(3):
+            with pool.acquire() as endpoint:
+                self.assertEqual(endpoint, "b")
+        self.assertEqual(pool.down_until[0], float("inf"))
+
+    def test_all_unhealthy(self):
+        pool = ClientPool(["a", "b"], cooldown=60)
+        for _ in range(2):
+            with self.assertRaises(TimeoutError), pool.acquire():
+                raise TimeoutError()
+        pool.down_until[1] += 60
+        with pool.acquire() as endpoint:
+            self.assertEqual(endpoint, "a")
+
+    def test_openai_pool(self):
+        ConfigManager.clear()
+        translator = OpenAIlikedTranslator(
+            lang_in="en",
+            lang_out="zh",
+            model=None,
+            envs={
+                "OPENAILIKED_BASE_URL": "https://a.example.com/v1;https://b.example.com/v1",
+                "OPENAILIKED_API_KEY": "k1;k2",
+                "OPENAILIKED_MODEL": "test_model",
+            },
+        )
+        urls = [str(client.base_url) for client, _ in translator.pool.endpoints]
+        self.assertEqual(
+            urls, ["https://a.example.com/v1/", "https://b.example.com/v1/"]
+        )
+        keys = [client.api_key for client, _ in translator.pool.endpoints]
+        self.assertEqual(keys, ["k1", "k2"])
+
+
+class FailingTranslator(BatchTranslator):
+    name = "failing"
+
+    def do_translate_batch(self, texts):
+        self.batches.append(texts)
+        raise HTTPError(503)
+
+
+class TestFallbackTranslator(unittest.TestCase):
+    def setUp(self):
+        self.test_db = cache.init_test_db()
+
+    def tearDown(self):
+        cache.clean_test_db(self.test_db)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=4, cooldown=60)
+        for ok in [True, False, True]:
+            breaker.record(ok)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.closed)
+        self.assertFalse(breaker.allow())
+        # 冷却结束后只放行一个试探请求
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.closed)
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_breaker_latency(self):
+        breaker = CircuitBreaker(latency=1, min_requests=2)
+        breaker.record(True, 0.5)
+        breaker.record(True, 2)
+        self.assertFalse(breaker.closed)
+
+    def test_fallback(self):
+        primary = FailingTranslator("en", "zh", "test", False)
+        secondary = BatchTranslator("en", "zh", "test", False)
+        translator = FallbackTranslator([primary, secondary])
+        self.assertEqual(translator.translate_batch(["a", "b"]), ["A", "B"])
+        self.assertEqual(primary.batches, [["a", "b"]])
+        # 译文缓存在实际完成翻译的服务下
+        self.assertEqual(secondary.cache.get("a"), "A")
+        self.assertIsNone(primary.cache.get("a"))
+        self.assertEqual(translator.translate_batch(["a", "c"]), ["A", "C"])
+        self.assertEqual(primary.batches, [["a", "b"], ["c"]])
+        self.assertEqual(secondary.batches, [["a", "b"], ["c"]])
+
+    def test_circuit_open(self):
+        primary = FailingTranslator("en", "zh", "test", False)
+        translator = FallbackTranslator(
+            [primary, BatchTranslator("en", "zh", "test", False)]
+        )
+        for text in "abcdef":
+            translator.translate(text)
+        # 连续失败 5 次后跳过主服务
+        self.assertEqual(len(primary.batches), 5)
+        self.assertFalse(translator.breakers[0].closed)
+
+    def test_all_failed(self):
+        translator = FallbackTranslator([FailingTranslator("en", "zh", "test", False)])
+        with self.assertRaises(HTTPError):
+            translator.translate("a")
+        translator.breakers[0].opened_at = time.monotonic()
+        with self.assertRaises(ServicesUnavailableError):
+            translator.translate("a")
+
+    def test_concurrency(self):
+        primary = FailingTranslator("en", "zh", "test", False)
+        secondary = BatchTranslator("en", "zh", "test", False)
+        translator = FallbackTranslator([primary, secondary])
+        self.assertIsNone(translator.concurrency)
+        primary.concurrency = AdaptiveConcurrency(4)
+        secondary.concurrency = AdaptiveConcurrency(4)
+        primary.concurrency.limit, primary.concurrency.latency = 3, 1.0
+        secondary.concurrency.limit = 2
+        self.assertEqual(translator.concurrency.limit, 5)
+        self.assertEqual(translator.concurrency.latency, 1.0)
+
+    def test_atranslate_batch(self):
+        translator = FallbackTranslator(
+            [
+                FailingTranslator("en", "zh", "test", False),
+                BatchTranslator("en", "zh", "test", False),
+            ]
+        )
+        self.assertEqual(asyncio.run(translator.atranslate_batch(["a"])), ["A"])
+
+    def test_acached_off_loop(self):
+        """Test that the cache lookup of atranslate_batch runs in a thread"""
+        secondary = BatchTranslator("en", "zh", "test", False)
+        translator = FallbackTranslator([secondary])
+        secondary.cache.set("a", "A")
+        threads = []
+        get_many = secondary.cache.get_many
+
+        def record(texts):
+            threads.append(threading.current_thread())
+            return get_many(texts)
+
+        with mock.patch.object(secondary.cache, "get_many", record):
+            self.assertEqual(asyncio.run(translator.atranslate_batch(["a"])), ["A"])
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(secondary.batches, [])
+
+
+class BingHandler(BaseHTTPRequestHandler):
+    """Stand-in for bing.com/translator, counts the requests it serves."""
+
+    def do_GET(self):
+        server = self.server
+        server.pages += 1
+        token = f"token{server.pages}"
+        server.tokens.add(token)
+        body = (
+            '<script>"ig":"IG1"</script><div data-iid="translator.5023"></div>'
+            f'<script>params_AbusePreventionHelper = [123,"{token}",3600000];'
+            "</script>"
+        )
+        self.reply(body, "text/html")
+
+    def do_POST(self):
+        server = self.server
+        server.posts += 1
+        length = int(self.headers["Content-Length"])
+        form = dict(
+            field.split("=", 1) for field in self.rfile.read(length).decode().split("&")
+        )
+        if form["token"] not in server.tokens:
+            self.reply(json.dumps({"statusCode": 205}), "application/json")
+        else:
+            translations = [{"text": form["text"].upper(), "to": form["to"]}]
+            self.reply(json.dumps([{"translations": translations}]), "application/json")
+
+    def reply(self, body: str, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestBingTranslator(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), BingHandler)
+        self.server.pages = self.server.posts = 0
+        self.server.tokens = set()
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+        self.translator = BingTranslator("en", "zh", None, ignore_cache=True)
+        self.translator.endpoint = (
+            f"http://127.0.0.1:{self.server.server_port}/translator"
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sid_cached(self):
+        texts = [f"text{i}" for i in range(10)]
+        self.assertEqual(
+            self.translator.translate_batch(texts), [t.upper() for t in texts]
+        )
+        # 翻译页面只获取一次
+        self.assertEqual((self.server.pages, self.server.posts), (1, 10))
+
+    def test_sid_threads(self):
+        threads = [
+            threading.Thread(target=self.translator.translate, args=(f"text{i}",))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((self.server.pages, self.server.posts), (1, 8))
+
+    def test_sid_rejected(self):
+        self.translator.translate("a")
+        self.server.tokens.clear()  # token 过期
+        self.assertEqual(self.translator.translate("b"), "B")
+        self.assertEqual((self.server.pages, self.server.posts), (2, 3))
+
+    def test_sid_expired(self):
+        self.translator.sid_ttl = 0
+        self.translator.translate("a")
+        self.translator.translate("b")
+        self.assertEqual((self.server.pages, self.server.posts), (2, 2))
+
+
 class TestOllamaTranslator(unittest.TestCase):
     def test_do_translate(self):
         translator = OllamaTranslator(lang_in="en", lang_out="zh", model="test:3b")
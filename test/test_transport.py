@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from pdf2zh import transport
+from pdf2zh.transport import Session
+
+
+class TestSession(unittest.TestCase):
+    def test_default_timeout(self):
+        session = Session(timeout=(1, 2))
+        response = requests.Response()
+        response.status_code = 200
+        with mock.patch.object(
+            requests.adapters.HTTPAdapter, "send", return_value=response
+        ) as send:
+            session.get("http://127.0.0.1/a")
+            self.assertEqual(send.call_args.kwargs["timeout"], (1, 2))
+            session.get("http://127.0.0.1/b", timeout=5)
+            self.assertEqual(send.call_args.kwargs["timeout"], 5)
+
+    def test_resize(self):
+        session = Session(pool_size=4)
+        adapter = session.get_adapter("https://example.com")
+        self.assertEqual(adapter._pool_maxsize, 4)
+        session.resize(2)  # 只增不减
+        self.assertIs(session.get_adapter("https://example.com"), adapter)
+        session.resize(16)
+        self.assertEqual(session.get_adapter("https://example.com")._pool_maxsize, 16)
+        self.assertIs(
+            session.get_adapter("http://example.com"),
+            session.get_adapter("https://example.com"),
+        )
+
+    def test_get_session(self):
+        with mock.patch.object(transport, "_session", None):
+            session = transport.get_session(4)
+            self.assertEqual(session.pool_size, 10)
+            self.assertIs(transport.get_session(32), session)
+            self.assertEqual(session.pool_size, 32)
+
+
+if __name__ == "__main__":
+    unittest.main()